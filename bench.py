@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import resource
+import contextlib
+import tracemalloc
+
+# END-TO-END THROUGHPUT BENCHMARK
+# Drives N emails through main.process_batch against the local replay stand-ins of a recorded fixture.
+#
+# Record a fixture (processes the live unread emails once, like a single 'start' cycle):
+#   python main.py record fixtures/recording.json
+# Run the benchmark:
+#   python bench.py fixtures/recording.json --emails 200 --latency-scale 1.0 --llm-error-rate 0.02
+
+CALL_KINDS = ['graph', 'document_intelligence', 'llm', 'esb']
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the email pipeline against a recorded fixture")
+    parser.add_argument('fixture', help="Path of the fixture written by 'python main.py record'")
+    parser.add_argument('--emails', type=int, default=None, help="Number of emails to process (default: the number recorded)")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="Multiplier for the recorded call durations, 0 for no latency")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for the error injection")
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline output instead of suppressing it")
+    parser.add_argument('--watchdog', action='store_true', help="Report the calls that blocked the event loop")
+    for kind in CALL_KINDS:
+        option = kind.replace('_', '-')
+        parser.add_argument(f'--{option}-latency', type=float, default=0.0, help=f"Extra seconds added to every {kind} call")
+        parser.add_argument(f'--{option}-error-rate', type=float, default=0.0, help=f"Probability that a {kind} call fails")
+    return parser.parse_args(argv)
+
+
+def run_benchmark(args):
+    # Use a throwaway ledger so that the replayed emails are never skipped as already processed
+    import ledger
+    ledger.LEDGER_DB_PATH = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench_ledger.db')
+
+    import main
+    import metrics
+    import replay
+    from loop_watchdog import LoopWatchdog
+
+    fixture = replay.load_fixture(args.fixture)
+    messages = replay.install_replay(
+        fixture,
+        email_count=args.emails,
+        latency_scale=args.latency_scale,
+        extra_latency={kind: getattr(args, f'{kind}_latency') for kind in CALL_KINDS},
+        error_rates={kind: getattr(args, f'{kind}_error_rate') for kind in CALL_KINDS},
+        seed=args.seed,
+    )
+    main.EMAIL_ACCOUNTS = ['bench@example.com']
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    async def run_cycle():
+        watchdog = LoopWatchdog() if args.watchdog else None
+        if watchdog is not None:
+            watchdog.start()
+        try:
+            await main.process_batch()
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+        return watchdog
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with output:
+        watchdog = asyncio.run(run_cycle())
+    elapsed = time.perf_counter() - start
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    replay.uninstall()
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"Emails processed:     {len(messages)}")
+    print(f"Wall time:            {elapsed:.2f} s")
+    print(f"Throughput:           {len(messages) / elapsed:.2f} emails/sec")
+    print(f"Peak traced memory:   {peak_traced / (1024 * 1024):.1f} MB")
+    print(f"Peak RSS:             {peak_rss_mb:.1f} MB")
+    print()
+    print(f"{'stage':<14}{'count':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}")
+    for stage_name in main.STAGE_NAMES:
+        p50 = metrics.percentile("stage", 0.5, stage=stage_name)
+        if p50 is None:
+            continue
+        p95 = metrics.percentile("stage", 0.95, stage=stage_name)
+        p99 = metrics.percentile("stage", 0.99, stage=stage_name)
+        count = metrics.counter_value("stage_total", stage=stage_name)
+        print(f"{stage_name:<14}{count:>8}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}")
+
+    if watchdog is not None:
+        print()
+        watchdog.print_report()
+
+
+def main(argv=None):
+    run_benchmark(parse_args(sys.argv[1:] if argv is None else argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import time
+import threading
+import contextlib
+import contextvars
+from collections import deque
+import metrics
+from config import (BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE, BREAKER_OPEN_SECONDS,
+                    BREAKER_HALF_OPEN_CALLS, BREAKER_SLOW_CALL_SECONDS)
+
+# CIRCUIT BREAKERS FOR THE DOWNSTREAM DEPENDENCIES (GRAPH, AZURE OPENAI, DOCUMENT INTELLIGENCE, ESB)
+# Every call to a dependency goes through guard(dependency). The breaker of a dependency trips (opens) when
+# at least BREAKER_FAILURE_RATE of its last BREAKER_WINDOW calls failed or took longer than its slow call
+# threshold. While open, calls fail fast with CircuitOpenError instead of waiting out timeouts. After
+# BREAKER_OPEN_SECONDS the breaker is half-open: BREAKER_HALF_OPEN_CALLS trial calls at a time are let
+# through, a successful trial closes the breaker and a failed one opens it again.
+#
+#   with breakers.guard("esb") as call:
+#       response = requests.get(...)
+#       if response.status_code >= 500:
+#           call.fail()
+
+GRAPH = "graph"
+OPENAI = "openai"
+DOCUMENT_INTELLIGENCE = "document_intelligence"
+ESB = "esb"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_GAUGE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Dependencies whose calls were rejected by an open breaker in the current task (see track_rejections)
+_rejected = contextvars.ContextVar('rejected_dependencies', default=None)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, dependency):
+        super().__init__(f"{dependency} unavailable (circuit open)")
+        self.dependency = dependency
+
+
+def is_dependency_failure(error):
+    """
+    Return True if an exception means the dependency is unhealthy. Client errors (4xx other than
+    408 and 429, e.g. a rejected prompt or a missing message) say nothing about its health.
+    """
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if isinstance(status, int) and 400 <= status < 500:
+        return status in (408, 429)
+    return True
+
+
+def is_failure_status(status):
+    """Return True if an HTTP status of a response means the dependency is unhealthy."""
+    return status >= 500 or status in (408, 429)
+
+
+class CircuitBreaker:
+    """Tracks the outcome of the recent calls to one dependency and decides whether calls are let through."""
+
+    def __init__(self, dependency, slow_call_seconds=None):
+        """
+        Args:
+            dependency (str): Name of the dependency, used in the metrics and errors
+            slow_call_seconds (float): Calls taking longer than this count as failed, None to only count errors
+        """
+        self.dependency = dependency
+        self.slow_call_seconds = slow_call_seconds
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=BREAKER_WINDOW)
+        self._opened_at = 0.0
+        self._trials = 0
+        self._lock = threading.Lock()
+        metrics.set_gauge("circuit_state", STATE_GAUGE_VALUES[CLOSED], dependency=dependency)
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"Circuit breaker for {self.dependency}: {self.state} -> {state}")
+            self.state = state
+            metrics.set_gauge("circuit_state", STATE_GAUGE_VALUES[state], dependency=self.dependency)
+            if state == OPEN:
+                metrics.increment("circuit_opened_total", dependency=self.dependency)
+
+    def is_open(self):
+        """Return True while calls are rejected (open, and not yet time for a trial call)."""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self._opened_at < BREAKER_OPEN_SECONDS
+
+    def before_call(self):
+        """
+        Let a call through or reject it.
+
+        Returns:
+            bool: True if the call is a half-open trial call
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < BREAKER_OPEN_SECONDS:
+                    metrics.increment("circuit_rejected_total", dependency=self.dependency)
+                    raise CircuitOpenError(self.dependency)
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._trials >= BREAKER_HALF_OPEN_CALLS:
+                    metrics.increment("circuit_rejected_total", dependency=self.dependency)
+                    raise CircuitOpenError(self.dependency)
+                self._trials += 1
+                return True
+            return False
+
+    def after_call(self, trial, failed, duration):
+        """Record the outcome of a call that was let through."""
+        if self.slow_call_seconds is not None and duration > self.slow_call_seconds:
+            failed = True
+        with self._lock:
+            if trial:
+                self._trials -= 1
+                if self.state == HALF_OPEN:
+                    if failed:
+                        self._opened_at = time.monotonic()
+                        self._set_state(OPEN)
+                    else:
+                        self._outcomes.clear()
+                        self._set_state(CLOSED)
+                return
+
+            self._outcomes.append(failed)
+            if (self.state == CLOSED and len(self._outcomes) >= BREAKER_MIN_CALLS
+                    and sum(self._outcomes) / len(self._outcomes) >= BREAKER_FAILURE_RATE):
+                self._opened_at = time.monotonic()
+                self._outcomes.clear()
+                self._set_state(OPEN)
+
+
+class _Call:
+    """Handle of a guarded call, fail() marks a call that returned an error response as failed."""
+
+    def __init__(self):
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(dependency):
+    """Return (creating it once) the breaker of a dependency."""
+    breaker = _breakers.get(dependency)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(dependency)
+            if breaker is None:
+                breaker = CircuitBreaker(dependency, BREAKER_SLOW_CALL_SECONDS.get(dependency))
+                _breakers[dependency] = breaker
+    return breaker
+
+
+def is_open(dependency):
+    return get_breaker(dependency).is_open()
+
+
+@contextlib.contextmanager
+def guard(dependency):
+    """
+    Run a call to a dependency through its breaker. Works inside both sync and async functions.
+    Raises CircuitOpenError without running the block while the breaker is open.
+    """
+    breaker = get_breaker(dependency)
+    try:
+        trial = breaker.before_call()
+    except CircuitOpenError:
+        rejected = _rejected.get()
+        if rejected is not None:
+            rejected.add(dependency)
+        raise
+
+    call = _Call()
+    start = time.monotonic()
+    try:
+        yield call
+    except BaseException as e:
+        call.failed = call.failed or (isinstance(e, Exception) and is_dependency_failure(e))
+        raise
+    finally:
+        breaker.after_call(trial, call.failed, time.monotonic() - start)
+
+
+def track_rejections():
+    """
+    Start collecting the dependencies whose calls are rejected in the current task (and the threads it
+    starts with asyncio.to_thread). Returns the set they are added to.
+    """
+    rejected = set()
+    _rejected.set(rejected)
+    return rejected
@@ -0,0 +1,327 @@
+import re
+import datetime
+
+# DETERMINISTIC EXTRACTION OF THE CERTIFICATE DETAILS FROM THE FIXED-LAYOUT FITMENT CERTIFICATES
+# The tracker companies issue certificates with labelled fields ("VIN Number: ...", "Engine No" with the value
+# on the next line, ...). Every field is found by its label in the attachment text (the Document Intelligence
+# or text layer output), parsed and validated. Each value gets a confidence, only the fields below
+# EXTRACTOR_MIN_CONFIDENCE are left to the extraction model. A label only counts at the start of a line or a
+# table cell and followed by a colon, a cell separator or the end of the line ("Make: TOYOTA"), or anywhere
+# when it is followed by a colon. A label at the start of a line that is only followed by a space
+# ("Chassis no. AHTFR22G306012345") counts when its value is validated and the whole rest of the line, so
+# "Year end 2023 review" has no year.
+#
+# The labels in COMMON_LABELS are used for every tracker company, TRACKER_LABELS adds the labels of a
+# specific company's certificate. A new layout is added with register_layout(tracker_company, labels).
+
+# Keys of the certificate details, the same as in the JSON of the extraction templates
+CERTIFICATE_FIELDS = ["vin_number", "engine_number", "registration_number", "vehicle_year", "vehicle_make",
+                      "vehicle_model", "contract_number", "fitment_date", "product_name"]
+
+NOT_FOUND = "not_found"
+
+_NO = r"(?:\s*(?:no|number|nr|num|#)\b\.?)"
+
+COMMON_LABELS = {
+    "vin_number": [rf"\b(?:vin|chassis)(?:\s*(?:/|or)\s*chassis)?{_NO}?"],
+    "engine_number": [rf"\bengine{_NO}"],
+    "registration_number": [rf"\b(?:vehicle\s*)?(?:registration|reg\b\.?){_NO}?(?!\s*date)"],
+    "vehicle_year": [r"\b(?:vehicle\s*|asset\s*|model\s*)?year(?:\s*of\s*manufacture)?\b"],
+    "vehicle_make": [r"\b(?:vehicle\s*|asset\s*)?make\b"],
+    "vehicle_model": [r"\b(?:vehicle\s*|asset\s*)?model\b(?!\s*year)"],
+    "contract_number": [rf"\b(?:contract|agreement){_NO}"],
+    "fitment_date": [r"\b(?:fitment|installation|install|fitted)\s*date\b", r"\bdate\s*(?:of\s*)?(?:fitment|installation)\b"],
+    "product_name": [r"\bproduct(?:\s*(?:name|description|type))?\b", r"\bunit\s*type\b"],
+}
+
+TRACKER_LABELS = {
+    "netstar": {
+        "contract_number": [rf"\bnetstar\s*contract{_NO}?"],
+        "product_name": [r"\bvbu\b"],
+    },
+    "cartrack": {
+        "contract_number": [rf"\bjob\s*card{_NO}?"],
+        "product_name": [r"\bpackage\b"],
+    },
+    "tracker": {
+        "product_name": [r"\bunit\s*fitted\b"],
+    },
+}
+
+# Confidence of a value found on the line of its label, and on the line after its label
+SAME_LINE_CONFIDENCE = 0.9
+NEXT_LINE_CONFIDENCE = 0.8
+# Added for values that passed a strict validation (VIN, date, year, registration, known make), subtracted otherwise
+VALIDATION_ADJUSTMENT = 0.05
+# Subtracted for free text that nothing validates (unknown makes, model and product names), which keeps it
+# below the default EXTRACTOR_MIN_CONFIDENCE so the extraction model still reads the field
+FREE_TEXT_PENALTY = 0.3
+# Factor applied when the certificate has different values for the same field
+CONFLICT_FACTOR = 0.6
+
+KNOWN_VEHICLE_MAKES = {
+    "alfa romeo", "audi", "baic", "bmw", "chery", "chevrolet", "citroen", "datsun", "fiat", "ford", "foton",
+    "gwm", "haval", "honda", "hyundai", "isuzu", "jac", "jaguar", "jeep", "jetour", "kia", "land rover", "lexus",
+    "mahindra", "mazda", "mercedes-benz", "mercedes benz", "mini", "mitsubishi", "nissan", "omoda", "opel",
+    "peugeot", "porsche", "proton", "renault", "subaru", "suzuki", "tata", "toyota", "volkswagen", "vw", "volvo",
+}
+
+# Start of a line (after a bullet) or of a table cell, and the end of a label: a colon, a cell separator or the end of the line
+_CELL_START = r"(?:^[\s*\u2022-]*|(?<=[|\t;])\s*|(?<=\s\s))"
+_CELL_END = r"(?=\s*[:#=|\t]|\s{2,}|\s*$)"
+
+VIN_PATTERN = re.compile(r"\b[A-HJ-NPR-Z0-9]{17}\b")
+VIN_TRANSLITERATION = {**{str(digit): digit for digit in range(10)},
+                       **dict(zip("ABCDEFGH", range(1, 9))), **dict(zip("JKLMN", range(1, 6))), "P": 7, "R": 9,
+                       **dict(zip("STUVWXYZ", range(2, 10)))}
+VIN_WEIGHTS = [8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2]
+
+DATE_PATTERN = re.compile(r"\b(\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{4}|\d{1,2}\s+[A-Za-z]{3,9}\.?\s+\d{4})\b")
+DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d %B %Y', '%d %b %Y']
+
+
+def vin_check_digit_valid(vin):
+    """Return True if the 9th character of the VIN is its ISO 3779 check digit (not used by every manufacturer)."""
+    total = sum(VIN_TRANSLITERATION[char] * weight for char, weight in zip(vin, VIN_WEIGHTS))
+    check = total % 11
+    return vin[8] == ('X' if check == 10 else str(check))
+
+
+def parse_vin(value):
+    """
+    Returns:
+        tuple: (VIN, strictly validated) or None. A VIN with a valid check digit is strictly validated.
+    """
+    match = VIN_PATTERN.search(value.upper().replace(' ', ''))
+    if match is None:
+        return None
+    vin = match.group(0)
+    if not (re.search(r"[A-Z]", vin) and re.search(r"\d", vin)):
+        return None
+    return vin, vin_check_digit_valid(vin)
+
+
+def parse_date(value):
+    """Parse a date in one of DATE_FORMATS and return it as YYYY-MM-DD."""
+    match = DATE_PATTERN.search(value)
+    if match is None:
+        return None
+    text = re.sub(r"\s+", " ", match.group(1))
+    if ' ' in text:
+        # "3 Mar. 2024"
+        text = text.replace('.', '')
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+        if 1990 <= date.year <= datetime.date.today().year + 1:
+            return date.isoformat(), True
+    return None
+
+
+def parse_year(value):
+    match = re.search(r"\b(19[5-9]\d|20\d\d)\b", value)
+    if match is None or int(match.group(1)) > datetime.date.today().year + 1:
+        return None
+    return match.group(1), True
+
+
+def parse_registration(value):
+    """South African registration numbers, e.g. "CA 123-456", "ABC 123 GP", "BB 12 CD GP"."""
+    match = re.search(r"\b[A-Z0-9]{1,4}(?:[ -]?[A-Z0-9]{1,4}){1,3}\b", value.upper())
+    if match is None:
+        return None
+    registration = match.group(0)
+    compact = re.sub(r"[ -]", "", registration)
+    if not (4 <= len(compact) <= 10 and re.search(r"[A-Z]", compact) and re.search(r"\d", compact)):
+        return None
+    return registration, True
+
+
+def parse_identifier(value):
+    """Engine and contract numbers: the first token with at least one digit."""
+    match = re.search(r"\b(?=[A-Z0-9/-]*\d)[A-Z0-9][A-Z0-9/-]{3,24}\b", value.upper())
+    if match is None:
+        return None
+    return match.group(0), False
+
+
+def parse_make(value):
+    """A make in KNOWN_VEHICLE_MAKES is strictly validated, any other make is free text."""
+    text = value.strip(" :-").split('  ')[0].strip()
+    if not text or len(text) > 30:
+        return None
+    return text, True if text.lower() in KNOWN_VEHICLE_MAKES else None
+
+
+def parse_text(value):
+    """Model and product names: the rest of the line, when it is a plausible name. Free text, not validated."""
+    text = re.sub(r"\s+", " ", value.strip(" :-"))
+    if not text or len(text) > 60 or not re.search(r"[A-Za-z]", text):
+        return None
+    return text, None
+
+
+PARSERS = {
+    "vin_number": parse_vin,
+    "engine_number": parse_identifier,
+    "registration_number": parse_registration,
+    "vehicle_year": parse_year,
+    "vehicle_make": parse_make,
+    "vehicle_model": parse_text,
+    "contract_number": parse_identifier,
+    "fitment_date": parse_date,
+    "product_name": parse_text,
+}
+
+
+def register_layout(tracker_company, labels):
+    """Add the label patterns (field -> list of regular expressions) of a tracker company's certificate."""
+    for field, patterns in labels.items():
+        TRACKER_LABELS.setdefault(tracker_company, {}).setdefault(field, []).extend(patterns)
+
+
+def _anchor_label(pattern):
+    """
+    Only match a label at the start of a line or cell and followed by a delimiter, or followed by a colon. The
+    group "bare" is set for a label at the start of a line that is only followed by a space.
+    """
+    return re.compile(rf"{_CELL_START}(?:{pattern}){_CELL_END}|(?:{pattern})(?=\s*:)|^(?:{pattern})(?P<bare>)(?=\s)",
+                      re.IGNORECASE)
+
+
+def get_label_patterns(tracker_company):
+    """Return the compiled label patterns per field for a tracker company, the company's own labels first."""
+    tracker_labels = TRACKER_LABELS.get(tracker_company, {})
+    return {field: [_anchor_label(pattern) for pattern in tracker_labels.get(field, []) + COMMON_LABELS[field]]
+            for field in CERTIFICATE_FIELDS}
+
+
+def _find_label(line, patterns):
+    """Return (end, bare) of the first label in the line, or None. See _anchor_label for bare labels."""
+    for pattern in patterns:
+        match = pattern.search(line)
+        if match is not None and match.end() > match.start():
+            return match.end(), match.group("bare") is not None
+    return None
+
+
+def _is_whole_value(field, value, parsed_value):
+    """Return True if the parsed value is all of the text it was parsed from."""
+    if field == "fitment_date":
+        return DATE_PATTERN.fullmatch(value) is not None
+    return re.sub(r"[\s-]", "", parsed_value).lower() == re.sub(r"[\s-]", "", value).lower()
+
+
+def _cut_at_next_label(value, label_patterns):
+    """Cut a value at the next label on the same line, e.g. "TOYOTA  Model: HILUX" -> "TOYOTA"."""
+    end = len(value)
+    for patterns in label_patterns.values():
+        for pattern in patterns:
+            match = pattern.search(value)
+            if match is not None and match.start() > 0:
+                end = min(end, match.start())
+    return value[:end]
+
+
+def _candidates(lines, field, label_patterns):
+    """Yield (value, confidence) for every occurrence of the field's label in the lines."""
+    parser = PARSERS[field]
+    for index, line in enumerate(lines):
+        label = _find_label(line, label_patterns[field])
+        if label is None:
+            continue
+        label_end, bare = label
+
+        same_line = _cut_at_next_label(line[label_end:], label_patterns).strip(" \t:-#.|")
+        next_lines = [candidate for candidate in lines[index + 1:index + 2] if candidate.strip()]
+        options = [(same_line, SAME_LINE_CONFIDENCE)] if same_line else []
+        if not bare and next_lines and not any(_find_label(next_lines[0], patterns) is not None for patterns in label_patterns.values()):
+            options.append((next_lines[0].strip(" \t|"), NEXT_LINE_CONFIDENCE))
+
+        for value, confidence in options:
+            parsed = parser(value)
+            # Free text after a bare label is not taken as its value ("Make sure the unit is activated")
+            if parsed is not None and bare and (parsed[1] is None or not _is_whole_value(field, value, parsed[0])):
+                parsed = None
+            if parsed is not None:
+                # strict is True for a strictly validated value, False for a format check only and None for free text
+                parsed_value, strict = parsed
+                if strict is None:
+                    yield parsed_value, confidence - FREE_TEXT_PENALTY
+                else:
+                    yield parsed_value, confidence + (VALIDATION_ADJUSTMENT if strict else -VALIDATION_ADJUSTMENT)
+                break
+
+
+def extract_certificate_fields(tracker_company, texts):
+    """
+    Extract the certificate details from the attachment texts of an email.
+
+    Args:
+        tracker_company (str): Tracker company the email was classified as
+        texts (list): Texts to search, in order of preference
+
+    Returns:
+        tuple: (details, confidence) - details has all CERTIFICATE_FIELDS ("not_found" when no value was
+               found), confidence has a score between 0 and 1 per field (0 when not found)
+    """
+    label_patterns = get_label_patterns(tracker_company)
+    lines = [line.strip() for text in texts for line in (text or '').splitlines()]
+
+    details = {}
+    confidence = {}
+    for field in CERTIFICATE_FIELDS:
+        candidates = list(_candidates(lines, field, label_patterns))
+        if not candidates:
+            details[field] = NOT_FOUND
+            confidence[field] = 0.0
+            continue
+
+        value, score = max(candidates, key=lambda candidate: candidate[1])
+        if len({re.sub(r"[\s-]", "", candidate[0]).lower() for candidate in candidates}) > 1:
+            score *= CONFLICT_FACTOR
+        details[field] = value
+        confidence[field] = round(min(score, 1.0), 2)
+
+    return details, confidence
+
+
+def context_texts(context):
+    """
+    Texts of an EmailContext to extract the certificate details from: the attachments only. The body is free
+    text ("Year end 2023 review") that is left to the extraction model.
+    """
+    return [attachment.get("content", "") for attachment in context.attachments]
+
+
+def _is_valid(field, value):
+    """Validate a value returned by the extraction model, "not_found" is valid for every field."""
+    if value == NOT_FOUND:
+        return True
+    if not isinstance(value, str) or not value.strip():
+        return False
+    if field == "vin_number":
+        parsed = parse_vin(value)
+        if parsed is None or parsed[0] != value.strip().upper():
+            return False
+        # The check digit is only mandatory for VINs of North American vehicles (world manufacturer identifier 1-5)
+        return parsed[1] or value.strip()[0] not in "12345"
+    if field == "fitment_date":
+        return re.fullmatch(r"\d{4}-\d{2}-\d{2}", value) is not None and parse_date(value) is not None
+    if field == "vehicle_year":
+        return re.fullmatch(r"\d{4}", value) is not None and parse_year(value) is not None
+    if field == "registration_number":
+        return parse_registration(value) is not None
+    return True
+
+
+def invalid_fields(details, required_fields=()):
+    """
+    Return the fields of extracted certificate details that fail validation: an invalid VIN, date, year or
+    registration number, or "not_found" (or no value) for one of the required fields.
+    """
+    return [field for field in CERTIFICATE_FIELDS
+            if (field in details and not _is_valid(field, details[field]))
+            or (field in required_fields and details.get(field, NOT_FOUND) == NOT_FOUND)]
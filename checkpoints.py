@@ -0,0 +1,65 @@
+import json
+import datetime
+import ledger
+
+# CHECKPOINTS ARE STORED IN THE SAME SQLITE DATABASE AS THE PROCESSING LEDGER
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stage_checkpoints (
+    ledger_key TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    output TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (ledger_key, stage)
+);
+"""
+
+_schema_created = False
+
+
+def _get_connection():
+    global _schema_created
+    connection = ledger.get_connection()
+    if not _schema_created:
+        connection.executescript(SCHEMA)
+        _schema_created = True
+    return connection
+
+
+def save_checkpoint(key, stage, output):
+    """
+    Persist the output of a completed stage.
+
+    Args:
+        key (str): Ledger key of the email
+        stage (str): Name of the stage
+        output (dict): JSON serialisable stage output
+    """
+    connection = _get_connection()
+    with ledger._lock:
+        connection.execute(
+            "INSERT OR REPLACE INTO stage_checkpoints (ledger_key, stage, output, created_at) VALUES (?, ?, ?, ?)",
+            (key, stage, json.dumps(output, default=str), datetime.datetime.now(datetime.timezone.utc).isoformat())
+        )
+
+
+def load_checkpoints(key):
+    """Return a dict of stage name -> saved output for every completed stage of an email."""
+    connection = _get_connection()
+    with ledger._lock:
+        rows = connection.execute(
+            "SELECT stage, output FROM stage_checkpoints WHERE ledger_key = ?", (key,)
+        ).fetchall()
+    return {stage: json.loads(output) for stage, output in rows}
+
+
+def clear_checkpoints(key, stages=None):
+    """Delete the saved outputs of an email, either for all stages or only for the given stage names."""
+    connection = _get_connection()
+    with ledger._lock:
+        if stages is None:
+            connection.execute("DELETE FROM stage_checkpoints WHERE ledger_key = ?", (key,))
+        else:
+            connection.executemany(
+                "DELETE FROM stage_checkpoints WHERE ledger_key = ? AND stage = ?",
+                [(key, stage) for stage in stages]
+            )
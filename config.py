@@ -1,9 +1,33 @@
 import os
+import socket
 
 # AZURE OPENAI CONNECTION DETAILS
 AZURE_OPENAI_KEY=os.environ.get('AZURE_OPENAI_KEY')
 AZURE_OPENAI_ENDPOINT=os.environ.get('AZURE_OPENAI_ENDPOINT')
 
+# LLM CALL DEADLINES IN SECONDS PER CALL TYPE (INCLUDING THE CLIENT RETRIES), OTHER CALL TYPES USE LLM_DEFAULT_TIMEOUT
+LLM_DEFAULT_TIMEOUT = float(os.environ.get('LLM_DEFAULT_TIMEOUT', 60))
+LLM_TIMEOUTS = {
+    'tracker_company': float(os.environ.get('LLM_TIMEOUT_TRACKER_COMPANY', 20)),
+    'policy_number': float(os.environ.get('LLM_TIMEOUT_POLICY_NUMBER', 20)),
+    'id_number': float(os.environ.get('LLM_TIMEOUT_ID_NUMBER', 20)),
+    'certificate_details': float(os.environ.get('LLM_TIMEOUT_CERTIFICATE_DETAILS', 60)),
+}
+# HEDGED LLM CALLS - A CALL STILL RUNNING AFTER THE LLM_HEDGE_QUANTILE LATENCY OF ITS CALL TYPE AND MODEL IS SENT A SECOND
+# TIME, THE FIRST ANSWER IS USED. ONLY ONCE LLM_HEDGE_MIN_SAMPLES CALLS WERE TIMED, AND NEVER EARLIER THAN LLM_HEDGE_MIN_DELAY
+LLM_HEDGING = os.environ.get('LLM_HEDGING', 'false').lower() == 'true'
+LLM_HEDGE_QUANTILE = float(os.environ.get('LLM_HEDGE_QUANTILE', 0.95))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', 20))
+LLM_HEDGE_MIN_DELAY = float(os.environ.get('LLM_HEDGE_MIN_DELAY', 2))
+# THE HEDGE IS SENT TO THIS ENDPOINT (DEFAULTS TO AZURE_OPENAI_ENDPOINT) AND DEPLOYMENT, E.G. "gpt-4o=gpt-4o-secondary"
+AZURE_OPENAI_HEDGE_ENDPOINT = os.environ.get('AZURE_OPENAI_HEDGE_ENDPOINT')
+AZURE_OPENAI_HEDGE_KEY = os.environ.get('AZURE_OPENAI_HEDGE_KEY', AZURE_OPENAI_KEY)
+LLM_HEDGE_DEPLOYMENTS = {model.strip(): deployment.strip() for model, deployment in
+                         (item.split('=') for item in os.environ.get('LLM_HEDGE_DEPLOYMENTS', '').split(',') if '=' in item)}
+
+# TIMEOUT IN SECONDS OF THE ESB REQUESTS (TOKEN, ACTIVE POLICIES, VEHICLES), FOR CONNECTING AND FOR EACH READ
+ESB_TIMEOUT_SECONDS = float(os.environ.get('ESB_TIMEOUT_SECONDS', 30))
+
 # SQL SERVER CONNECTIONS
 # SQL_SERVER = os.environ.get('SQL_SERVER')
 # SQL_DATABASE = os.environ.get('SQL_DATABASE')
@@ -22,8 +46,156 @@ AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT=os.environ.get('AZURE_DOCUMENT_INTELLIGENCE
 AZURE_DOCUMENT_INTELLIGENCE_KEY=os.environ.get('AZURE_DOCUMENT_INTELLIGENCE_KEY')
 
 # EMAIL CONFIGURATIONS
-EMAIL_ACCOUNTS = [os.environ.get('EMAIL_ACCOUNT')]
+# EMAIL_ACCOUNT MAY HOLD SEVERAL COMMA SEPARATED MAILBOXES
+EMAIL_ACCOUNTS = [account.strip() for account in os.environ.get('EMAIL_ACCOUNT', '').split(',') if account.strip()]
 DEFAULT_EMAIL_ACCOUNT = 'tevinri@tihsa.co.za'
 
+# MAXIMUM NUMBER OF UNREAD EMAILS FETCHED PER MAILBOX AND CYCLE
+FETCH_MAX_MESSAGES = int(os.environ.get('FETCH_MAX_MESSAGES', 500))
 # INTERVAL IN SECONDS(30) 
 EMAIL_FETCH_INTERVAL = 30
+
+# PROCESSING LEDGER (SQLITE) - TRACKS WHICH EMAILS HAVE ALREADY BEEN PROCESSED
+LEDGER_DB_PATH = os.environ.get('LEDGER_DB_PATH', 'processing_ledger.db')
+# SECONDS AFTER WHICH AN EMAIL STUCK IN THE "processing" STATE (E.G. AFTER A CRASH) MAY BE CLAIMED AGAIN
+LEDGER_STALE_SECONDS = int(os.environ.get('LEDGER_STALE_SECONDS', 900))
+# NUMBER OF FAILED ATTEMPTS AFTER WHICH AN EMAIL IS NO LONGER PICKED UP AUTOMATICALLY
+LEDGER_MAX_ATTEMPTS = int(os.environ.get('LEDGER_MAX_ATTEMPTS', 3))
+# SQLITE JOURNAL MODE OF THE LEDGER, USE DELETE WHEN THE DATABASE IS ON NETWORK STORAGE SHARED BY SEVERAL INSTANCES
+LEDGER_JOURNAL_MODE = os.environ.get('LEDGER_JOURNAL_MODE', 'WAL')
+# MARK EMAILS THAT THE LEDGER ALREADY HAS AS COMPLETED (E.G. A FAILED MARK-AS-READ OR A COPY IN ANOTHER MAILBOX) AS READ
+MARK_PROCESSED_AS_READ = os.environ.get('MARK_PROCESSED_AS_READ', 'false').lower() == 'true'
+
+# FORWARDING - DISABLED BY DEFAULT WHILE TESTING
+FORWARD_EMAILS = os.environ.get('FORWARD_EMAILS', 'false').lower() == 'true'
+DEFAULT_FORWARD_TO = os.environ.get('DEFAULT_FORWARD_TO', 'connexaibiztest@tihsa.co.za')
+# "one_shot" FORWARDS WITH A SINGLE GRAPH CALL (/forward), "draft" CREATES, UPDATES AND SENDS A FORWARD DRAFT
+# THE DRAFT FLOW IS ALSO USED WHEN GRAPH REJECTS THE ONE-SHOT FORWARD
+FORWARD_MODE = os.environ.get('FORWARD_MODE', 'one_shot').lower()
+# EMAILS HELD BACK BY THE SAFE ATTACHMENTS SCAN ARE PARKED, ONLY THE SCAN STATUS IS CHECKED AGAIN (SEE deferred.py)
+# SECONDS BEFORE THE FIRST CHECK, DOUBLED AFTER EVERY CHECK UP TO DEFER_MAX_DELAY
+DEFER_INITIAL_DELAY = int(os.environ.get('DEFER_INITIAL_DELAY', 60))
+DEFER_MAX_DELAY = int(os.environ.get('DEFER_MAX_DELAY', 900))
+# SECONDS AFTER THE FIRST DEFERRAL AFTER WHICH THE EMAIL IS NO LONGER PARKED AND COUNTS AS FAILED
+DEFER_MAX_AGE = int(os.environ.get('DEFER_MAX_AGE', 7200))
+
+# PROMETHEUS METRICS ENDPOINT (http://127.0.0.1:<port>/metrics), SET TO 0 TO DISABLE
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+
+# LLM TOKEN PRICES IN USD PER 1 MILLION TOKENS, USED TO ESTIMATE THE COST OF EVERY MODEL CALL
+MODEL_PRICES_USD_PER_1M_TOKENS = {
+    'gpt-4o': {'input': 2.50, 'cached_input': 1.25, 'output': 10.00},
+    'gpt-4o-mini': {'input': 0.15, 'cached_input': 0.075, 'output': 0.60},
+}
+
+# LLM SPEND BUDGETS IN USD, SET TO 0 TO DISABLE
+HOURLY_BUDGET_USD = float(os.environ.get('HOURLY_BUDGET_USD', 0))
+DAILY_BUDGET_USD = float(os.environ.get('DAILY_BUDGET_USD', 0))
+# FRACTION OF A BUDGET AFTER WHICH PROCESSING IS SLOWED DOWN AND ROUTED TO THE CHEAPER MODEL
+BUDGET_SOFT_LIMIT = float(os.environ.get('BUDGET_SOFT_LIMIT', 0.8))
+BUDGET_FALLBACK_MODEL = os.environ.get('BUDGET_FALLBACK_MODEL', 'gpt-4o-mini')
+# SECONDS TO WAIT BETWEEN EMAILS WHILE OVER THE SOFT LIMIT
+BUDGET_THROTTLE_DELAY = int(os.environ.get('BUDGET_THROTTLE_DELAY', 10))
+
+# ATTACHMENTS LARGER THAN THIS ARE NOT DOWNLOADED OR ANALYSED
+MAX_ATTACHMENT_BYTES = int(os.environ.get('MAX_ATTACHMENT_BYTES', 20 * 1024 * 1024))
+
+# READ THE TEXT LAYER OF DIGITAL PDFS LOCALLY (REQUIRES pypdf) AND ONLY OCR THE PAGES WITHOUT ONE
+LOCAL_PDF_TEXT_LAYER = os.environ.get('LOCAL_PDF_TEXT_LAYER', 'true').lower() == 'true'
+# PAGES WITH LESS TEXT THAN THIS IN THEIR TEXT LAYER ARE TREATED AS SCANNED AND SENT TO DOCUMENT INTELLIGENCE
+PDF_TEXT_LAYER_MIN_CHARS = int(os.environ.get('PDF_TEXT_LAYER_MIN_CHARS', 50))
+
+# ATTACHMENTS WITH AT LEAST THIS MANY PAGES ONLY KEEP THE PAGES LIKELY TO HOLD CERTIFICATE DATA
+PAGE_SELECTION_MIN_PAGES = int(os.environ.get('PAGE_SELECTION_MIN_PAGES', 5))
+# MAXIMUM NUMBER OF SCANNED PAGES OF SUCH AN ATTACHMENT THAT ARE SENT TO DOCUMENT INTELLIGENCE
+PAGE_SELECTION_MAX_OCR_PAGES = int(os.environ.get('PAGE_SELECTION_MAX_OCR_PAGES', 10))
+# A PAGE IS KEPT WHEN IT MENTIONS ONE OF THESE (OR ONE OF THE TRACKING COMPANIES IN extraction_templates)
+CERTIFICATE_PAGE_KEYWORDS = ['certificate', 'fitment', 'fitted', 'installation', 'installed', 'tracking', 'tracker',
+                             'vin', 'chassis', 'engine no', 'engine number', 'registration', 'reg no']
+
+# SCANNED PDFS WITH MORE PAGES TO OCR THAN THIS ARE SPLIT AND THE CHUNKS ANALYSED IN PARALLEL, SET TO 0 TO DISABLE
+DI_CHUNK_PAGES = int(os.environ.get('DI_CHUNK_PAGES', 4))
+# MAXIMUM NUMBER OF CHUNKS OF ONE DOCUMENT ANALYSED AT THE SAME TIME
+DI_MAX_CONCURRENCY = int(os.environ.get('DI_MAX_CONCURRENCY', 4))
+
+# READ THE CERTIFICATE DETAILS FROM THE LABELLED FIELDS OF THE KNOWN CERTIFICATE LAYOUTS (SEE certificate_extractors.py)
+DETERMINISTIC_EXTRACTION = os.environ.get('DETERMINISTIC_EXTRACTION', 'true').lower() == 'true'
+# FIELDS READ WITH A LOWER CONFIDENCE THAN THIS (0-1) ARE EXTRACTED BY THE MODEL
+EXTRACTOR_MIN_CONFIDENCE = float(os.environ.get('EXTRACTOR_MIN_CONFIDENCE', 0.75))
+# MODEL CASCADE - THE CERTIFICATE DETAILS ARE EXTRACTED WITH THE CHEAP MODEL FIRST, THE FIELDS THAT FAIL VALIDATION
+# (VIN, DATE FORMAT, YEAR RANGE, REGISTRATION, "not_found" ON A REQUIRED FIELD) ARE EXTRACTED AGAIN WITH GPT-4O
+EXTRACTION_CASCADE = os.environ.get('EXTRACTION_CASCADE', 'true').lower() == 'true'
+CASCADE_CHEAP_MODEL = os.environ.get('CASCADE_CHEAP_MODEL', 'gpt-4o-mini')
+CASCADE_REQUIRED_FIELDS = [field.strip() for field in os.environ.get('CASCADE_REQUIRED_FIELDS', 'vin_number,fitment_date').split(',') if field.strip()]
+# WHEN NEITHER THE POLICY NUMBER NOR THE ID NUMBER IS IN THE LATEST MESSAGE, LOOK FOR THEM IN THE QUOTED HISTORY OF THE EMAIL (EXTRA MODEL CALLS)
+FULL_TRAIL_SEARCH = os.environ.get('FULL_TRAIL_SEARCH', 'true').lower() == 'true'
+
+# IMAGE ATTACHMENTS BELOW THESE SIZES (BYTES, OR PIXELS ON THE SHORTER SIDE) ARE LOGOS OR ICONS AND ARE NOT ANALYSED
+MIN_IMAGE_ATTACHMENT_BYTES = int(os.environ.get('MIN_IMAGE_ATTACHMENT_BYTES', 10 * 1024))
+MIN_IMAGE_DIMENSION = int(os.environ.get('MIN_IMAGE_DIMENSION', 200))
+# AN IMAGE THAT ARRIVES WITH THIS MANY DIFFERENT EMAILS IS A SIGNATURE IMAGE AND IS NEVER ANALYSED AGAIN
+SIGNATURE_IMAGE_MIN_EMAILS = int(os.environ.get('SIGNATURE_IMAGE_MIN_EMAILS', 3))
+# ONLY IMAGES UP TO THIS SIZE IN BYTES ARE COUNTED AS POSSIBLE SIGNATURE IMAGES
+SIGNATURE_IMAGE_MAX_BYTES = int(os.environ.get('SIGNATURE_IMAGE_MAX_BYTES', 100 * 1024))
+
+# MAXIMUM NUMBER OF EMAILS OF ONE MAILBOX PROCESSED AT THE SAME TIME, 0 FOR NO LIMIT OTHER THAN THE BATCH SIZE
+ACCOUNT_MAX_CONCURRENCY = int(os.environ.get('ACCOUNT_MAX_CONCURRENCY', 0))
+# SHARE OF THE PROCESSING WORKERS PER MAILBOX, E.G. "claims@example.com=2,tracking@example.com=1" (DEFAULT WEIGHT 1)
+ACCOUNT_WEIGHTS = {account.strip(): int(weight) for account, weight in
+                   (item.split('=') for item in os.environ.get('ACCOUNT_WEIGHTS', '').split(',') if '=' in item)}
+
+# PRIORITY OF THE QUEUED EMAILS: EMAILS RECEIVED IN THE LAST PRIORITY_SLA_SECONDS GO FIRST (NEWEST FIRST), THE BACKLOG
+# AFTER THEM (OLDEST FIRST). WITHIN EACH, EMAILS UNDER PRIORITY_LARGE_EMAIL_BYTES GO AHEAD OF LARGE ONES
+PRIORITY_SLA_SECONDS = int(os.environ.get('PRIORITY_SLA_SECONDS', 1800))
+PRIORITY_LARGE_EMAIL_BYTES = int(os.environ.get('PRIORITY_LARGE_EMAIL_BYTES', 5 * 1024 * 1024))
+# EMAILS THAT MENTION A TRACKER COMPANY (SUBJECT, SENDER, PREVIEW) GO AHEAD WITHIN THEIR CLASS, E.G. "netstar=2,tracker=1"
+PRIORITY_TRACKER_WEIGHTS = {tracker.strip().lower(): int(weight) for tracker, weight in
+                            (item.split('=') for item in os.environ.get('PRIORITY_TRACKER_WEIGHTS', '').split(',') if '=' in item)}
+
+# DRAIN MODE - WHILE AT LEAST DRAIN_BACKLOG_THRESHOLD EMAILS ARE QUEUED (E.G. AFTER AN OUTAGE), UP TO DRAIN_MAX_CONCURRENCY
+# EMAILS ARE PROCESSED AT THE SAME TIME INSTEAD OF BATCH_SIZE, UNTIL NO MORE THAN DRAIN_EXIT_BACKLOG ARE QUEUED.
+# SET DRAIN_MAX_CONCURRENCY TO WHAT THE OPENAI AND DOCUMENT INTELLIGENCE RATE LIMITS ALLOW, SET THE THRESHOLD TO 0 TO DISABLE
+DRAIN_BACKLOG_THRESHOLD = int(os.environ.get('DRAIN_BACKLOG_THRESHOLD', 50))
+DRAIN_EXIT_BACKLOG = int(os.environ.get('DRAIN_EXIT_BACKLOG', 5))
+DRAIN_MAX_CONCURRENCY = int(os.environ.get('DRAIN_MAX_CONCURRENCY', 8))
+# MICROSOFT GRAPH ALLOWS 4 CONCURRENT REQUESTS PER MAILBOX, THE PER-MAILBOX LIMIT IN DRAIN MODE
+GRAPH_MAILBOX_CONCURRENCY = int(os.environ.get('GRAPH_MAILBOX_CONCURRENCY', 4))
+
+# CIRCUIT BREAKERS PER DEPENDENCY (SEE breakers.py): A BREAKER OPENS WHEN BREAKER_FAILURE_RATE OF THE LAST BREAKER_WINDOW
+# CALLS (AT LEAST BREAKER_MIN_CALLS) FAILED OR WERE SLOWER THAN THE SLOW CALL THRESHOLD OF THE DEPENDENCY
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 10))
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))
+# SECONDS AN OPEN BREAKER REJECTS CALLS BEFORE TRIAL CALLS ARE LET THROUGH, AND THE NUMBER OF TRIAL CALLS AT A TIME
+BREAKER_OPEN_SECONDS = int(os.environ.get('BREAKER_OPEN_SECONDS', 30))
+BREAKER_HALF_OPEN_CALLS = int(os.environ.get('BREAKER_HALF_OPEN_CALLS', 1))
+# SECONDS AFTER WHICH A CALL COUNTS AS FAILED (SLOW)
+BREAKER_SLOW_CALL_SECONDS = {
+    'graph': float(os.environ.get('BREAKER_SLOW_GRAPH_SECONDS', 15)),
+    'openai': float(os.environ.get('BREAKER_SLOW_OPENAI_SECONDS', 45)),
+    'document_intelligence': float(os.environ.get('BREAKER_SLOW_DI_SECONDS', 90)),
+    'esb': float(os.environ.get('BREAKER_SLOW_ESB_SECONDS', 15)),
+}
+
+# MULTI-INSTANCE WORK CLAIMING - EVERY EMAIL IS LEASED BY ONE INSTANCE WHILE IT IS PROCESSED (SEE leases.py)
+# BACKEND: "sqlite" (SHARED DATABASE FILE, DEFAULTS TO THE LEDGER DATABASE) OR "memory" (SINGLE INSTANCE)
+LEASE_BACKEND = os.environ.get('LEASE_BACKEND', 'sqlite')
+LEASE_DB_PATH = os.environ.get('LEASE_DB_PATH', '')
+# A LEASE EXPIRES THIS MANY SECONDS AFTER ITS LAST RENEWAL, IT IS RENEWED EVERY THIRD OF THIS WHILE THE EMAIL IS IN FLIGHT.
+# KEEP IT ABOVE THE LONGEST CALL DEADLINE (LLM_TIMEOUTS, ESB_TIMEOUT_SECONDS)
+LEASE_TTL_SECONDS = int(os.environ.get('LEASE_TTL_SECONDS', 180))
+# NAME OF THIS INSTANCE IN THE LEASES, MUST BE UNIQUE PER RUNNING INSTANCE
+INSTANCE_ID = os.environ.get('INSTANCE_ID', f'{socket.gethostname()}-{os.getpid()}')
+
+# WHERE CPU-BOUND WORK (HTML CONVERSION, PARAGRAPHS, PROMPT JSON, EMBEDDINGS) RUNS: "thread", "process" OR "inline"
+CPU_EXECUTOR = os.environ.get('CPU_EXECUTOR', 'thread')
+CPU_EXECUTOR_WORKERS = int(os.environ.get('CPU_EXECUTOR_WORKERS', os.cpu_count() or 2))
+
+# EVENT LOOP WATCHDOG - LOGS THE CALLS THAT BLOCK THE EVENT LOOP (ALSO ENABLED WITH "python main.py watchdog")
+LOOP_WATCHDOG = os.environ.get('LOOP_WATCHDOG', 'false').lower() == 'true'
+# SECONDS WITHOUT A HEARTBEAT AFTER WHICH THE LOOP COUNTS AS STALLED
+LOOP_STALL_THRESHOLD = float(os.environ.get('LOOP_STALL_THRESHOLD', 0.25))
+# SECONDS BETWEEN HEARTBEATS AND BETWEEN STACK SAMPLES
+LOOP_WATCHDOG_INTERVAL = float(os.environ.get('LOOP_WATCHDOG_INTERVAL', 0.05))
+# SECONDS BETWEEN REPORTS OF THE TOP BLOCKING CALL SITES, 0 TO ONLY REPORT ON EXIT
+LOOP_WATCHDOG_REPORT_INTERVAL = int(os.environ.get('LOOP_WATCHDOG_REPORT_INTERVAL', 300))
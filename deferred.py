@@ -0,0 +1,95 @@
+import time
+import ledger
+import metrics
+from config import DEFER_INITIAL_DELAY, DEFER_MAX_DELAY, DEFER_MAX_AGE
+
+# EMAILS PARKED UNTIL SOMETHING OUTSIDE THE PIPELINE IS READY, STORED IN THE SAME SQLITE DATABASE AS THE LEDGER
+# While Defender Safe Attachments scans the attachments of an email, Graph returns a "Safe Attachments Scan
+# In Progress" placeholder instead of them. Such an email is parked instead of failing: it is skipped on every
+# poll until its retry time, and then only the scan status is checked again (one Graph call). The checkpointed
+# stages are kept, so no OCR or LLM call is repeated while waiting. The delay doubles after every check, up to
+# DEFER_MAX_DELAY, and an email still waiting DEFER_MAX_AGE seconds after it was first parked is failed.
+# Emails are parked the same way while the circuit breaker of a dependency they need is open (see breakers.py),
+# and are let through again once the breaker allows calls.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deferred_emails (
+    ledger_key TEXT PRIMARY KEY,
+    account TEXT,
+    message_id TEXT,
+    reason TEXT,
+    checks INTEGER NOT NULL DEFAULT 0,
+    first_deferred_at REAL NOT NULL,
+    retry_at REAL NOT NULL
+);
+"""
+
+COLUMNS = ['ledger_key', 'account', 'message_id', 'reason', 'checks', 'first_deferred_at', 'retry_at']
+
+_schema_created = False
+
+
+class DeferEmail(Exception):
+    """Raised by a pipeline stage to park the email instead of failing it, the message is the reason."""
+
+
+def _get_connection():
+    global _schema_created
+    connection = ledger.get_connection()
+    if not _schema_created:
+        connection.executescript(SCHEMA)
+        _schema_created = True
+    return connection
+
+
+def get_deferral(key):
+    """Return the deferred_emails row of a parked email as a dict, None if the email is not parked."""
+    connection = _get_connection()
+    with ledger._lock:
+        row = connection.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM deferred_emails WHERE ledger_key = ?", (key,)
+        ).fetchone()
+    return dict(zip(COLUMNS, row)) if row is not None else None
+
+
+def is_due(deferral):
+    return deferral['retry_at'] <= time.time()
+
+
+def defer(key, account, message_id, reason):
+    """
+    Park an email, or park it again after a check that found it still waiting.
+
+    Returns:
+        bool: True if the email was parked, False if it has been waiting for longer than DEFER_MAX_AGE
+    """
+    connection = _get_connection()
+    now = time.time()
+    with ledger._lock:
+        row = connection.execute(
+            "SELECT checks, first_deferred_at FROM deferred_emails WHERE ledger_key = ?", (key,)
+        ).fetchone()
+        checks, first_deferred_at = row if row is not None else (0, now)
+        if now - first_deferred_at > DEFER_MAX_AGE:
+            metrics.increment("emails_deferred_total", result="expired")
+            return False
+
+        delay = min(DEFER_INITIAL_DELAY * 2 ** checks, DEFER_MAX_DELAY)
+        connection.execute(
+            """
+            INSERT INTO deferred_emails (ledger_key, account, message_id, reason, checks, first_deferred_at, retry_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(ledger_key) DO UPDATE SET
+                reason = excluded.reason, checks = excluded.checks, retry_at = excluded.retry_at
+            """,
+            (key, account, message_id, str(reason), checks + 1, first_deferred_at, now + delay)
+        )
+    print(f"Parked {key} for {delay} s: {reason}")
+    metrics.increment("emails_deferred_total", result="parked" if checks == 0 else "still_waiting")
+    return True
+
+
+def clear(key):
+    """Unpark an email, it is processed normally from now on."""
+    connection = _get_connection()
+    with ledger._lock:
+        connection.execute("DELETE FROM deferred_emails WHERE ledger_key = ?", (key,))
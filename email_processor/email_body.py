@@ -0,0 +1,202 @@
+import re
+import html2text
+
+# selectolax (lexbor backend) is optional, without it the HTML is converted with html2text
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+# ELEMENTS THAT START A NEW LINE IN THE TEXT
+BLOCK_TAGS = 'br, p, div, tr, li, table, hr, blockquote, h1, h2, h3, h4, h5, h6'
+
+# ELEMENTS THAT ARE NEVER PART OF THE TEXT
+IGNORED_TAGS = 'head, title, style, script'
+
+# ELEMENTS THAT START THE QUOTED HISTORY BELOW THE LATEST REPLY (OUTLOOK, OUTLOOK MOBILE, GMAIL, THUNDERBIRD, APPLE MAIL)
+QUOTE_SELECTORS = ('#appendonsend, #divRplyFwdMsg, #mail-editor-reference-message-container, div.gmail_quote, '
+                   'div.moz-cite-prefix, blockquote[type="cite"]')
+
+# PLAIN TEXT SEPARATORS OF THE QUOTED HISTORY
+# ("From:" followed by "Sent:"/"Date:" on the next line, "-----Original Message-----", "On <date>, <name> wrote:")
+QUOTE_SEPARATOR_PATTERN = re.compile(
+    r'^[ \t>*_]*(?:from|van|von|de)[*_]*:.*\n[ \t>*_]*(?:sent|date|gesendet|verzonden|envoyé)[*_]*:'
+    r'|^[ \t>]*-{2,} ?(?:original message|forwarded message) ?-{2,}'
+    r'|^[ \t>]*on .{1,200} wrote:[ \t]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# START OF A DISCLAIMER OR CONFIDENTIALITY NOTICE, EVERYTHING FROM HERE ON IS DROPPED
+DISCLAIMER_PATTERN = re.compile(
+    r'^[ \t*_]*(?:disclaimer\b|confidentiality notice|this (?:e-?mail|message)(?: and any (?:files|attachments))?(?: transmitted with it)? '
+    r'(?:is|are|may be) (?:confidential|intended|privileged)|the information (?:contained )?in this (?:e-?mail|message))',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# SIGN-OFF LINE THAT STARTS A SIGNATURE BLOCK
+SIGN_OFF_PATTERN = re.compile(
+    r'^[ \t*_]*(?:kind regards|best regards|warm regards|regards|thanks and regards|thank you and regards|many thanks|'
+    r'yours sincerely|sent from my \w+)[,.!]?[ \t*_]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# A SIGN-OFF IS ONLY TREATED AS A SIGNATURE WHEN AT MOST THIS MANY LINES FOLLOW IT
+SIGNATURE_MAX_LINES = 10
+
+# SUBJECT PREFIX OF A FORWARDED EMAIL, THE FORWARDED MESSAGE IS KEPT BELOW THE LATEST ONE
+FORWARD_SUBJECT_PATTERN = re.compile(r'^\s*(?:fw|fwd)\s*:', re.IGNORECASE)
+
+WHITESPACE_PATTERN = re.compile(r'[ \t\xa0\u200b]+')
+
+# Private use characters that mark the line breaks of block elements and the start of the quoted history while
+# the text is extracted
+_LINE_BREAK = '\ue000'
+_QUOTE_START = '\ue001'
+
+
+def _remove_from(node):
+    """Remove the node and everything that follows it in the document."""
+    current = node
+    while current is not None and current.tag not in ('body', 'html'):
+        sibling = current.next
+        while sibling is not None:
+            following = sibling.next
+            sibling.decompose()
+            sibling = following
+        current = current.parent
+    node.decompose()
+
+
+def _normalise_whitespace(text):
+    """Collapse runs of spaces and of empty lines, and strip every line."""
+    lines = []
+    for line in text.splitlines():
+        line = WHITESPACE_PATTERN.sub(' ', line).strip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    return "\n".join(lines).strip()
+
+
+def html_to_text(html, full_trail=False):
+    """
+    Convert an HTML body to plain text.
+
+    Args:
+        html (str): HTML content of the body
+        full_trail (bool): Keep the quoted history below the latest reply
+
+    Returns:
+        str: Plain text with one line per block element
+    """
+    latest, trail = html_to_texts(html)
+    return trail if full_trail else latest
+
+
+def html_to_texts(html):
+    """
+    Convert an HTML body to plain text once, with and without the quoted history below the latest reply.
+
+    Returns:
+        tuple: (text up to the first quoted message, text of the whole thread), one line per block element
+    """
+    if LexborHTMLParser is None:
+        text = html2text.html2text(html)
+        return text, text
+
+    tree = LexborHTMLParser(html)
+    body = tree.body
+    if body is None:
+        return "", ""
+
+    for node in tree.css(IGNORED_TAGS):
+        node.decompose()
+
+    # Everything after the first quote element in document order is the quoted history
+    quote = body.css_first(QUOTE_SELECTORS)
+    if quote is not None:
+        quote.insert_before(_QUOTE_START)
+
+    # Line breaks in the HTML source are plain whitespace, only block elements start a new line
+    for node in body.css(BLOCK_TAGS):
+        node.insert_after(_LINE_BREAK)
+    for node in body.css('td, th'):
+        node.insert_after(' ')
+
+    text = body.text(deep=True).replace('\r', ' ').replace('\n', ' ').replace(_LINE_BREAK, '\n')
+    latest, _, quoted = text.partition(_QUOTE_START)
+    return _normalise_whitespace(latest), _normalise_whitespace(latest + quoted)
+
+
+def strip_signature(text):
+    """Drop the disclaimer and the signature block that follows the last sign-off line of a message."""
+    match = DISCLAIMER_PATTERN.search(text)
+    if match:
+        text = text[:match.start()].rstrip()
+
+    sign_offs = list(SIGN_OFF_PATTERN.finditer(text))
+    if sign_offs:
+        start = sign_offs[-1].start()
+        if len([line for line in text[start:].splitlines() if line.strip()]) <= SIGNATURE_MAX_LINES + 1:
+            text = text[:start].rstrip()
+    return text
+
+
+def latest_messages(text, keep_quoted=0):
+    """
+    Split the text at the separators of the quoted history and keep the latest message.
+
+    Args:
+        text (str): Plain text body
+        keep_quoted (int): Number of quoted messages kept below the latest one (with their From/Sent header)
+
+    Returns:
+        str: The kept messages, each without its disclaimer and signature
+    """
+    bounds = [0] + [match.start() for match in QUOTE_SEPARATOR_PATTERN.finditer(text)] + [len(text)]
+    messages = [strip_signature(text[start:end].strip()) for start, end in zip(bounds[:keep_quoted + 1], bounds[1:])]
+    return "\n\n".join(message for message in messages if message)
+
+
+def extract_body_text(content, content_type, full_trail=False, keep_quoted=0):
+    """
+    Return the text of an email body.
+
+    By default only the latest message is kept: the quoted history of replies and forwards,
+    disclaimers and the signature are removed. Pass full_trail=True for the complete text.
+
+    Args:
+        content (str): Body content
+        content_type (str): 'html' or 'text'
+        full_trail (bool): Keep the quoted history, disclaimers and signatures
+        keep_quoted (int): Number of quoted messages kept below the latest one, e.g. 1 for a forwarded email
+    """
+    if content_type == 'html':
+        # The HTML can only be cut at the first quote, deeper messages are split in the text
+        text = html_to_text(content, full_trail=full_trail or keep_quoted > 0)
+    elif content_type == 'text':
+        text = content
+    else:
+        return ''
+
+    if full_trail:
+        return text
+    return latest_messages(text, keep_quoted)
+
+
+def extract_body_texts(content, content_type, keep_quoted=0):
+    """
+    Return the text of extract_body_text and the text of the whole thread, parsing the body only once.
+
+    Returns:
+        tuple: (latest message text, full trail text)
+    """
+    if content_type == 'html':
+        latest, trail = html_to_texts(content)
+        # The HTML can only be cut at the first quote, deeper messages are split in the text
+        text = trail if keep_quoted > 0 else latest
+    elif content_type == 'text':
+        text = trail = content
+    else:
+        return '', ''
+
+    return latest_messages(text, keep_quoted), trail
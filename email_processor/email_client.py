@@ -2,17 +2,28 @@ import aiohttp
 import asyncio
 import datetime
 import time
-from msal import ConfidentialClientApplication
-from config import MS_CLIENT_ID, TENANT_ID, MS_CLIENT_SECRET, AUTHORITY, SCOPE
+from config import MS_CLIENT_ID, TENANT_ID, MS_CLIENT_SECRET, AUTHORITY, SCOPE, FORWARD_MODE, FETCH_MAX_MESSAGES
 from email_processor.email_utils import create_email_details
+import metrics
+import breakers
+
+# NAME OF THE PLACEHOLDER ATTACHMENT DEFENDER SAFE ATTACHMENTS PUTS ON AN EMAIL WHILE IT SCANS THE ATTACHMENTS
+SAFE_ATTACHMENTS_PLACEHOLDER = "Safe Attachments Scan In Progress"
+
+# MAPI PROPERTY WITH THE SIZE OF A MESSAGE (PR_MESSAGE_SIZE), GRAPH ONLY RETURNS IT AS AN EXTENDED PROPERTY
+MESSAGE_SIZE_PROPERTY = "Long 0x0E08"
+# NUMBER OF MESSAGES PER PAGE WHEN LISTING THE UNREAD EMAILS
+FETCH_PAGE_SIZE = 50
 
 async def get_access_token():
+    from msal import ConfidentialClientApplication
     app = ConfidentialClientApplication(
         MS_CLIENT_ID,
         authority=AUTHORITY,
         client_credential=MS_CLIENT_SECRET,
     )
-    result = await asyncio.to_thread(app.acquire_token_for_client, scopes=SCOPE)
+    with metrics.span("graph_token"):
+        result = await asyncio.to_thread(app.acquire_token_for_client, scopes=SCOPE)
     if 'access_token' in result:
         return result['access_token']
     else:
@@ -21,27 +32,74 @@ async def get_access_token():
         print(result.get('error_description'))
         return None
 
-async def fetch_unread_emails(access_token, user_id):
+async def fetch_unread_messages(access_token, user_id):
+    """
+    Fetch the raw unread Graph messages for a mailbox without downloading or analysing any attachments.
+    The pages of the result are followed up to FETCH_MAX_MESSAGES messages, so a backlog is seen as a whole.
+    Every message carries its size (PR_MESSAGE_SIZE) in singleValueExtendedProperties, see message_size().
+    """
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
     }
 
-    endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages?$filter=isRead eq false'
+    endpoint = (f'https://graph.microsoft.com/v1.0/users/{user_id}/messages?$filter=isRead eq false&$top={FETCH_PAGE_SIZE}'
+                f"&$expand=singleValueExtendedProperties($filter=id eq '{MESSAGE_SIZE_PROPERTY}')")
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(endpoint, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                messages = data.get('value', [])
-                email_details_list = [
-                    (await create_email_details(access_token, user_id, msg), msg['id']) for msg in messages
-                ]
-                return email_details_list
-            else:
-                print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: fetch_unread_emails - Failed to retrieve messages for user {user_id}: {response.status}")
-                print(await response.text())
-                return []
+    messages = []
+    with metrics.span("graph_fetch"), breakers.guard(breakers.GRAPH) as call:
+        async with aiohttp.ClientSession() as session:
+            while endpoint and len(messages) < FETCH_MAX_MESSAGES:
+                async with session.get(endpoint, headers=headers) as response:
+                    if breakers.is_failure_status(response.status):
+                        call.fail()
+                    if response.status == 200:
+                        data = await response.json()
+                        messages.extend(data.get('value', []))
+                        endpoint = data.get('@odata.nextLink')
+                    else:
+                        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: fetch_unread_messages - Failed to retrieve messages for user {user_id}: {response.status}")
+                        print(await response.text())
+                        break
+    return messages[:FETCH_MAX_MESSAGES]
+
+def message_size(msg):
+    """Return the size in bytes of a message fetched by fetch_unread_messages, None if it is not known."""
+    for prop in msg.get('singleValueExtendedProperties') or []:
+        if prop.get('id', '').lower() == MESSAGE_SIZE_PROPERTY.lower():
+            try:
+                return int(prop.get('value'))
+            except (TypeError, ValueError):
+                return None
+    return None
+
+async def fetch_message(access_token, user_id, message_id):
+    """Fetch a single raw Graph message by its id, returns None if it could not be retrieved."""
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json',
+    }
+
+    endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}'
+    
+    with metrics.span("graph_fetch_message"), breakers.guard(breakers.GRAPH) as call:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(endpoint, headers=headers) as response:
+                if breakers.is_failure_status(response.status):
+                    call.fail()
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: fetch_message - Failed to retrieve message {message_id} for user {user_id}: {response.status}")
+                    print(await response.text())
+                    return None
+
+async def fetch_unread_emails(access_token, user_id):
+    messages = await fetch_unread_messages(access_token, user_id)
+    email_details_list = [
+        (await create_email_details(access_token, user_id, msg), msg['id']) for msg in messages
+    ]
+    return email_details_list
             
 async def mark_email_as_read(access_token: str, user_id: str, message_id: str, max_retries: int = 3) -> bool:
     headers = {
@@ -55,14 +113,21 @@ async def mark_email_as_read(access_token: str, user_id: str, message_id: str, m
     
     for attempt in range(max_retries):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.patch(endpoint, headers=headers, json=body) as response:
-                    if response.status == 200:
-                        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: mark_email_as_read - Marked message {message_id} as read.")
-                        return True
-                    else:
-                        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: mark_email_as_read - Failed to mark message {message_id} as read: {response.status}")
-                        print(await response.text())
+            with metrics.span("graph_mark_read"), breakers.guard(breakers.GRAPH) as call:
+                async with aiohttp.ClientSession() as session:
+                    async with session.patch(endpoint, headers=headers, json=body) as response:
+                        if breakers.is_failure_status(response.status):
+                            call.fail()
+                        if response.status == 200:
+                            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: mark_email_as_read - Marked message {message_id} as read.")
+                            return True
+                        else:
+                            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: mark_email_as_read - Failed to mark message {message_id} as read: {response.status}")
+                            print(await response.text())
+        except breakers.CircuitOpenError as e:
+            # Graph is unavailable, the email is marked as read in a later cycle instead of retrying now
+            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: mark_email_as_read - Not marking message {message_id} as read: {str(e)}")
+            return False
         except Exception as e:
             print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: mark_email_as_read - Error marking message {message_id} as read: {str(e)}")
         
@@ -78,175 +143,159 @@ async def force_mark_emails_as_read(access_token: str, user_id: str, message_ids
         results[message_id] = success
     return results
 
+def _log(function, message):
+    print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: {function} - {message}")
+
+def _recipients(addresses):
+    return [{"emailAddress": {"address": address}} for address in addresses if address]
+
+def forward_recipients(original_sender, forward_to, email_data):
+    """The recipient fields of the forward: the forward address, the CCs of the original email and a reply-to of the original sender."""
+    # Format CC recipients from comma-separated string
+    cc_list = [email.strip() for email in (email_data.get('cc') or '').split(',') if email.strip()]
+    return {
+        "toRecipients": _recipients([forward_to]),
+        "ccRecipients": _recipients(cc_list),
+        "replyTo": _recipients([original_sender]),
+    }
+
+def scan_in_progress(attachments):
+    """Return True if the attachment metadata still has the Safe Attachments placeholder instead of the attachments."""
+    return any(attachment.get('name') == SAFE_ATTACHMENTS_PLACEHOLDER for attachment in attachments)
+
+async def safe_attachments_scan_in_progress(session, headers, user_id, message_id, email_data):
+    """
+    Check whether Defender Safe Attachments still holds the attachments of the email back.
+    Uses the attachment metadata create_email_details already fetched, the attachments are only
+    fetched again for email data that has none (e.g. checkpoints of older versions).
+    """
+    attachments = email_data.get('attachment_metadata')
+    if attachments is None:
+        endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/attachments?$select=name'
+        with breakers.guard(breakers.GRAPH) as call:
+            async with session.get(endpoint, headers=headers) as response:
+                if breakers.is_failure_status(response.status):
+                    call.fail()
+                if response.status != 200:
+                    _log("forward_email", f"Failed to get attachments: {response.status}")
+                    print(await response.text())
+                    return True
+                attachments = (await response.json()).get('value', [])
+    return scan_in_progress(attachments)
+
+async def forward_one_shot(session, headers, user_id, message_id, recipients, comment):
+    """
+    Forward with Graph's /forward action: recipients, reply-to and comment in a single call.
+
+    Returns:
+        int: HTTP status of the call, 202 when the email was forwarded
+    """
+    endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/forward'
+    body = {
+        "comment": comment,
+        "message": recipients,
+    }
+    with breakers.guard(breakers.GRAPH) as call:
+        async with session.post(endpoint, headers=headers, json=body) as response:
+            if breakers.is_failure_status(response.status):
+                call.fail()
+            if response.status != 202:
+                _log("forward_one_shot", f"Failed to forward: {response.status}")
+                print(await response.text())
+            return response.status
+
+async def forward_with_draft(session, headers, user_id, message_id, recipients, comment):
+    """Forward by creating a forward draft, setting its recipients and body and sending it (three calls)."""
+    with breakers.guard(breakers.GRAPH) as call:
+        # CREATE THE FORWARD EMAIL DRAFT
+        create_forward_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/createForward'
+        async with session.post(create_forward_endpoint, headers=headers, json={"comment": comment}) as create_response:
+            if breakers.is_failure_status(create_response.status):
+                call.fail()
+            if create_response.status != 201:
+                _log("forward_with_draft", f"Failed to create forward: {create_response.status}")
+                print(await create_response.text())
+                return False
+            forward_message = await create_response.json()
+            forward_id = forward_message['id']
+
+        # UPDATE THE FORWARD EMAIL WITH CUSTOMER HEADER
+        update_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{forward_id}'
+        update_body = dict(recipients)
+        update_body["body"] = {
+            "contentType": forward_message['body']['contentType'],
+            "content": f"{forward_message['body']['content']}"
+        }
+        async with session.patch(update_endpoint, headers=headers, json=update_body) as update_response:
+            if breakers.is_failure_status(update_response.status):
+                call.fail()
+            if update_response.status != 200:
+                _log("forward_with_draft", f"Failed to update forward: {update_response.status}")
+                print(await update_response.text())
+                return False
+
+        # FORWARD THE EMAIL
+        send_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{forward_id}/send'
+        async with session.post(send_endpoint, headers=headers) as send_response:
+            if breakers.is_failure_status(send_response.status):
+                call.fail()
+            if send_response.status != 202:
+                _log("forward_with_draft", f"Failed to send forward: {send_response.status}")
+                print(await send_response.text())
+                return False
+            return True
+
 async def forward_email(access_token, user_id, message_id, original_sender, forward_to, email_data, forwardMsg=""):
-    
+    """
+    Forward an email to forward_to, keeping its CCs and with a reply-to of the original sender.
+
+    The message and attachment details are taken from email_data (as returned by create_email_details)
+    instead of being fetched again. With FORWARD_MODE "one_shot" the email is forwarded with a single
+    Graph call, the draft flow (create, update, send) is used with FORWARD_MODE "draft" or when the
+    one-shot forward is rejected.
+
+    Returns:
+        bool: True if the email was forwarded, False otherwise (also while the Safe Attachments scan is in progress).
+              breakers.CircuitOpenError is raised while the Graph circuit breaker is open.
+    """
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': "application/json; odata.metadata=minimal; odata.streaming=true; IEEE754Compatible=false; charset=utf-8",
     }
+    email_data = email_data or {}
     
     async with aiohttp.ClientSession() as session:
-        
         try:
-            
-            # GATHER EMAIL DETAILS TO CHECK IF EMAIL HAS ATTACHMENTS
-            email_details_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/'
-            
-            async with session.get(email_details_endpoint , headers=headers) as get_response:
-                if get_response.status != 200:
-                    print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Failed to get original message: {get_response.status}")
-                    print(await get_response.text())
-                
-                original_message = await get_response.json()
-                
-                # Format CC recipients from comma-separated string
-                cc_recipients = []
-                if email_data.get('cc'):
-                    # Split the CC string and remove any whitespace
-                    cc_list = [email.strip() for email in email_data['cc'].split(',') if email.strip()]
-                    # Create properly formatted recipient objects for each CC
-                    cc_recipients = [
-                        {
-                            "emailAddress": {
-                                "address": cc
-                            }
-                        } for cc in cc_list if cc  # Additional check to ensure no empty emails
-                    ]
-                 
-                # CHECK IF EMAIL HAS ATTACHMENTS               
-                if original_message.get('hasAttachments') == True: # CHECK THF ATTACHMENT STATUS IF EMAIL HAS ATTACHMENTS
-                    
-                    get_attachments_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/attachments'
-                    async with session.get(get_attachments_endpoint, headers=headers) as get_attachments_response:
-                        
-                        get_attachments_data = await get_attachments_response.json() 
-                        
-                        if get_attachments_data.get('value')[0]['name'] == "Safe Attachments Scan In Progress":
-                            return False 
-                        
-                        else:  # FORWARD EMAIL IF NOT ATTACHMENTS
-
-                            # CREATE THE FORWARD EMAIL DRAFT
-                            create_forward_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/createForward'
-                            async with session.post(create_forward_endpoint, headers=headers) as create_response:
-                                if create_response.status != 201:
-                                    print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Failed to create forward: {create_response.status}")
-                                    print(await create_response.text())
-                                    return False
-                                
-                                forward_message = await create_response.json()
-                                forward_id = forward_message['id']
-
-                            # UPDATE THE FORWARD EMAIL WITH CUSTOMER HEADER
-                            update_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{forward_id}'
-                            update_body = {
-                                # "sender": [
-                                #     {
-                                #         "emailAddress": {
-                                #             "address": original_sender
-                                #         }
-                                #     }
-                                # ],
-                                "toRecipients": [
-                                    {
-                                        "emailAddress": {
-                                            "address": forward_to
-                                        }
-                                    }
-                                ],
-                                "ccRecipients": cc_recipients if cc_recipients else [],
-                                "replyTo": [
-                                    {
-                                        "emailAddress": {
-                                            "address": original_sender
-                                        }
-                                    }
-                                ],
-                                "body": {
-                                    "contentType": forward_message['body']['contentType'],
-                                    "content": f"{forward_message['body']['content']}"
-                                }
-                            }
-
-                            async with session.patch(update_endpoint, headers=headers, json=update_body) as update_response:
-                                if update_response.status != 200:
-                                    print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Failed to update forward: {update_response.status}")
-                                    print(await update_response.text())
-                                    return False
-
-                            # FORWARD THE EMAIL
-                            send_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{forward_id}/send'
-                            async with session.post(send_endpoint, headers=headers) as send_response:
-                                if send_response.status != 202:
-                                    print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Failed to send forward: {send_response.status}")
-                                    print(await send_response.text())
-                                    return False
-                                
-                                print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Successfully forwarded message to {forward_to} with reply-to set to {original_sender}")
-                                return True
+            # AN EMAIL WITH ATTACHMENTS IS NOT FORWARDED WHILE THE SAFE ATTACHMENTS SCAN IS IN PROGRESS
+            if await safe_attachments_scan_in_progress(session, headers, user_id, message_id, email_data):
+                _log("forward_email", f"Safe Attachments scan in progress for message {message_id}, not forwarded")
+                metrics.increment("forward_total", mode="none", result="scan_in_progress")
+                return False
 
-                else: # FORWARD THE EMAIL IF NO ATTACHMENTS PRESENT          
-                    
-                    # CREATE THE FORWARD EMAIL DRAFT
-                    create_forward_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/createForward'
-                    async with session.post(create_forward_endpoint, headers=headers) as create_response:
-                        if create_response.status != 201:
-                            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Failed to create forward: {create_response.status}")
-                            print(await create_response.text())
-                            return False
-                        forward_message = await create_response.json()
-                        forward_id = forward_message['id']
+            recipients = forward_recipients(original_sender, forward_to, email_data)
 
-                    # UPDATE THE FORWARD EMAIL WITH CUSTOMER HEADER
-                    update_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{forward_id}'
-                    update_body = {
-                        # "sender": [
-                        #     {
-                        #         "emailAddress": {
-                        #             "address": original_sender
-                        #         }
-                        #     }
-                        # ],
-                        "toRecipients": [
-                            {
-                                "emailAddress": {
-                                    "address": forward_to
-                                }
-                            }
-                        ],
-                        "ccRecipients": cc_recipients if cc_recipients else [],
-                        "replyTo": [
-                            {
-                                "emailAddress": {
-                                    "address": original_sender
-                                }
-                            }
-                        ],
-                        "body": {
-                            "contentType": forward_message['body']['contentType'],
-                            "content": f"{forward_message['body']['content']}"
-                        }
-                    }
+            forwarded = False
+            mode = FORWARD_MODE
+            if mode == 'one_shot':
+                status = await forward_one_shot(session, headers, user_id, message_id, recipients, forwardMsg)
+                forwarded = status == 202
+                # Only a rejected request (4xx) falls back to the draft flow, after a server error the
+                # email may have been sent and the stage is retried with the next attempt instead
+                if 400 <= status < 500:
+                    mode = 'draft'
+            if mode != 'one_shot':
+                forwarded = await forward_with_draft(session, headers, user_id, message_id, recipients, forwardMsg)
 
-                    async with session.patch(update_endpoint, headers=headers, json=update_body) as update_response:
-                        if update_response.status != 200:
-                            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Failed to update forward: {update_response.status}")
-                            print(await update_response.text())
-                            return False
+            metrics.increment("forward_total", mode=mode, result="success" if forwarded else "failed")
+            if forwarded:
+                _log("forward_email", f"Successfully forwarded message to {forward_to} with reply-to set to {original_sender}")
+            return forwarded
 
-                   # FORWARD THE EMAIL
-                    send_endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{forward_id}/send'
-                    async with session.post(send_endpoint, headers=headers) as send_response:
-                        if send_response.status != 202:
-                            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Failed to send forward: {send_response.status}")
-                            print(await send_response.text())
-                            return False
-                        
-                        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - Successfully forwarded message to {forward_to} with reply-to set to {original_sender}")
-                        return True
-                        
+        except breakers.CircuitOpenError:
+            # Graph is unavailable, the caller parks the email instead of counting a failed attempt
+            raise
         except Exception as e:
-            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: email_client.py - Function: forward_email - An error occurred: {str(e)}")
+            _log("forward_email", f"An error occurred: {str(e)}")
             return False
                 
 # Keeping the synchronous version for compatibility with existing code
@@ -260,4 +309,4 @@ def fetch_unread_emails_sync(access_token, user_id):
 #     asyncio.run(mark_as_read(access_token, user_id, message_id) if isRead else mark_as_unread(access_token, user_id, message_id))
 
 def forward_email_sync(access_token, user_id, message_id, original_sender, forward_to, forwardMsg="Forwarded message"):
-    asyncio.run(forward_email(access_token, user_id, message_id, original_sender, forward_to, forwardMsg))
\ No newline at end of file
+    asyncio.run(forward_email(access_token, user_id, message_id, original_sender, forward_to, None, forwardMsg))
\ No newline at end of file
@@ -0,0 +1,117 @@
+import json
+
+
+class EmailContext:
+    """
+    Compact, read-only view of an email that is passed to every model call.
+
+    Only the fields the prompts need are kept (metadata, body text and the extracted text per attachment),
+    so the raw attachment content and the per-page OCR output can be released once the context is built.
+    The prompt text is rendered once, on first use, and reused by every model call: formatting the context
+    in an f-string (f"... {context}") returns the memoized JSON.
+
+    The body text is the latest message only. The text of the whole thread (trail_text, empty when the body
+    had no quoted history) is not sent with the prompts, see with_full_trail().
+    """
+
+    __slots__ = ('sender', 'to', 'cc', 'subject', 'date_received', 'body_text', 'trail_text', 'attachments', '_prompt_text')
+
+    def __init__(self, sender='', to='', cc='', subject='', date_received='', body_text='', attachments=(), trail_text=''):
+        self.sender = sender
+        self.to = to
+        self.cc = cc
+        self.subject = subject
+        self.date_received = date_received
+        self.body_text = body_text
+        self.trail_text = trail_text
+        # Tuple of dicts with name, type, index and either content (+ page_count, has_handwritten_content) or error
+        self.attachments = tuple(attachments)
+        self._prompt_text = None
+
+    @classmethod
+    def from_email_data(cls, email_data):
+        """Build the context from the dict returned by create_email_details."""
+        attachments = []
+        for i, attachment in enumerate(email_data.get('processed_attachments', []), 1):
+            attachment_data = {
+                "name": attachment.get('name', ''),
+                "type": attachment.get('content_type', ''),
+                "index": i
+            }
+
+            # Add analysis results if available
+            analysis_result = attachment.get('analysis_result', {})
+            if analysis_result and "error" not in analysis_result:
+                attachment_data["content"] = analysis_result.get("full_text", "")
+                attachment_data["page_count"] = analysis_result.get("page_count", 1)
+                attachment_data["has_handwritten_content"] = analysis_result.get("has_handwritten_content", False)
+            else:
+                attachment_data["content"] = ""
+                attachment_data["error"] = analysis_result.get("error", "Unknown error during text extraction")
+
+            attachments.append(attachment_data)
+
+        return cls(
+            sender=email_data.get('from', ''),
+            to=email_data.get('to', ''),
+            cc=email_data.get('cc', ''),
+            subject=email_data.get('subject', ''),
+            date_received=email_data.get('date_received', ''),
+            body_text=email_data.get('body_text', ''),
+            attachments=attachments,
+            trail_text=email_data.get('body_trail_text', ''),
+        )
+
+    def to_dict(self, include_trail=False):
+        """
+        Return the structure sent to the models. With include_trail the text of the whole thread is added
+        under "email_trail" (used to checkpoint the context).
+        """
+        data = {
+            "email_metadata": {
+                "from": self.sender,
+                "to": self.to,
+                "cc": self.cc,
+                "subject": self.subject,
+                "date_received": self.date_received
+            },
+            "email_body": self.body_text,
+            "attachments": list(self.attachments)
+        }
+        if include_trail and self.trail_text:
+            data["email_trail"] = self.trail_text
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a context from to_dict() output."""
+        metadata = data.get("email_metadata", {})
+        return cls(
+            sender=metadata.get('from', ''),
+            to=metadata.get('to', ''),
+            cc=metadata.get('cc', ''),
+            subject=metadata.get('subject', ''),
+            date_received=metadata.get('date_received', ''),
+            body_text=data.get("email_body", ''),
+            attachments=data.get("attachments", []),
+            trail_text=data.get("email_trail", ''),
+        )
+
+    def with_full_trail(self):
+        """Return a copy of the context whose body is the text of the whole thread, None if nothing was quoted."""
+        if not self.trail_text:
+            return None
+        return EmailContext(self.sender, self.to, self.cc, self.subject, self.date_received, self.trail_text, self.attachments)
+
+    @property
+    def prompt_text(self):
+        """Compact JSON of the context, rendered on first use."""
+        if self._prompt_text is None:
+            self._prompt_text = json.dumps(self.to_dict(), separators=(',', ':'))
+        return self._prompt_text
+
+    def __str__(self):
+        return self.prompt_text
+
+    def __format__(self, format_spec):
+        return format(self.prompt_text, format_spec)
@@ -1,79 +1,125 @@
-import html2text
 import aiohttp
 import base64
 import os
+import re
 import json
-import tempfile
 import asyncio
+import threading
 from io import BytesIO
 from pathlib import Path
 
-# For Azure AI Document Intelligence
-from azure.core.credentials import AzureKeyCredential
-# Import the correct Document Intelligence client
-from azure.core.credentials import AzureKeyCredential
-try:
-    # Try newer SDK structure
-    from azure.ai.documentintelligence import DocumentIntelligenceClient
-    from azure.ai.formrecognizer import DocumentAnalysisClient
-except ImportError:
-    # Fall back to older SDK structure
-    from azure.ai.formrecognizer import DocumentAnalysisClient
-    # Define alias for compatibility
-    DocumentIntelligenceClient = DocumentAnalysisClient
-from azure.core.exceptions import HttpResponseError
+from ledger import hash_attachment, ledger_key, get_attachment_analysis, save_attachment_analysis
+from email_processor.email_context import EmailContext
+from email_processor.email_body import extract_body_texts, FORWARD_SUBJECT_PATTERN
+from email_processor.image_info import is_image, get_image_size
+from email_processor.pdf_text import read_text_layer, split_pdf, count_pages, format_page_ranges
+import metrics
+import breakers
+import signature_images
+from executor import run_cpu
+from extraction_templates import available_tempates
+from config import (MAX_ATTACHMENT_BYTES, LOCAL_PDF_TEXT_LAYER, PDF_TEXT_LAYER_MIN_CHARS, PAGE_SELECTION_MIN_PAGES,
+                    PAGE_SELECTION_MAX_OCR_PAGES, CERTIFICATE_PAGE_KEYWORDS, DI_CHUNK_PAGES, DI_MAX_CONCURRENCY,
+                    MIN_IMAGE_ATTACHMENT_BYTES, MIN_IMAGE_DIMENSION, SIGNATURE_IMAGE_MAX_BYTES)
+
+# ATTACHMENT PROPERTIES FETCHED WHEN LISTING THE ATTACHMENTS OF A MESSAGE
+ATTACHMENT_METADATA_FIELDS = 'id,name,contentType,size,isInline'
+FILE_ATTACHMENT_TYPE = '#microsoft.graph.fileAttachment'
+INLINE_ATTACHMENT = "Inline attachment"
+SMALL_IMAGE = "Image too small to hold certificate data"
+SIGNATURE_IMAGE = "Known signature image"
+
+# ATTACHMENTS SKIPPED FOR THESE REASONS (LOGOS, ICONS, SIGNATURE IMAGES) ARE LEFT OUT OF THE CONTEXT ENTIRELY
+OMITTED_ATTACHMENT_REASONS = (INLINE_ATTACHMENT, SMALL_IMAGE, SIGNATURE_IMAGE)
+
+# PAGES OF LONG DOCUMENTS ARE KEPT WHEN THEY MENTION ONE OF THE KEYWORDS OR A TRACKING COMPANY
+PAGE_KEYWORD_PATTERN = re.compile(
+    r'\b(' + '|'.join(re.escape(keyword) for keyword in list(CERTIFICATE_PAGE_KEYWORDS) + available_tempates) + r')\b',
+    re.IGNORECASE
+)
 
 # EXTRACT BODY FROM EMAIL
-def get_email_body(msg):
-    """Extract the body from the raw email message."""
+def get_email_body(msg, full_trail=False):
+    """
+    Extract the body from the raw email message.
+    
+    The text holds the latest message only (plus the forwarded message of a forward), without the
+    quoted history, disclaimers and signatures. Pass full_trail=True for the text of the whole thread.
+    
+    'trail_text' holds the text of the whole thread when the quoted history was removed from 'text'
+    (empty otherwise), for the values that may only be found further down the trail.
+    """
     if 'body' in msg:
         body_content = msg['body']
         content_type = body_content.get('contentType', 'text')
         content = body_content.get('content', '')
+        keep_quoted = 1 if FORWARD_SUBJECT_PATTERN.match(msg.get('subject') or '') else 0
 
-        if content_type == 'html':
-            plain_text_content = html2text.html2text(content)
-            return {'html': content, 'text': plain_text_content}
-        elif content_type == 'text':
-            return {'html': '', 'text': content}
-        else:
-            return {'html': '', 'text': ''}
+        if content_type not in ('html', 'text'):
+            return {'html': '', 'text': '', 'trail_text': ''}
+        
+        # Both texts come from a single parse of the body
+        plain_text_content, trail_text = extract_body_texts(content, content_type, keep_quoted=keep_quoted)
+        if full_trail:
+            plain_text_content, trail_text = trail_text, ''
+        return {
+            'html': content if content_type == 'html' else '',
+            'text': plain_text_content,
+            'trail_text': trail_text if trail_text != plain_text_content else ''
+        }
         
-    return {'html': '', 'text': ''}
+    return {'html': '', 'text': '', 'trail_text': ''}
+
+# THE DOCUMENT INTELLIGENCE SDK IS IMPORTED WHEN THE CLIENT IS FIRST CREATED, THE CLIENT IS SHARED BY ALL ANALYSES
+_document_client = None
+_document_client_lock = threading.Lock()
 
-async def extract_text_with_document_intelligence(attachment_content, attachment_name):
+def get_document_client():
+    """Create (once) the Document Intelligence client, None if the endpoint or key is not configured."""
+    global _document_client
+    endpoint = os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
+    api_key = os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_KEY")
+    if not endpoint or not api_key:
+        return None
+    if _document_client is None:
+        with _document_client_lock:
+            if _document_client is None:
+                from azure.core.credentials import AzureKeyCredential
+                from azure.ai.formrecognizer import DocumentAnalysisClient
+                _document_client = DocumentAnalysisClient(
+                    endpoint=endpoint,
+                    credential=AzureKeyCredential(api_key)
+                )
+    return _document_client
+
+async def extract_text_with_document_intelligence(attachment_content, attachment_name, pages=None):
     """
     Extract text from PDF or image using Azure Document Intelligence.
     
     Args:
-        attachment_content: Base64 encoded content of the attachment
+        attachment_content: Raw bytes of the attachment (base64 encoded contentBytes are still accepted)
         attachment_name: Name of the attachment
+        pages: Optional page ranges to analyse (e.g. "1-3,5"), defaults to all pages
     
     Returns:
         dict: Dictionary containing extracted text and error message if any
     """
-    # Get configuration for Document Intelligence
-    endpoint = os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
-    api_key = os.environ.get("AZURE_DOCUMENT_INTELLIGENCE_KEY")
-    
-    if not endpoint or not api_key:
-        return {
-            "error": "Document Intelligence service not properly configured",
-            "text": ""
-        }
-    
     # Initialize the Document Intelligence client
     try:
-        document_client = DocumentAnalysisClient(
-            endpoint=endpoint, 
-            credential=AzureKeyCredential(api_key)
-        )
+        document_client = get_document_client()
+        from azure.core.exceptions import HttpResponseError
     except Exception as e:
         return {
             "error": f"Error initializing Document Intelligence service: {str(e)}",
             "text": ""
         }
     
+    if document_client is None:
+        return {
+            "error": "Document Intelligence service not properly configured",
+            "text": ""
+        }
+    
     # Check file extension to ensure it's supported
     file_extension = Path(attachment_name).suffix.lower()
     supported_extensions = ['.jpg', '.jpeg', '.jpe', '.jif', '.jfi', '.jfif', 
@@ -86,26 +132,12 @@ async def extract_text_with_document_intelligence(attachment_content, attachment
         }
     
     try:
-        # Create a temporary file to store the attachment
-        with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as temp_file:
-            # Decode base64 content and write to temp file
-            binary_content = base64.b64decode(attachment_content)
-            temp_file.write(binary_content)
-            temp_file_path = temp_file.name
+        if isinstance(attachment_content, str):
+            attachment_content = base64.b64decode(attachment_content)
         
-        # Analyze the document
-        with open(temp_file_path, "rb") as f:
-            document_content = f.read()
-            poller = document_client.begin_analyze_document(
-                "prebuilt-read",
-                document_content
-            )
-            
-            # Wait for the operation to complete
-            result = poller.result()
-        
-        # Remove temporary file
-        os.unlink(temp_file_path)
+        # Analyze the document, the SDK waits for the operation synchronously so it runs in a thread
+        with metrics.span("di_analyze"), breakers.guard(breakers.DOCUMENT_INTELLIGENCE):
+            result = await asyncio.to_thread(analyze_document, document_client, attachment_content, pages)
         
         # Process results
         if not result or not result.pages:
@@ -114,23 +146,10 @@ async def extract_text_with_document_intelligence(attachment_content, attachment
                 "text": ""
             }
         
-        # Extract text from all pages
-        full_text = ""
-        page_texts = []
-        
-        for page in result.pages:
-            # Group lines into paragraphs
-            line_contents = [line.content for line in page.lines if line.content.strip()]
-            paragraphs = group_lines_into_paragraphs(line_contents)
-            
-            # Combine paragraphs for this page
-            page_text = "\n\n".join(paragraphs)
-            page_texts.append({
-                "page_number": page.page_number,
-                "text": page_text
-            })
-            
-            full_text += page_text + "\n\n"
+        # Extract text from all pages, the lines are grouped into paragraphs off the event loop
+        page_lines = [(page.page_number, [line.content for line in page.lines if line.content.strip()]) for page in result.pages]
+        page_texts = await run_cpu(paragraph_pages, page_lines)
+        full_text = "\n\n".join(page["text"] for page in page_texts)
         
         return {
             "full_text": full_text.strip(),
@@ -151,13 +170,181 @@ async def extract_text_with_document_intelligence(attachment_content, attachment
             "error": f"Error analyzing document: {str(e)}",
             "text": ""
         }
-    finally:
-        # Ensure temp file is deleted if it exists
-        if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
-            try:
-                os.unlink(temp_file_path)
-            except:
-                pass
+
+def analyze_document(document_client, attachment_content, pages=None):
+    """Run prebuilt-read on the document and wait for the operation to complete."""
+    poller = document_client.begin_analyze_document(
+        "prebuilt-read",
+        attachment_content,
+        pages=pages
+    )
+    return poller.result()
+
+async def extract_text_in_chunks(attachment_content, attachment_name, page_numbers):
+    """
+    Analyse the pages of a PDF with Document Intelligence in chunks of DI_CHUNK_PAGES pages.
+    
+    The PDF is split locally and up to DI_MAX_CONCURRENCY chunks are analysed at the same time.
+    The results are merged back into one list of pages numbered as in the original document.
+    When some chunks fail, the pages of the others are still returned.
+    
+    Returns:
+        dict: Same structure as extract_text_with_document_intelligence
+    """
+    chunks = [page_numbers[i:i + DI_CHUNK_PAGES] for i in range(0, len(page_numbers), DI_CHUNK_PAGES)]
+    chunk_contents = await run_cpu(split_pdf, attachment_content, chunks)
+    semaphore = asyncio.Semaphore(DI_MAX_CONCURRENCY)
+    
+    async def analyse_chunk(index, chunk):
+        async with semaphore:
+            if chunk_contents is None:
+                # The file could not be split locally, let the service select the pages instead
+                return await extract_text_with_document_intelligence(attachment_content, attachment_name, pages=format_page_ranges(chunk))
+            
+            result = await extract_text_with_document_intelligence(chunk_contents[index], attachment_name)
+            if "error" not in result:
+                for page in result["pages"]:
+                    page["page_number"] = chunk[page["page_number"] - 1]
+            return result
+    
+    with metrics.span("di_chunked_analyze"):
+        results = await asyncio.gather(*(analyse_chunk(index, chunk) for index, chunk in enumerate(chunks)))
+    
+    failed = [result for result in results if "error" in result]
+    if len(failed) == len(results):
+        return failed[0]
+    for chunk, result in zip(chunks, results):
+        if "error" in result:
+            print(f"OCR of pages {format_page_ranges(chunk)} of {attachment_name} failed: {result['error']}")
+    
+    page_texts = sorted((page for result in results if "error" not in result for page in result["pages"]),
+                        key=lambda page: page["page_number"])
+    return {
+        "full_text": "\n\n".join(page["text"] for page in page_texts).strip(),
+        "pages": page_texts,
+        "page_count": len(page_texts),
+        "has_handwritten_content": any(result.get("has_handwritten_content", False) for result in results if "error" not in result)
+    }
+
+async def extract_whole_document(attachment_content, attachment_name):
+    """
+    Analyse a whole document with Document Intelligence, in parallel chunks when it is a PDF with more than
+    DI_CHUNK_PAGES pages. The document is analysed in one go when its page count cannot be read.
+    """
+    page_count = await run_cpu(count_pages, attachment_content) if DI_CHUNK_PAGES else None
+    if page_count is None or page_count <= DI_CHUNK_PAGES:
+        return await extract_text_with_document_intelligence(attachment_content, attachment_name)
+    
+    result = await extract_text_in_chunks(attachment_content, attachment_name, list(range(1, page_count + 1)))
+    if "error" not in result:
+        result["page_count"] = page_count
+    return result
+
+async def extract_attachment_text(attachment_content, attachment_name):
+    """
+    Extract text from an attachment, reading digital PDFs locally.
+    
+    The embedded text layer of a PDF is read in process and only the pages without enough text
+    (scanned or image-only pages) are sent to Document Intelligence. Images, unreadable PDFs and
+    PDFs without any text layer go to Document Intelligence as a whole.
+    
+    For long documents (PAGE_SELECTION_MIN_PAGES or more) only the pages likely to hold certificate
+    data are kept: text layer pages must mention a certificate keyword or a tracking company, and at
+    most PAGE_SELECTION_MAX_OCR_PAGES scanned pages are sent to Document Intelligence. A document
+    without text on any page is OCR'd in full, there is nothing to select the pages by.
+    
+    When more than DI_CHUNK_PAGES pages need OCR they are analysed in parallel chunks.
+    
+    Returns:
+        dict: Same structure as extract_text_with_document_intelligence, plus the lists of "ocr_pages"
+              and "skipped_pages" (page numbers left out of the text) and "ocr_pages_limited" (True when
+              scanned pages were left out because of PAGE_SELECTION_MAX_OCR_PAGES)
+    """
+    text_layer = await run_cpu(read_text_layer, attachment_content) if LOCAL_PDF_TEXT_LAYER else None
+    if not text_layer:
+        return await extract_whole_document(attachment_content, attachment_name)
+    
+    page_count = len(text_layer)
+    select_pages = page_count >= PAGE_SELECTION_MIN_PAGES
+    
+    page_texts = []
+    scanned_pages = []
+    for page in await run_cpu(paragraph_pages, list(enumerate(text_layer, 1))):
+        if len(page["text"]) < PDF_TEXT_LAYER_MIN_CHARS:
+            scanned_pages.append(page["page_number"])
+        else:
+            page_texts.append(page)
+    metrics.increment("attachment_pages_total", len(page_texts), source="text_layer")
+    
+    ocr_pages = scanned_pages
+    skipped_pages = []
+    if select_pages and page_texts:
+        relevant_pages = [page["page_number"] for page in page_texts if is_relevant_page(page["text"])]
+        ocr_pages = select_pages_to_ocr(scanned_pages, relevant_pages)
+        skipped_pages = [page_number for page_number in scanned_pages if page_number not in ocr_pages]
+        if skipped_pages:
+            print(f"OCR of {attachment_name} limited to {len(ocr_pages)} of {len(scanned_pages)} scanned pages, not analysed: {format_page_ranges(skipped_pages)}")
+            metrics.increment("attachment_ocr_limited_total")
+    ocr_pages_limited = bool(skipped_pages)
+    
+    has_handwritten_content = False
+    if ocr_pages:
+        if DI_CHUNK_PAGES and len(ocr_pages) > DI_CHUNK_PAGES:
+            ocr_result = await extract_text_in_chunks(attachment_content, attachment_name, ocr_pages)
+        else:
+            # The whole document is sent when every page needs OCR, e.g. a short scanned document
+            pages = None if len(ocr_pages) == page_count else format_page_ranges(ocr_pages)
+            ocr_result = await extract_text_with_document_intelligence(attachment_content, attachment_name, pages=pages)
+        if "error" in ocr_result:
+            if not page_texts:
+                return ocr_result
+            # Keep the text layer pages rather than failing the whole attachment
+            print(f"OCR of pages {format_page_ranges(ocr_pages)} of {attachment_name} failed: {ocr_result['error']}")
+        else:
+            page_texts.extend(ocr_result["pages"])
+            page_texts.sort(key=lambda page: page["page_number"])
+            has_handwritten_content = ocr_result.get("has_handwritten_content", False)
+    
+    if select_pages:
+        # Leave the pages without any certificate hint out of the text, unless none of the pages has one
+        relevant_texts = [page for page in page_texts if is_relevant_page(page["text"])]
+        if relevant_texts:
+            relevant_pages = {page["page_number"] for page in relevant_texts}
+            skipped_pages.extend(page["page_number"] for page in page_texts if page["page_number"] not in relevant_pages)
+            page_texts = relevant_texts
+        skipped_pages.sort()
+    
+    if skipped_pages:
+        metrics.increment("attachment_pages_total", len(skipped_pages), source="skipped")
+        print(f"Skipped {len(skipped_pages)} of {page_count} pages of {attachment_name}: {format_page_ranges(skipped_pages)}")
+    
+    return {
+        "full_text": "\n\n".join(page["text"] for page in page_texts).strip(),
+        "pages": page_texts,
+        "page_count": page_count,
+        "has_handwritten_content": has_handwritten_content,
+        "ocr_pages": ocr_pages,
+        "skipped_pages": skipped_pages,
+        "ocr_pages_limited": ocr_pages_limited
+    }
+
+def is_relevant_page(page_text):
+    """Return True if the page mentions a certificate keyword or one of the tracking companies."""
+    return PAGE_KEYWORD_PATTERN.search(page_text) is not None
+
+def select_pages_to_ocr(scanned_pages, relevant_pages):
+    """
+    Choose the scanned pages of a long document that are sent to Document Intelligence.
+    
+    Scanned pages next to a text layer page with certificate data come first, followed by the
+    remaining scanned pages in document order (certificates and cover letters usually lead).
+    
+    Returns:
+        list: Sorted page numbers, at most PAGE_SELECTION_MAX_OCR_PAGES of them
+    """
+    neighbours = {page_number + offset for page_number in relevant_pages for offset in (-1, 1)}
+    ordered = sorted(scanned_pages, key=lambda page_number: (page_number not in neighbours, page_number))
+    return sorted(ordered[:PAGE_SELECTION_MAX_OCR_PAGES])
 
 def group_lines_into_paragraphs(lines):
     """
@@ -208,12 +395,23 @@ def group_lines_into_paragraphs(lines):
     
     return paragraphs
 
-# Process attachment based on its content type or file extension
-async def process_attachment(attachment):
-    """Process an attachment and extract text using Document Intelligence."""
-    attachment_name = attachment.get('name', '').lower()
-    content_type = attachment.get('contentType', '').lower()
-    attachment_content = attachment.get('contentBytes', '')
+def paragraph_pages(page_lines):
+    """
+    Group the lines of every page into paragraphs.
+    
+    Args:
+        page_lines (list): (page_number, list of line strings) per page
+        
+    Returns:
+        list: {"page_number", "text"} per page, the paragraphs separated by blank lines
+    """
+    return [{"page_number": page_number, "text": "\n\n".join(group_lines_into_paragraphs(lines))}
+            for page_number, lines in page_lines]
+
+def is_supported_attachment(attachment_name, content_type):
+    """Return True if the extension or the MIME type suggests a document Document Intelligence can read."""
+    attachment_name = attachment_name.lower()
+    content_type = content_type.lower()
     
     # Check file extension for common document formats
     is_supported_ext = any(attachment_name.endswith(ext) for ext in [
@@ -226,33 +424,99 @@ async def process_attachment(attachment):
     ])
     
     # Process if either the extension or MIME type suggests a supported document
-    if is_supported_ext or is_supported_mime:
+    return is_supported_ext or is_supported_mime
+
+def get_attachment_skip_reason(attachment):
+    """
+    Decide from the attachment metadata alone whether the attachment is worth downloading.
+    
+    Returns:
+        str: Reason the attachment is skipped, or None if it should be downloaded and analysed
+    """
+    if attachment.get('@odata.type', FILE_ATTACHMENT_TYPE) != FILE_ATTACHMENT_TYPE:
+        return "Attached items and references are not supported for text extraction"
+    if attachment.get('isInline'):
+        return INLINE_ATTACHMENT
+    if not is_supported_attachment(attachment.get('name', ''), attachment.get('contentType', '')):
+        return "Content type not supported for text extraction"
+    size = attachment.get('size') or 0
+    if size > MAX_ATTACHMENT_BYTES:
+        return f"Attachment larger than {MAX_ATTACHMENT_BYTES} bytes"
+    if 0 < size < MIN_IMAGE_ATTACHMENT_BYTES and is_image(attachment.get('name', ''), attachment.get('contentType', '')):
+        return SMALL_IMAGE
+    return None
+
+def get_image_skip_reason(attachment, attachment_content, attachment_hash):
+    """
+    Decide from the downloaded content whether an image is a logo or signature image.
+    
+    Returns:
+        str: Reason the image is skipped, or None if it should be analysed (always None for other attachments)
+    """
+    if not is_image(attachment.get('name', ''), attachment.get('contentType', '')):
+        return None
+    if signature_images.is_signature_image(attachment_hash):
+        return SIGNATURE_IMAGE
+    size = get_image_size(attachment_content)
+    if size is not None and min(size) < MIN_IMAGE_DIMENSION:
+        return SMALL_IMAGE
+    return None
+
+# Process attachment based on its content type or file extension
+async def process_attachment(attachment, attachment_content=None):
+    """
+    Process an attachment and extract text using Document Intelligence.
+    
+    Args:
+        attachment: Attachment metadata (name, contentType, ...)
+        attachment_content: Raw bytes of the attachment, defaults to the base64 contentBytes of the attachment
+    """
+    attachment_name = attachment.get('name', '').lower()
+    content_type = attachment.get('contentType', '').lower()
+    if attachment_content is None:
+        attachment_content = attachment.get('contentBytes', '')
+    
+    if is_supported_attachment(attachment_name, content_type):
         # If it's octet-stream, try to determine if it's actually a PDF or image
-        if 'octet-stream' in content_type and is_supported_ext:
-            print(f"Found octet-stream with supported extension: {attachment_name}")
+        if 'octet-stream' in content_type:
+            print(f"Found octet-stream attachment: {attachment_name}")
         
-        # Extract text using Document Intelligence
-        extracted_data = await extract_text_with_document_intelligence(attachment_content, attachment_name)
+        # Extract text from the PDF text layer, or with Document Intelligence
+        extracted_data = await extract_attachment_text(attachment_content, attachment_name)
         
-        return {
-            "name": attachment_name,
-            "content_type": content_type,
-            "analysis_result": extracted_data,
-            # For backward compatibility
-            "extracted_text": extracted_data.get("full_text", "") if "error" not in extracted_data else ""
-        }
+        return analysed_attachment(attachment, extracted_data)
     else:
         # For other content types, we don't extract text
-        return {
-            "name": attachment_name,
-            "content_type": content_type,
-            "analysis_result": {"error": "Content type not supported for text extraction"},
-            "extracted_text": ""
-        }
+        return skipped_attachment(attachment, "Content type not supported for text extraction")
+
+def analysed_attachment(attachment, extracted_data):
+    """Processed attachment entry for an attachment with the result of extract_attachment_text."""
+    return {
+        "name": attachment.get('name', '').lower(),
+        "content_type": attachment.get('contentType', '').lower(),
+        "analysis_result": extracted_data,
+        # For backward compatibility
+        "extracted_text": extracted_data.get("full_text", "") if "error" not in extracted_data else ""
+    }
+
+def skipped_attachment(attachment, reason):
+    """Processed attachment entry for an attachment that was not analysed."""
+    return {
+        "name": attachment.get('name', '').lower(),
+        "content_type": attachment.get('contentType', '').lower(),
+        "analysis_result": {"error": reason},
+        "extracted_text": ""
+    }
 
 # CREATE EMAIL OBJECT
-async def create_email_details(access_token, user_id, msg):
-    body_content = get_email_body(msg)
+async def create_email_details(access_token, user_id, msg, attachments=None):
+    """
+    Build the email details, with the text of the analysed attachments.
+    
+    Args:
+        attachments: Attachment metadata from fetch_attachments, fetched here when not given
+    """
+    body_content = await run_cpu(get_email_body, msg)
 
     # Get all the recipients and cc list
     to_recipients = [recipient.get('emailAddress', {}).get('address', '') for recipient in msg.get('toRecipients', [])]
@@ -261,17 +525,55 @@ async def create_email_details(access_token, user_id, msg):
     to_recipients_str = ', '.join(to_recipients)
     cc_recipients_str = ', '.join(cc_recipients)
 
-    # Fetch attachments
-    raw_attachments = await fetch_attachments(access_token, user_id, msg.get('id', ''))
+    # Fetch the attachment metadata only, the content is downloaded below for the attachments that are analysed
+    message_id = msg.get('id', '')
+    if attachments is None:
+        attachments = await fetch_attachments(access_token, user_id, message_id) if msg.get('hasAttachments', True) else []
     
-    # Process attachments to extract text
+    # Process attachments to extract text, the content of each attachment is released as soon as it was analysed
+    key = ledger_key(msg)
+    attachment_hashes = []
     processed_attachments = []
-    for attachment in raw_attachments:
-        processed_attachment = await process_attachment(attachment)
-        processed_attachments.append(processed_attachment)
+    for attachment in attachments:
+        skip_reason = get_attachment_skip_reason(attachment)
+        
+        attachment_content = None
+        if skip_reason is None:
+            attachment_content = await download_attachment(access_token, user_id, message_id, attachment['id'])
+            if attachment_content is None:
+                processed_attachments.append(skipped_attachment(attachment, "Attachment could not be downloaded"))
+                continue
+            
+            attachment_hash = hash_attachment(attachment_content)
+            attachment_hashes.append(attachment_hash)
+            skip_reason = get_image_skip_reason(attachment, attachment_content, attachment_hash)
+            if len(attachment_content) <= SIGNATURE_IMAGE_MAX_BYTES and is_image(attachment.get('name', ''), attachment.get('contentType', '')):
+                # Only small images are counted, so that a scanned certificate sent again is never mistaken for a logo
+                signature_images.record_image(attachment_hash, key, attachment.get('name', ''))
+        
+        if skip_reason in OMITTED_ATTACHMENT_REASONS:
+            # Inline, tiny and known signature images (logos, social icons) are left out of the context
+            print(f"Skipping {attachment.get('name', '')}: {skip_reason}")
+            metrics.increment("attachments_omitted_total", reason=skip_reason)
+            continue
+        if skip_reason is not None:
+            processed_attachments.append(skipped_attachment(attachment, skip_reason))
+            continue
+        
+        saved_analysis = get_attachment_analysis(attachment_hash)
+        if saved_analysis is not None:
+            # The same file was analysed before (e.g. a certificate sent again), its text is reused
+            metrics.increment("attachment_analyses_reused_total")
+            processed_attachments.append(analysed_attachment(attachment, saved_analysis))
+        else:
+            processed_attachment = await process_attachment(attachment, attachment_content)
+            if "error" not in processed_attachment["analysis_result"]:
+                save_attachment_analysis(attachment_hash, processed_attachment["analysis_result"])
+            processed_attachments.append(processed_attachment)
+        del attachment_content
 
     email_details = {
-        'email_id': msg.get('id', ''),
+        'email_id': message_id,
         'internet_message_id': msg.get('internetMessageId', ''),
         'to': to_recipients_str,
         'from': msg.get('from', {}).get('emailAddress', {}).get('address', ''),
@@ -280,68 +582,67 @@ async def create_email_details(access_token, user_id, msg):
         'subject': msg.get('subject', ''),
         'body_html': body_content.get('html', ''),
         'body_text': body_content.get('text', ''),
-        'raw_attachments': raw_attachments,
+        'body_trail_text': body_content.get('trail_text', ''),
+        # Attachment metadata only (id, name, contentType, size, isInline), the content is never kept
+        'attachment_metadata': attachments,
+        'attachment_hashes': attachment_hashes,
         'processed_attachments': processed_attachments
     }
     
     return email_details
 
 async def fetch_attachments(access_token, user_id, message_id):
+    """Fetch the metadata of the attachments of a message, without their content."""
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
     }
-    endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/attachments'
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.get(endpoint, headers=headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                attachments = data.get('value', [])
-                return attachments
-            else:
-                print(f"Failed to retrieve attachments for message {message_id}: {response.status}")
-                print(await response.text())
-                return []
+    endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/attachments?$select={ATTACHMENT_METADATA_FIELDS}'
+    
+    with metrics.span("attachment_list"), breakers.guard(breakers.GRAPH) as call:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(endpoint, headers=headers) as response:
+                if breakers.is_failure_status(response.status):
+                    call.fail()
+                if response.status == 200:
+                    data = await response.json()
+                    attachments = data.get('value', [])
+                    return attachments
+                else:
+                    print(f"Failed to retrieve attachments for message {message_id}: {response.status}")
+                    print(await response.text())
+                    return []
+
+async def download_attachment(access_token, user_id, message_id, attachment_id):
+    """Download the raw bytes of a file attachment, returns None if the download failed."""
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+    }
+    endpoint = f'https://graph.microsoft.com/v1.0/users/{user_id}/messages/{message_id}/attachments/{attachment_id}/$value'
+    
+    with metrics.span("attachment_download"), breakers.guard(breakers.GRAPH) as call:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(endpoint, headers=headers) as response:
+                if breakers.is_failure_status(response.status):
+                    call.fail()
+                if response.status == 200:
+                    return await response.read()
+                else:
+                    print(f"Failed to download attachment {attachment_id} for message {message_id}: {response.status}")
+                    print(await response.text())
+                    return None
+
+def build_email_context(email_data):
+    """Build the EmailContext that is shared by all the model calls for an email."""
+    return EmailContext.from_email_data(email_data)
+
+def render_email_context(email_data):
+    """Build the EmailContext and render its prompt text, meant to run in the CPU executor."""
+    context = build_email_context(email_data)
+    context.prompt_text
+    return context
 
 # Generate a formatted LLM text as JSON with all email details and attachment content
 def generate_llm_text(email_data):
     """Generate a structured JSON with all email details and attachment content."""
-    
-    # Create the structured JSON object
-    llm_data = {
-        "email_metadata": {
-            "from": email_data.get('from', ''),
-            "to": email_data.get('to', ''),
-            "cc": email_data.get('cc', ''),
-            "subject": email_data.get('subject', ''),
-            "date_received": email_data.get('date_received', '')
-        },
-        "email_body": email_data.get('body_text', ''),
-        "attachments": []
-    }
-    
-    # Add attachment information
-    attachments = email_data.get('processed_attachments', [])
-    if attachments:
-        for i, attachment in enumerate(attachments, 1):
-            attachment_data = {
-                "name": attachment.get('name', ''),
-                "type": attachment.get('content_type', ''),
-                "index": i
-            }
-            
-            # Add analysis results if available
-            analysis_result = attachment.get('analysis_result', {})
-            if analysis_result and "error" not in analysis_result:
-                attachment_data["content"] = analysis_result.get("full_text", "")
-                attachment_data["page_count"] = analysis_result.get("page_count", 1)
-                attachment_data["has_handwritten_content"] = analysis_result.get("has_handwritten_content", False)
-            else:
-                attachment_data["content"] = ""
-                attachment_data["error"] = analysis_result.get("error", "Unknown error during text extraction")
-            
-            llm_data["attachments"].append(attachment_data)
-    
-    # Convert to JSON string
-    return json.dumps(llm_data, indent=2)
+    return json.dumps(build_email_context(email_data).to_dict(), indent=2)
@@ -0,0 +1,41 @@
+import struct
+
+# JPEG START-OF-FRAME MARKERS (THE ONES THAT CARRY THE IMAGE SIZE)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.jpe', '.jif', '.jfi', '.jfif', '.png', '.gif', '.bmp', '.tif', '.tiff')
+
+
+def is_image(attachment_name, content_type):
+    """Return True if the name or the MIME type is the one of an image."""
+    return content_type.lower().startswith('image/') or attachment_name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def get_image_size(content):
+    """
+    Read the width and height of a PNG, GIF, BMP or JPEG image from its header, without decoding it.
+
+    Returns:
+        tuple: (width, height) in pixels, or None if the format is not recognised
+    """
+    try:
+        if content[:8] == b'\x89PNG\r\n\x1a\n':
+            return struct.unpack('>II', content[16:24])
+        if content[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', content[6:10])
+        if content[:2] == b'BM':
+            width, height = struct.unpack('<ii', content[18:26])
+            return width, abs(height)
+        if content[:2] == b'\xff\xd8':
+            offset = 2
+            while offset + 9 <= len(content):
+                if content[offset] != 0xFF:
+                    return None
+                marker = content[offset + 1]
+                if marker in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack('>HH', content[offset + 5:offset + 9])
+                    return width, height
+                offset += 2 + struct.unpack('>H', content[offset + 2:offset + 4])[0]
+    except struct.error:
+        return None
+    return None
@@ -0,0 +1,104 @@
+from io import BytesIO
+
+# pypdf is optional, without it every PDF is sent to Document Intelligence
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+
+def is_pdf(attachment_content):
+    """Return True if the bytes start with the PDF header."""
+    return isinstance(attachment_content, (bytes, bytearray)) and attachment_content[:5] == b'%PDF-'
+
+
+def _open_pdf(attachment_content):
+    """Open a PDF, decrypting it with the empty password (no password to open, only permissions set) if needed."""
+    reader = PdfReader(BytesIO(attachment_content))
+    if reader.is_encrypted:
+        reader.decrypt('')
+    return reader
+
+
+def count_pages(attachment_content):
+    """
+    Return the number of pages of a PDF, or None if pypdf is not installed or the file cannot be read.
+    Independent of the text layer, so it also works for scanned PDFs.
+    """
+    if PdfReader is None or not is_pdf(attachment_content):
+        return None
+
+    try:
+        return len(_open_pdf(attachment_content).pages)
+    except Exception as e:
+        print(f"Could not read the PDF page count: {str(e)}")
+        return None
+
+
+def read_text_layer(attachment_content):
+    """
+    Read the embedded text layer of a PDF in process.
+
+    Args:
+        attachment_content (bytes): Raw bytes of the PDF
+
+    Returns:
+        list: One list of line strings per page (empty for image-only pages),
+              or None if pypdf is not installed or the file cannot be read
+    """
+    if PdfReader is None or not is_pdf(attachment_content):
+        return None
+
+    try:
+        # PDFs encrypted for their permissions only are read, PDFs that need a password end up in the except below
+        reader = _open_pdf(attachment_content)
+
+        pages = []
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            pages.append([line for line in text.splitlines() if line.strip()])
+        return pages
+    except Exception as e:
+        print(f"Could not read the PDF text layer: {str(e)}")
+        return None
+
+
+def split_pdf(attachment_content, chunks):
+    """
+    Write one smaller PDF per chunk of pages.
+
+    Args:
+        attachment_content (bytes): Raw bytes of the PDF
+        chunks (list): Lists of 1-based page numbers
+
+    Returns:
+        list: The bytes of one PDF per chunk, or None if pypdf is not installed or the file cannot be split
+    """
+    if PdfReader is None or not is_pdf(attachment_content):
+        return None
+
+    try:
+        reader = _open_pdf(attachment_content)
+        chunk_contents = []
+        for chunk in chunks:
+            writer = PdfWriter()
+            for page_number in chunk:
+                writer.add_page(reader.pages[page_number - 1])
+            output = BytesIO()
+            writer.write(output)
+            chunk_contents.append(output.getvalue())
+        return chunk_contents
+    except Exception as e:
+        print(f"Could not split the PDF into chunks: {str(e)}")
+        return None
+
+
+def format_page_ranges(page_numbers):
+    """Format page numbers as the ranges expected by Document Intelligence, e.g. [1, 2, 3, 5] -> '1-3,5'."""
+    ranges = []
+    for page_number in sorted(page_numbers):
+        if ranges and ranges[-1][1] == page_number - 1:
+            ranges[-1][1] = page_number
+        else:
+            ranges.append([page_number, page_number])
+    return ",".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
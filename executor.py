@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+import functools
+import threading
+import concurrent.futures
+import metrics
+from config import CPU_EXECUTOR, CPU_EXECUTOR_WORKERS
+
+# CPU-BOUND WORK (HTML CONVERSION, PARAGRAPH GROUPING, PROMPT JSON, EMBEDDINGS) IS RUN OFF THE EVENT LOOP
+# CPU_EXECUTOR selects where it runs:
+#   "thread"  - a thread pool (default). Keeps the loop responsive, the GIL still limits CPU parallelism
+#   "process" - a process pool, CPU work scales across cores. Every worker loads the embedding model once at start
+#   "inline"  - on the event loop, as before
+# Functions run in the process pool must be importable module-level functions with picklable arguments.
+# The workers are started with forkserver (spawn where it is not available), never forked from the processor,
+# which already runs threads (the LLM pool, the lease renewal). The metrics a worker records during a task are
+# sent back with its result and recorded in the processor.
+
+_executor = None
+_executor_lock = threading.Lock()
+_outstanding = 0
+_outstanding_lock = threading.Lock()
+
+
+def _init_process_worker():
+    """Warm up a process pool worker: load the embedding model before the first email needs it."""
+    import functions
+    functions.get_embedding_model()
+
+
+def _run_in_worker(function, args, kwargs):
+    """
+    Run a function in a process pool worker.
+
+    Returns:
+        tuple: (result, metrics recorded during the call, exception raised by the call or None)
+    """
+    metrics.start_recording()
+    try:
+        result, error = function(*args, **kwargs), None
+    except Exception as e:
+        result, error = None, e
+    return result, metrics.take_recording(), error
+
+
+def get_executor():
+    """Create (once) the executor selected with CPU_EXECUTOR, None when running inline."""
+    global _executor
+    if CPU_EXECUTOR == 'inline':
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                if CPU_EXECUTOR == 'process':
+                    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                    _executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=CPU_EXECUTOR_WORKERS, initializer=_init_process_worker,
+                        mp_context=multiprocessing.get_context(start_method)
+                    )
+                elif CPU_EXECUTOR == 'thread':
+                    _executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=CPU_EXECUTOR_WORKERS, thread_name_prefix='cpu-worker'
+                    )
+                else:
+                    raise ValueError(f"Unknown CPU_EXECUTOR {CPU_EXECUTOR}, expected thread, process or inline")
+    return _executor
+
+
+def _report_outstanding(change):
+    global _outstanding
+    with _outstanding_lock:
+        _outstanding += change
+        outstanding = _outstanding
+    metrics.set_gauge("cpu_executor_in_flight", min(outstanding, CPU_EXECUTOR_WORKERS))
+    metrics.set_gauge("cpu_executor_queue_depth", max(0, outstanding - CPU_EXECUTOR_WORKERS))
+
+
+async def run_cpu(function, *args, **kwargs):
+    """
+    Run a CPU-bound function in the configured executor and return its result.
+
+    Records the span cpu_task{function=...} (time spent queued plus running) and the gauges
+    cpu_executor_in_flight and cpu_executor_queue_depth.
+    """
+    executor = get_executor()
+    with metrics.span("cpu_task", function=function.__name__):
+        if executor is None:
+            return function(*args, **kwargs)
+
+        _report_outstanding(1)
+        try:
+            loop = asyncio.get_running_loop()
+            if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+                result, recorded, error = await loop.run_in_executor(executor, functools.partial(_run_in_worker, function, args, kwargs))
+                metrics.replay(recorded)
+                if error is not None:
+                    raise error
+                return result
+            return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
+        finally:
+            _report_outstanding(-1)
+
+
+def warm_up():
+    """Start the executor (and for a process pool, its workers and their embedding models) ahead of the first email."""
+    executor = get_executor()
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        # Submitting one task per worker makes the pool start all of them
+        for future in [executor.submit(int) for _ in range(CPU_EXECUTOR_WORKERS)]:
+            future.result()
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
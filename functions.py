@@ -2,29 +2,172 @@ import requests
 import os
 import json
 import uuid
-from openai import AzureOpenAI
+import asyncio
+import functools
+import threading
+import concurrent.futures
 from config import AZURE_OPENAI_KEY, AZURE_OPENAI_ENDPOINT
+from config import ESB_TIMEOUT_SECONDS, LLM_DEFAULT_TIMEOUT, LLM_TIMEOUTS, LLM_HEDGING, LLM_HEDGE_QUANTILE, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_MIN_DELAY, AZURE_OPENAI_HEDGE_ENDPOINT, AZURE_OPENAI_HEDGE_KEY, LLM_HEDGE_DEPLOYMENTS
+import metrics
+import breakers
+import usage
 
 base_url = os.environ.get('base_url')
 client_id = os.environ.get('client_id')
 client_secret = os.environ.get('client_secret')
 scope = os.environ.get('scope')
 
-# CREATE AN OPENAI CONNECTION
+# HEAVY DEPENDENCIES (openai, sentence_transformers, sklearn) ARE IMPORTED AT FIRST USE, SO THAT IMPORTING THIS MODULE
+# (E.G. FOR THE ADMIN COMMANDS OF main.py) STAYS FAST. "python main.py start" LOADS THEM UP FRONT IN ITS WARM-UP
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+# CREATE AN OPENAI CONNECTION (ONCE, THE CLIENT AND ITS CONNECTION POOL ARE SHARED BY ALL CALLS)
 def get_openai_client():
-    client = AzureOpenAI(
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    api_key=AZURE_OPENAI_KEY,
-    api_version="2024-02-01",
-)
-    return client
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                from openai import AzureOpenAI
+                _openai_client = AzureOpenAI(
+                    azure_endpoint=AZURE_OPENAI_ENDPOINT,
+                    api_key=AZURE_OPENAI_KEY,
+                    api_version="2024-02-01",
+                )
+    return _openai_client
+
+
+# LLM REQUESTS RUN IN A THREAD POOL SO THAT THE CALLER CAN STOP WAITING AT THE DEADLINE AND HEDGE A SLOW REQUEST.
+# ABANDONED REQUESTS KEEP A THREAD UNTIL THEY END, AT THE LATEST AT THEIR OWN TIMEOUT
+LLM_POOL_SIZE = 32
+
+_llm_pool = None
+_hedge_client = None
+_llm_pool_lock = threading.Lock()
+
+
+def _get_llm_pool():
+    global _llm_pool
+    if _llm_pool is None:
+        with _llm_pool_lock:
+            if _llm_pool is None:
+                _llm_pool = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_POOL_SIZE, thread_name_prefix='llm-request')
+    return _llm_pool
+
+
+def get_hedge_client(client):
+    """Return the client hedge requests are sent with: a client of AZURE_OPENAI_HEDGE_ENDPOINT if set, else the primary client."""
+    global _hedge_client
+    if not AZURE_OPENAI_HEDGE_ENDPOINT:
+        return client
+    with _llm_pool_lock:
+        if _hedge_client is None:
+            from openai import AzureOpenAI
+            _hedge_client = AzureOpenAI(
+                azure_endpoint=AZURE_OPENAI_HEDGE_ENDPOINT,
+                api_key=AZURE_OPENAI_HEDGE_KEY,
+                api_version="2024-02-01",
+            )
+    return _hedge_client
+
+
+def hedge_delay(call_type, model):
+    """
+    Return the seconds after which a call is hedged: the LLM_HEDGE_QUANTILE latency of the recent requests
+    of this call type and model, None while hedging is disabled or fewer than LLM_HEDGE_MIN_SAMPLES were timed.
+    """
+    if not LLM_HEDGING:
+        return None
+    labels = {"call_type": call_type, "model": model, "endpoint": "primary"}
+    if metrics.counter_value("llm_request_total", **labels) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    latency = metrics.percentile("llm_request", LLM_HEDGE_QUANTILE, **labels)
+    return max(latency, LLM_HEDGE_MIN_DELAY) if latency is not None else None
+
+
+def _send_request(client, call_type, endpoint, timeout, kwargs):
+    with metrics.span("llm_request", call_type=call_type, model=kwargs.get('model'), endpoint=endpoint):
+        return client.chat.completions.create(timeout=timeout, **kwargs)
+
+
+def _record_unused_answer(call_type, request):
+    """Record the token usage of a request whose answer was not used (hedged or past the deadline), it is paid for all the same."""
+    if request.cancelled() or request.exception() is not None:
+        return
+    usage.record_usage(request.result(), f"{call_type}_unused")
 
 
-def get_tracking_company(llm_text):
+async def create_chat_completion(client, call_type, **kwargs):
+    """
+    Call the chat completions API, recording the latency and errors under the given call type.
+    
+    The request runs in the LLM thread pool and is awaited, so the event loop keeps running. The call raises
+    TimeoutError once the deadline of its call type (LLM_TIMEOUTS) has passed. With LLM_HEDGING, a request still
+    running after hedge_delay() is sent a second time (to the hedge endpoint and deployment when configured) and
+    the first answer is used. The other request is cancelled if it has not started yet, otherwise its answer is
+    dropped (a request in flight cannot be interrupted) and its token usage recorded as "<call_type>_unused".
+    """
+    model = kwargs.get('model')
+    deadline = LLM_TIMEOUTS.get(call_type, LLM_DEFAULT_TIMEOUT)
+    
+    with metrics.span("llm_call", call_type=call_type, model=model), breakers.guard(breakers.OPENAI):
+        pool = _get_llm_pool()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        
+        # Awaitable of every request -> the request in the thread pool
+        requests_sent = {}
+        primary_request = pool.submit(_send_request, client, call_type, "primary", deadline, kwargs)
+        primary = asyncio.wrap_future(primary_request)
+        requests_sent[primary] = primary_request
+        pending = {primary}
+        
+        answer = None
+        error = None
+        try:
+            delay = hedge_delay(call_type, model)
+            if delay is not None and delay < deadline:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    hedge_kwargs = dict(kwargs, model=LLM_HEDGE_DEPLOYMENTS.get(model, model))
+                    hedge_request = pool.submit(_send_request, get_hedge_client(client), call_type, "hedge", deadline - delay, hedge_kwargs)
+                    hedge = asyncio.wrap_future(hedge_request)
+                    requests_sent[hedge] = hedge_request
+                    pending.add(hedge)
+            
+            # Use the first answer, an error only counts once the other request failed as well
+            while pending and answer is None:
+                remaining = deadline - (loop.time() - start)
+                done, pending = await asyncio.wait(pending, timeout=max(remaining, 0), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for request in done:
+                    if request.exception() is not None:
+                        error = request.exception()
+                    elif answer is None:
+                        answer = request
+                    else:
+                        _record_unused_answer(call_type, requests_sent[request])
+        finally:
+            for request in pending:
+                requests_sent[request].add_done_callback(functools.partial(_record_unused_answer, call_type))
+                request.cancel()
+        
+        if answer is not None:
+            if len(requests_sent) > 1:
+                metrics.increment("llm_hedge_total", call_type=call_type, answered_by="primary" if answer is primary else "hedge")
+            return answer.result()
+        if pending:
+            metrics.increment("llm_timeouts_total", call_type=call_type)
+            raise TimeoutError(f"{call_type} call to {model} took longer than its deadline of {deadline} s")
+        raise error
+
+async def get_tracking_company(llm_text, model='gpt-4o'):
     client = get_openai_client()
     
-    response =  client.chat.completions.create(
-    model='gpt-4o',
+    response = await create_chat_completion(client, "tracker_company",
+    model=model,
     messages=[
         {
             "role": "system", 
@@ -62,10 +205,10 @@ def get_tracking_company(llm_text):
     return response
 
 
-def get_id_number(llm_text):
+async def get_id_number(llm_text):
     client = get_openai_client()
     
-    response =  client.chat.completions.create(
+    response = await create_chat_completion(client, "id_number",
     model='gpt-4o-mini',
     messages=[
         {
@@ -95,10 +238,10 @@ def get_id_number(llm_text):
     return response
 
 
-def get_policy_number(llm_text):
+async def get_policy_number(llm_text):
     client = get_openai_client()
     
-    response =  client.chat.completions.create(
+    response = await create_chat_completion(client, "policy_number",
     model='gpt-4o-mini',
     messages=[
         {
@@ -130,11 +273,20 @@ def get_policy_number(llm_text):
     return response
 
 
-def extract_details(llm_text, template):
+async def extract_details(llm_text, template, model='gpt-4o', fields=None):
+    """
+    Extract the certificate details with the template of the tracker company.
+    With fields, the model is only asked for those fields (the others were read from the certificate layout).
+    """
     client = get_openai_client()
     
-    response =  client.chat.completions.create(
-    model='gpt-4o',
+    user_prompt = f"Analyse the following email context to extract the request details from the attachements text: {llm_text}"
+    if fields:
+        # Added to the user message, so the system prompt (and its prompt cache) stays the same
+        user_prompt = f"Only extract these fields and return just them in the JSON format: {', '.join(fields)}. " + user_prompt
+    
+    response = await create_chat_completion(client, "certificate_details",
+    model=model,
     messages=[
         {
             "role": "system", 
@@ -142,7 +294,7 @@ def extract_details(llm_text, template):
         },
         {
             "role": "user",
-            "content": f"Analyse the following email context to extract the request details from the attachements text: {llm_text}"
+            "content": user_prompt
         }
     ],
     temperature=0.1,
@@ -161,7 +313,10 @@ def get_token():
     'Content-Type': 'application/x-www-form-urlencoded',
     'Cookie': ''
     }
-    response = requests.request("GET", url, headers=headers, data=payload)
+    with metrics.span("esb_token"), breakers.guard(breakers.ESB) as call:
+        response = requests.request("GET", url, headers=headers, data=payload, timeout=ESB_TIMEOUT_SECONDS)
+        if breakers.is_failure_status(response.status_code):
+            call.fail()
     token = response.json()['access_token']
     
     return token
@@ -188,7 +343,10 @@ def get_active_policies(id_number,token):
     'Cookie': ""
     }
 
-    response = requests.request("GET", url, headers=headers, data=payload)
+    with metrics.span("esb_get_active_policies"), breakers.guard(breakers.ESB) as call:
+        response = requests.request("GET", url, headers=headers, data=payload, timeout=ESB_TIMEOUT_SECONDS)
+        if breakers.is_failure_status(response.status_code):
+            call.fail()
 
     # Initialize an empty list to store active policy reference numbers  
     activePolicies = [] 
@@ -237,7 +395,10 @@ def get_vehicles(token, policyNumber):
     'Cookie': ''
     }
 
-    response = requests.request("GET", url, headers=headers, data=payload)
+    with metrics.span("esb_get_vehicles"), breakers.guard(breakers.ESB) as call:
+        response = requests.request("GET", url, headers=headers, data=payload, timeout=ESB_TIMEOUT_SECONDS)
+        if breakers.is_failure_status(response.status_code):
+            call.fail()
     
     data = response.json()
     policyDetails = data["policyDetailResponse"]
@@ -266,8 +427,31 @@ def get_vehicles(token, policyNumber):
     return vehicles
     
     
-from sentence_transformers import SentenceTransformer, util
-from sklearn.metrics.pairwise import cosine_similarity
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+def get_embedding_model():
+    """Load (once per process) the SentenceTransformer model used to match the vehicle descriptions."""
+    global _embedding_model
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                from sentence_transformers import SentenceTransformer
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+def vehicle_similarity_scores(vehicle_key, as400_vehicle_keys):
+    """
+    Compute the similarity score of the extracted vehicle key against the key of every AS400 vehicle.
+    Runs in the CPU executor, the embedding model is loaded once per process.
+    :param vehicle_key: The vehicle key extracted from the certificate
+    :param as400_vehicle_keys: Dict of vehicle sequence -> AS400 vehicle key
+    :return: Dict of vehicle sequence -> similarity score
+    """
+    model = get_embedding_model()
+    return {sequence: float(text_similarity_score(vehicle_key, as400_vehicle_key, model))
+            for sequence, as400_vehicle_key in as400_vehicle_keys.items()}
 
 def text_similarity_score(text1,text2,model):
     """
@@ -277,9 +461,11 @@ def text_similarity_score(text1,text2,model):
     :param model: A loaded SentenceTransformer model
     :return: A float simialrity score between 0 and 1
     """
+    from sklearn.metrics.pairwise import cosine_similarity
     
     #Get the embeddings for both texts
-    embeddings = model.encode([text1, text2])
+    with metrics.span("embedding"):
+        embeddings = model.encode([text1, text2])
     
     # Compute cosine similariyt between the two embeddings
     score = cosine_similarity([embeddings[0]],[embeddings[1]])[0][0]
@@ -0,0 +1,91 @@
+import os
+import sys
+import argparse
+import subprocess
+
+# IMPORT TIME CHECK FOR main.py
+# Imports main in a fresh interpreter with -X importtime and fails when the import takes longer than the
+# budget or loads one of the heavy dependencies that must only be imported at first use (see the warm-up
+# in main.py). Run it after adding an import to main.py or to one of the modules it imports.
+#
+#   python import_time.py                   # exit code 1 over the budget or when a lazy dependency is imported
+#   python import_time.py --budget 0.5      # a stricter budget in seconds
+#   python import_time.py --top 20          # list more of the slowest imports
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds that importing main may take
+DEFAULT_BUDGET = 1.0
+
+# Packages that are imported lazily and must not be loaded by importing main
+LAZY_MODULES = ['openai', 'sentence_transformers', 'sklearn', 'torch', 'transformers', 'azure.ai', 'msal']
+
+
+def measure_imports(module='main'):
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        list: (module name, cumulative seconds, nesting depth) of every import, in the order they finished
+    """
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=PROJECT_DIR, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{completed.stderr[-2000:]}")
+
+    imports = []
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(cumulative) / 1_000_000, depth))
+    return imports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time of main.py against a budget")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help="Seconds that importing main may take")
+    parser.add_argument('--top', type=int, default=10, help="Number of the slowest top-level imports to list")
+    args = parser.parse_args(argv)
+
+    try:
+        imports = measure_imports()
+    except RuntimeError as e:
+        print(e)
+        return 2
+
+    # Imports are listed when they finish, so main comes after everything it imports. The interpreter
+    # startup imports before it are not counted
+    position = max(index for index, (name, _, depth) in enumerate(imports) if name == 'main' and depth == 0)
+    total = imports[position][1]
+    first = position
+    while first > 0 and imports[first - 1][2] > 0:
+        first -= 1
+    top_level = sorted(((name, seconds) for name, seconds, depth in imports[first:position] if depth == 1),
+                       key=lambda item: item[1], reverse=True)
+
+    print(f"Importing main took {total:.3f} s (budget {args.budget:.3f} s), slowest imports:")
+    for name, seconds in top_level[:args.top]:
+        print(f"   {seconds:8.3f} s  {name}")
+
+    failures = []
+    if total > args.budget:
+        failures.append(f"import time {total:.3f} s is over the budget of {args.budget:.3f} s")
+    loaded = sorted({lazy for name, _, _ in imports[first:position + 1] for lazy in LAZY_MODULES
+                     if name == lazy or name.startswith(lazy + '.')})
+    if loaded:
+        failures.append(f"lazy dependencies imported at startup: {', '.join(loaded)}")
+
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if not failures:
+        print("Import time within the budget")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
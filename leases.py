@@ -0,0 +1,199 @@
+import time
+import asyncio
+import sqlite3
+import threading
+import ledger
+import metrics
+from config import LEASE_BACKEND, LEASE_DB_PATH, LEASE_TTL_SECONDS, INSTANCE_ID
+
+# TIME-LIMITED LEASES ON EMAILS, SHARED BY ALL THE INSTANCES OF THE PROCESSOR
+# An instance processes an email only while it holds the lease on its ledger key. The lease is renewed
+# while the email is in flight and expires LEASE_TTL_SECONDS after the last renewal, so the emails of a
+# crashed instance are picked up by another instance on its next poll.
+#
+# The leases are renewed from a dedicated thread rather than from the event loop, so that a call that
+# blocks the loop for longer than the TTL cannot make a lease expire while the email is still in flight.
+#
+# Backends are registered by name in BACKENDS and selected with LEASE_BACKEND. A backend is a class with
+# acquire(key, owner, ttl), renew(key, owner, ttl) and release(key, owner) methods, and a shared attribute
+# that is False when the leases are not seen by the other instances (the default is True).
+
+
+class SQLiteLeaseBackend:
+    """
+    Leases in a SQLite database, by default the ledger database. For instances on different hosts, put the
+    database on storage they share and set LEDGER_JOURNAL_MODE=DELETE, WAL does not work over network file systems.
+    """
+
+    shared = True
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS leases (
+        lease_key TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """
+
+    def __init__(self, path=None):
+        self.path = path or ledger.LEDGER_DB_PATH
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.executescript(self.SCHEMA)
+
+    def acquire(self, key, owner, ttl):
+        """Take the lease if it is free or expired. Returns True if the caller now holds the lease."""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                """
+                INSERT INTO leases (lease_key, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(lease_key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.expires_at < ?
+                """,
+                (key, owner, now + ttl, now)
+            )
+        return cursor.rowcount == 1
+
+    def renew(self, key, owner, ttl):
+        """Extend a lease we hold. Returns False if the lease was lost (expired and taken by another instance)."""
+        with self._lock:
+            cursor = self._connection.execute(
+                "UPDATE leases SET expires_at = ? WHERE lease_key = ? AND owner = ?",
+                (time.time() + ttl, key, owner)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, key, owner):
+        with self._lock:
+            self._connection.execute("DELETE FROM leases WHERE lease_key = ? AND owner = ?", (key, owner))
+
+
+class MemoryLeaseBackend:
+    """Leases in process memory, for a single instance (e.g. benchmarks)."""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            current = self._leases.get(key)
+            if current is not None and current[1] >= now:
+                return False
+            self._leases[key] = (owner, now + ttl)
+            return True
+
+    def renew(self, key, owner, ttl):
+        with self._lock:
+            current = self._leases.get(key)
+            if current is None or current[0] != owner:
+                return False
+            self._leases[key] = (owner, time.time() + ttl)
+            return True
+
+    def release(self, key, owner):
+        with self._lock:
+            if self._leases.get(key, (None,))[0] == owner:
+                del self._leases[key]
+
+
+BACKENDS = {
+    'sqlite': lambda: SQLiteLeaseBackend(LEASE_DB_PATH),
+    'memory': MemoryLeaseBackend,
+}
+
+_backend = None
+
+
+def register_backend(name, factory):
+    """Register a lease backend factory (a zero-argument callable returning the backend) under a name."""
+    BACKENDS[name] = factory
+
+
+def get_backend():
+    """Create (once) the backend selected with LEASE_BACKEND."""
+    global _backend
+    if _backend is None:
+        if LEASE_BACKEND not in BACKENDS:
+            raise ValueError(f"Unknown lease backend {LEASE_BACKEND}, expected one of {', '.join(BACKENDS)}")
+        _backend = BACKENDS[LEASE_BACKEND]()
+    return _backend
+
+
+def is_shared():
+    """Return True if the leases are seen by every instance, so that holding one excludes the other instances."""
+    return getattr(get_backend(), 'shared', True)
+
+
+def acquire(key):
+    """Take the lease on an email. Returns False if another instance (or another worker of this one) holds it."""
+    acquired = get_backend().acquire(key, INSTANCE_ID, LEASE_TTL_SECONDS)
+    metrics.increment("lease_acquire_total", result="acquired" if acquired else "held_elsewhere")
+    return acquired
+
+
+def release(key):
+    # Stop renewing first, so that the renewal thread does not take the released lease for a lost one
+    with _kept_alive_lock:
+        _kept_alive.pop(key, None)
+    get_backend().release(key, INSTANCE_ID)
+
+
+# Leases kept alive by the renewal thread: ledger key -> (event loop, asyncio.Event set when the lease is lost)
+_kept_alive = {}
+_kept_alive_lock = threading.Lock()
+_renewal_thread = None
+
+
+def _renew_leases():
+    """Renew every kept alive lease each third of LEASE_TTL_SECONDS, runs in the renewal thread."""
+    while True:
+        time.sleep(LEASE_TTL_SECONDS / 3)
+        with _kept_alive_lock:
+            kept_alive = list(_kept_alive.items())
+        for key, entry in kept_alive:
+            # Leases released since the snapshot are not renewed
+            with _kept_alive_lock:
+                if _kept_alive.get(key) is not entry:
+                    continue
+            try:
+                renewed = get_backend().renew(key, INSTANCE_ID, LEASE_TTL_SECONDS)
+            except Exception as e:
+                # Try again on the next round, the lease is only lost once it was taken over
+                print(f"Could not renew the lease on {key}: {str(e)}")
+                continue
+            if not renewed:
+                with _kept_alive_lock:
+                    if _kept_alive.get(key) is not entry:
+                        # Released while it was renewed
+                        continue
+                    _kept_alive.pop(key)
+                loop, lost = entry
+                print(f"Lost the lease on {key}, another instance may be processing it")
+                metrics.increment("lease_lost_total")
+                loop.call_soon_threadsafe(lost.set)
+
+
+async def keep_alive(key, lost):
+    """
+    Keep the lease on an email renewed (from the renewal thread) until cancelled.
+
+    Args:
+        key (str): Ledger key of the email
+        lost (asyncio.Event): Set when a renewal fails, the caller should stop working on the email
+    """
+    global _renewal_thread
+    with _kept_alive_lock:
+        _kept_alive[key] = (asyncio.get_running_loop(), lost)
+        if _renewal_thread is None:
+            _renewal_thread = threading.Thread(target=_renew_leases, name='lease-renewal', daemon=True)
+            _renewal_thread.start()
+    try:
+        await lost.wait()
+    finally:
+        with _kept_alive_lock:
+            _kept_alive.pop(key, None)
@@ -0,0 +1,253 @@
+import json
+import sqlite3
+import hashlib
+import base64
+import datetime
+import threading
+from config import LEDGER_DB_PATH, LEDGER_STALE_SECONDS, LEDGER_MAX_ATTEMPTS, LEDGER_JOURNAL_MODE
+
+# PROCESSING STATES RECORDED PER EMAIL
+STATUS_PROCESSING = 'processing'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+STATUS_DEFERRED = 'deferred'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed_emails (
+    ledger_key TEXT PRIMARY KEY,
+    account TEXT,
+    message_id TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    attachment_hashes TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_emails_attachment_hashes ON processed_emails (attachment_hashes);
+
+-- Text extracted from every analysed attachment, so that a file sent again is not analysed again
+CREATE TABLE IF NOT EXISTS attachment_analyses (
+    attachment_hash TEXT PRIMARY KEY,
+    analysis_result TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+"""
+
+_connection = None
+_lock = threading.Lock()
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def get_connection():
+    """Open (once) the SQLite ledger database and make sure the schema exists."""
+    global _connection
+    if _connection is None:
+        with _lock:
+            if _connection is None:
+                connection = sqlite3.connect(LEDGER_DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+                connection.execute(f'PRAGMA journal_mode={LEDGER_JOURNAL_MODE}')
+                connection.executescript(SCHEMA)
+                _connection = connection
+    return _connection
+
+
+def ledger_key(msg):
+    """
+    Return the key an email is tracked under in the ledger.
+    The internetMessageId is the same in every mailbox the message was delivered to, so it is preferred over the Graph id.
+    """
+    return msg.get('internetMessageId') or msg.get('internet_message_id') or msg.get('id', '')
+
+
+def hash_attachment(content):
+    """
+    Compute the SHA-256 of an attachment's content.
+
+    Args:
+        content (bytes | str): Raw bytes or the base64 encoded contentBytes returned by Graph
+
+    Returns:
+        str: Hex digest of the decoded attachment bytes
+    """
+    if isinstance(content, str):
+        content = base64.b64decode(content)
+    return hashlib.sha256(content or b'').hexdigest()
+
+
+def get_status(key):
+    """Return the ledger row for an email as a dict, or None if the email has never been seen."""
+    connection = get_connection()
+    with _lock:
+        row = connection.execute(
+            "SELECT ledger_key, account, message_id, status, attempts, attachment_hashes, error, created_at, updated_at "
+            "FROM processed_emails WHERE ledger_key = ?", (key,)
+        ).fetchone()
+    if row is None:
+        return None
+    columns = ['ledger_key', 'account', 'message_id', 'status', 'attempts', 'attachment_hashes', 'error', 'created_at', 'updated_at']
+    return dict(zip(columns, row))
+
+
+def claim_email(key, account, message_id, leased=False):
+    """
+    Atomically claim an email for processing.
+
+    Returns False if the email was already completed (in this or another mailbox), if another
+    worker is still processing it, or if it already failed LEDGER_MAX_ATTEMPTS times. A "processing"
+    claim older than LEDGER_STALE_SECONDS is treated as abandoned (e.g. the process crashed) and may
+    be claimed again. With leased=True the caller holds the lease on the email (see leases.py), so a
+    "processing" claim belongs to an instance whose lease expired and is taken over straight away.
+
+    Returns:
+        bool: True if the caller now owns the email and should process it
+    """
+    connection = get_connection()
+    now = _now()
+    with _lock:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                "SELECT status, attempts, updated_at FROM processed_emails WHERE ledger_key = ?", (key,)
+            ).fetchone()
+
+            if row is not None:
+                status, attempts, updated_at = row
+                if status == STATUS_COMPLETED or (status == STATUS_FAILED and attempts >= LEDGER_MAX_ATTEMPTS):
+                    connection.execute('COMMIT')
+                    return False
+                if status == STATUS_PROCESSING and not leased:
+                    age = (now - datetime.datetime.fromisoformat(updated_at)).total_seconds()
+                    if age < LEDGER_STALE_SECONDS:
+                        connection.execute('COMMIT')
+                        return False
+
+                connection.execute(
+                    "UPDATE processed_emails SET status = ?, account = ?, message_id = ?, attempts = attempts + 1, error = NULL, updated_at = ? "
+                    "WHERE ledger_key = ?",
+                    (STATUS_PROCESSING, account, message_id, now.isoformat(), key)
+                )
+            else:
+                connection.execute(
+                    "INSERT INTO processed_emails (ledger_key, account, message_id, status, attempts, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 1, ?, ?)",
+                    (key, account, message_id, STATUS_PROCESSING, now.isoformat(), now.isoformat())
+                )
+            connection.execute('COMMIT')
+            return True
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+
+def _set_status(key, status, error=None):
+    connection = get_connection()
+    with _lock:
+        connection.execute(
+            "UPDATE processed_emails SET status = ?, error = ?, updated_at = ? WHERE ledger_key = ?",
+            (status, error, _now().isoformat(), key)
+        )
+
+
+def mark_completed(key):
+    _set_status(key, STATUS_COMPLETED)
+
+
+def mark_failed(key, error):
+    """Record a failed attempt. Failed emails are claimed again on the next poll until LEDGER_MAX_ATTEMPTS is reached."""
+    _set_status(key, STATUS_FAILED, str(error))
+
+
+def mark_deferred(key, reason):
+    """
+    Record that a claimed email was parked (see deferred.py). The claim is not counted as an attempt,
+    so waiting for the Safe Attachments scan does not use up LEDGER_MAX_ATTEMPTS.
+    """
+    connection = get_connection()
+    with _lock:
+        connection.execute(
+            "UPDATE processed_emails SET status = ?, error = ?, attempts = MAX(attempts - 1, 0), updated_at = ? WHERE ledger_key = ?",
+            (STATUS_DEFERRED, str(reason), _now().isoformat(), key)
+        )
+
+
+def record_attachment_hashes(key, attachment_hashes):
+    connection = get_connection()
+    with _lock:
+        connection.execute(
+            "UPDATE processed_emails SET attachment_hashes = ?, updated_at = ? WHERE ledger_key = ?",
+            (','.join(sorted(attachment_hashes)), _now().isoformat(), key)
+        )
+
+
+def find_completed_with_attachments(key, attachment_hashes):
+    """
+    Return the ledger key of the latest other completed email with exactly the same analysed attachments
+    (e.g. a certificate sent again in a new message), or None. Emails without attachments never match.
+    """
+    if not attachment_hashes:
+        return None
+    connection = get_connection()
+    with _lock:
+        row = connection.execute(
+            "SELECT ledger_key FROM processed_emails WHERE attachment_hashes = ? AND status = ? AND ledger_key != ? "
+            "ORDER BY updated_at DESC LIMIT 1",
+            (','.join(sorted(attachment_hashes)), STATUS_COMPLETED, key)
+        ).fetchone()
+    return row[0] if row is not None else None
+
+
+def get_attachment_analysis(attachment_hash):
+    """Return the text extraction result saved for an attachment that was analysed before, or None."""
+    connection = get_connection()
+    with _lock:
+        row = connection.execute(
+            "SELECT analysis_result FROM attachment_analyses WHERE attachment_hash = ?", (attachment_hash,)
+        ).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def save_attachment_analysis(attachment_hash, analysis_result):
+    """Save the text extraction result (see email_utils.extract_attachment_text) of an attachment by its hash."""
+    connection = get_connection()
+    with _lock:
+        connection.execute(
+            "INSERT OR REPLACE INTO attachment_analyses (attachment_hash, analysis_result, created_at) VALUES (?, ?, ?)",
+            (attachment_hash, json.dumps(analysis_result), _now().isoformat())
+        )
+
+
+def count_recent_claims():
+    """Return the number of emails claimed for processing within the last LEDGER_STALE_SECONDS."""
+    connection = get_connection()
+    since = (_now() - datetime.timedelta(seconds=LEDGER_STALE_SECONDS)).isoformat()
+    with _lock:
+        row = connection.execute(
+            "SELECT COUNT(*) FROM processed_emails WHERE status = ? AND updated_at >= ?", (STATUS_PROCESSING, since)
+        ).fetchone()
+    return row[0]
+
+
+def list_unfinished():
+    """Return the ledger rows of all emails that are not completed, oldest first."""
+    connection = get_connection()
+    with _lock:
+        rows = connection.execute(
+            "SELECT ledger_key, account, message_id, status, attempts, error, updated_at FROM processed_emails "
+            "WHERE status != ? ORDER BY updated_at", (STATUS_COMPLETED,)
+        ).fetchall()
+    columns = ['ledger_key', 'account', 'message_id', 'status', 'attempts', 'error', 'updated_at']
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def reset_email(key):
+    """Reset an email to a fresh failed state with no attempts so that it is claimed again."""
+    connection = get_connection()
+    with _lock:
+        connection.execute(
+            "UPDATE processed_emails SET status = ?, attempts = 0, updated_at = ? WHERE ledger_key = ?",
+            (STATUS_FAILED, _now().isoformat(), key)
+        )
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+import metrics
+from config import LOOP_STALL_THRESHOLD, LOOP_WATCHDOG_INTERVAL, LOOP_WATCHDOG_REPORT_INTERVAL
+
+# EVENT LOOP STALL DETECTOR
+# A heartbeat task on the event loop records when the loop last ran and how late its timer fired (the loop
+# lag). A sampling thread checks the heartbeat and, while the loop has not run for LOOP_STALL_THRESHOLD
+# seconds, samples the stack of the loop thread. The blocking call site of every sample is charged the
+# time between two samples, so the report shows which calls froze the loop and for how long in total.
+#
+#   python main.py watchdog        - process emails with the watchdog running
+#   python bench.py <fixture> --watchdog
+
+# Directory of the project, call sites in the project are preferred over library frames
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Number of frames of the stack printed when a stall is logged
+STACK_DEPTH = 8
+
+
+def _format_frame(frame):
+    filename = os.path.relpath(frame.filename, PROJECT_DIR) if frame.filename.startswith(PROJECT_DIR) else os.path.basename(frame.filename)
+    return f"{filename}:{frame.lineno} in {frame.name}"
+
+
+def _call_site(stack):
+    """
+    Describe where the loop is blocked: the two innermost project frames (the caller and the blocking call)
+    followed by the library function the loop is in, e.g. "main.py:95 in stage_triage -> functions.py:40 in
+    create_chat_completion -> _base_client.py:1012 in request".
+    """
+    project_frames = [frame for frame in stack
+                      if frame.filename.startswith(PROJECT_DIR) and not frame.filename.endswith('loop_watchdog.py')]
+    frames = project_frames[-2:]
+    if not frames or stack[-1] is not frames[-1]:
+        frames.append(stack[-1])
+    return " -> ".join(_format_frame(frame) for frame in frames)
+
+
+class LoopWatchdog:
+    """Measures the event loop lag and names the calls that block the loop."""
+
+    def __init__(self, threshold=LOOP_STALL_THRESHOLD, interval=LOOP_WATCHDOG_INTERVAL):
+        """
+        Args:
+            threshold (float): Seconds without a heartbeat after which the loop counts as stalled
+            interval (float): Seconds between heartbeats, also the sampling interval
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.blocking_time = {}
+        self.stall_count = 0
+        self._lock = threading.Lock()
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._heartbeat_task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            metrics.observe("event_loop_lag_seconds", max(0.0, now - expected))
+            with self._lock:
+                self._last_beat = now
+
+    def _sample(self):
+        stall_started = None
+        stall_sites = {}
+        last_report = time.monotonic()
+
+        while not self._stopped.wait(self.interval):
+            now = time.monotonic()
+            with self._lock:
+                since_beat = now - self._last_beat
+
+            if since_beat > self.threshold + self.interval:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                stack = traceback.extract_stack(frame)
+                site = _call_site(stack)
+                if stall_started is None:
+                    # Charge the part of the stall that happened before it was detected as well
+                    stall_started = self._last_beat
+                    stall_sites = {site: (since_beat, stack)}
+                else:
+                    previous = stall_sites.get(site, (0.0, stack))[0]
+                    stall_sites[site] = (previous + self.interval, stack)
+            elif stall_started is not None:
+                self._record_stall(now - stall_started, stall_sites)
+                stall_started = None
+                stall_sites = {}
+
+            if LOOP_WATCHDOG_REPORT_INTERVAL and now - last_report >= LOOP_WATCHDOG_REPORT_INTERVAL:
+                self.print_report()
+                last_report = now
+
+    def _record_stall(self, duration, stall_sites):
+        """Log a finished stall with the call site that blocked the loop the longest."""
+        with self._lock:
+            self.stall_count += 1
+            for site, (seconds, _) in stall_sites.items():
+                self.blocking_time[site] = self.blocking_time.get(site, 0.0) + seconds
+
+        metrics.increment("event_loop_stalls_total")
+        metrics.observe("event_loop_stall_seconds", duration)
+
+        site, (_, stack) = max(stall_sites.items(), key=lambda item: item[1][0])
+        print(f">> Event loop stalled for {duration:.2f} s, blocked in {site}")
+        for line in traceback.format_list(stack[-STACK_DEPTH:]):
+            print("   " + line.rstrip().replace("\n", "\n   "))
+
+    def top_sites(self, count=10):
+        """Return the (call site, cumulative stall seconds) pairs that blocked the loop the longest."""
+        with self._lock:
+            return sorted(self.blocking_time.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def print_report(self, count=10):
+        sites = self.top_sites(count)
+        if not sites:
+            print(">> Event loop watchdog: no stalls")
+            return
+        print(f">> Event loop watchdog: {self.stall_count} stalls over {self.threshold} s, top blocking call sites:")
+        for site, seconds in sites:
+            print(f"   {seconds:8.2f} s  {site}")
+
+    def start(self):
+        """Start the heartbeat on the running loop and the sampling thread. Call from inside the loop."""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._heartbeat_task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._sample, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        if self._thread is not None:
+            self._thread.join()
@@ -1,373 +1,692 @@
 import sys
 import time
 import asyncio
-from email_processor.email_client import get_access_token, fetch_unread_emails, forward_email, mark_email_as_read, force_mark_emails_as_read
-from email_processor.email_utils import generate_llm_text
-from config import EMAIL_ACCOUNTS, EMAIL_FETCH_INTERVAL, DEFAULT_EMAIL_ACCOUNT
+import importlib
+from email_processor.email_client import get_access_token, fetch_unread_messages, fetch_message, forward_email, mark_email_as_read, force_mark_emails_as_read, scan_in_progress, message_size
+from email_processor.email_utils import render_email_context, create_email_details, fetch_attachments, get_document_client
+from email_processor.email_context import EmailContext
+from config import EMAIL_ACCOUNTS, EMAIL_FETCH_INTERVAL, DEFAULT_EMAIL_ACCOUNT, MARK_PROCESSED_AS_READ, FORWARD_EMAILS, DEFAULT_FORWARD_TO, METRICS_PORT, BUDGET_SOFT_LIMIT, BUDGET_THROTTLE_DELAY, ACCOUNT_MAX_CONCURRENCY, ACCOUNT_WEIGHTS, LOOP_WATCHDOG, DEFER_MAX_AGE, DETERMINISTIC_EXTRACTION, EXTRACTOR_MIN_CONFIDENCE, EXTRACTION_CASCADE, CASCADE_CHEAP_MODEL, CASCADE_REQUIRED_FIELDS, CPU_EXECUTOR, FULL_TRAIL_SEARCH
+from config import PRIORITY_SLA_SECONDS, PRIORITY_LARGE_EMAIL_BYTES, PRIORITY_TRACKER_WEIGHTS, DRAIN_BACKLOG_THRESHOLD, DRAIN_EXIT_BACKLOG, DRAIN_MAX_CONCURRENCY, GRAPH_MAILBOX_CONCURRENCY, LEASE_BACKEND
 import datetime
 import json
 import os
 from functions import * 
 import extraction_templates
+import certificate_extractors
 import functions as func
+import ledger
+import checkpoints
+import metrics
+import usage
+import leases
+import deferred
+import breakers
+import executor
+from scheduler import FairScheduler
+from loop_watchdog import LoopWatchdog
 
 
+# (account, message_id) PAIRS THAT THE LEDGER HAS AS COMPLETED BUT THAT ARE STILL UNREAD IN THE MAILBOX
 processed_but_unread = set()
 
-client = get_openai_client()
 
+BATCH_SIZE = 3  # Process 3 emails at a time (over all mailboxes) - Cap for MS Graph
 
-BATCH_SIZE = 3  # Process 3 emails at a time - Cap for MS Graph
+# PRIORITY CLASSES OF THE QUEUED EMAILS, LOWER GOES FIRST
+PRIORITY_FRESH = 0
+PRIORITY_FRESH_LARGE = 1
+PRIORITY_BACKLOG = 2
+PRIORITY_BACKLOG_LARGE = 3
 
-async def process_email(access_token, account, email_data, message_id):
+# True while the backlog is drained with DRAIN_MAX_CONCURRENCY workers
+draining = False
+
+# Mailboxes fetched at least once in the current cycle
+polled_mailboxes = set()
+
+NOT_FOUND_CERTIFICATE_DETAILS = ["vin_number", "engine_number", "registration_number", "vehicle_year", "vehicle_make", "vehicle_model", "contract_number", "fitment_date", "product_name"]
+
+VALIDATION_UNSUCCESSFUL_FIELDS = ['year', 'make', 'model', 'colour', 'registrationNumber', 'vinNumber', 'engineNumber', 'riskItemSequenceNumber', 'coverTypeDescription', 'statusDescription', 'vehicleActiveIndicator']
+
+
+# Reason an email is parked while Defender Safe Attachments scans its attachments
+SCAN_IN_PROGRESS = "Safe Attachments scan in progress"
+
+# Reason prefix of an email parked while the circuit breaker of a dependency is open, followed by the dependency
+DEPENDENCY_UNAVAILABLE = "Dependency unavailable: "
+
+
+# Email details kept after the context stage (used to forward the email)
+EMAIL_DATA_KEYS = ['email_id', 'internet_message_id', 'to', 'from', 'date_received', 'cc', 'subject', 'attachment_metadata', 'attachment_hashes']
+
+
+# PIPELINE STAGES
+# Every stage receives the email state (dict) and a list to append non-fatal errors to, and returns a dict
+# of outputs that is merged into the state and saved as the stage checkpoint. A stage that raises stops the
+# pipeline for this attempt. A stage that reported errors is not checkpointed, so it is rerun on the next attempt.
+
+async def stage_context(state, errors):
+    """Download the attachments, extract their text using Document Intelligence and build the LLM context."""
+    msg = state["msg"]
+    attachments = await fetch_attachments(state["access_token"], state["account"], msg['id']) if msg.get('hasAttachments', True) else []
+    if scan_in_progress(attachments):
+        # Only the placeholder of the attachments is available, park the email before anything is downloaded
+        raise deferred.DeferEmail(SCAN_IN_PROGRESS)
+    
+    email_data = await create_email_details(state["access_token"], state["account"], msg, attachments)
+    ledger.record_attachment_hashes(state["ledger_key"], email_data['attachment_hashes'])
+    
+    # Build the context shared by all the model calls, the body HTML and the per-page OCR output are not kept
+    context = await executor.run_cpu(render_email_context, email_data)
+    email_data = {key: email_data[key] for key in EMAIL_DATA_KEYS}
+    
+    return {"email_data": email_data, "context": context}
+
+
+async def search_full_trail(context, extract, call_type, account, tracker_company):
     """
-    Process a single email: extract all information including attachment text using Document Intelligence,
-    categorize it, forward it, mark as read, and log it.
+    Extract a value that is not in the latest message from the whole email thread (the quoted history
+    is left out of the prompts). Returns the parsed result, None if the email has no quoted history.
+    Only used when FULL_TRAIL_SEARCH is enabled and neither the policy number nor the ID number was found.
     """
+    trail_context = context.with_full_trail()
+    if trail_context is None:
+        return None
     
-    print(f"Processing email with subject: {email_data['subject']}")
-    
-    start_time = datetime.datetime.now()
+    response = await extract(trail_context)
+    usage.record_usage(response, call_type, account, tracker_company)
+    result = json.loads(response.choices[0].message.content)
+    metrics.increment("full_trail_searches_total", call_type=call_type, result="not_found" if result.get(call_type) == "not_found" else "found")
+    return result
+
 
+async def stage_triage(state, errors):
+    """Classify the tracker company and extract the policy number and ID number from the email context."""
+    context = state["context"]
+    account = state["account"]
+    ava_compiliation = {}
+    
+    # STEP 1: Pass the email_data to a GPT-4o model to classify the tracker company
     try:
-        # Generate the complete LLM text (JSON) including email details and attachment content
-        llm_text = generate_llm_text(email_data)
-               
-        # Parse the JSON to get summary information for logging
-        llm_data = json.loads(llm_text)
-        
-        # STEP 1: Pass the email_data to a GPT-4o model to classify the tracker company
-        ava_compiliation = {}
-        ava_result = {}
+        tracker_company_response = await func.get_tracking_company(context, model=usage.select_model('gpt-4o'))
+                    
+        result = tracker_company_response.choices[0].message.content
+        result = json.loads(result)
+        ava_compiliation.update(result)
         
-        try:
-            tracker_company_response = get_tracking_company(llm_data)
-                        
-            result = tracker_company_response.choices[0].message.content
-            result = json.loads(result)
-            ava_compiliation.update(result)
-            
-            tracker_company_input_tokens = tracker_company_response.usage.prompt_tokens
-            tracker_company_completion_tokens = tracker_company_response.usage.completion_tokens
-            tracker_company_output_tokens = tracker_company_response.usage.total_tokens
-            tracker_company_cached_tokens = tracker_company_response.usage.cached_tokens if hasattr(tracker_company_response.usage, 'cached_tokens') else None
+        usage.record_usage(tracker_company_response, "tracker_company", account, ava_compiliation.get("tracker_company"))
 
-        except Exception as e:
-            print(f"Error obtain the tracker company using gpt4o: {str(e)}")
-            ava_compiliation.update({"tracker_company": "error"})
+    except Exception as e:
+        print(f"Error obtain the tracker company using gpt4o: {str(e)}")
+        ava_compiliation.update({"tracker_company": "error"})
+        errors.append("tracker_company")
 
-        ## STEP 2: EXTRACT A POLICY NUMBER FROM THE EMAIL CONTEXT
-                    
-        try:
-            polno_response = get_policy_number(llm_data)
-            
-            result = polno_response.choices[0].message.content
-            result = json.loads(result)
-            ava_compiliation.update(result)
-            
-            polno_input_tokens = polno_response.usage.prompt_tokens
-            polno_completion_tokens = polno_response.usage.completion_tokens
-            polno_output_tokens = polno_response.usage.total_tokens
-            polno_cached_tokens = polno_response.usage.cached_tokens if hasattr(polno_response.usage, 'cached_tokens') else None
+    ## STEP 2: EXTRACT A POLICY NUMBER FROM THE EMAIL CONTEXT
+    try:
+        polno_response = await func.get_policy_number(context)
         
-        except Exception as e:
-            print(f"Error obtaining the policy number from the mail context: {str(e)}")
-            ava_compiliation.update({"policy_number": "error"})
+        result = polno_response.choices[0].message.content
+        result = json.loads(result)
+        ava_compiliation.update(result)
+        
+        usage.record_usage(polno_response, "policy_number", account, ava_compiliation.get("tracker_company"))
+    
+    except Exception as e:
+        print(f"Error obtaining the policy number from the mail context: {str(e)}")
+        ava_compiliation.update({"policy_number": "error"})
+        errors.append("policy_number")
 
+    # STEP 3 - GET THE ID NUMBER
+    try:
+        idNumber_response = await func.get_id_number(context)
+        result = idNumber_response.choices[0].message.content
+        result = json.loads(result)
+        ava_compiliation.update(result)
         
-        # STEP 3 - GET THE ID NUMBER
-        try:
-            idNumber_response = get_id_number(llm_data)
-            result = idNumber_response.choices[0].message.content
-            result = json.loads(result)
-            ava_compiliation.update(result)
-            
-            idNumber_input_tokens = idNumber_response.usage.prompt_tokens
-            idNumber_completion_tokens = idNumber_response.usage.completion_tokens
-            idNumber_output_tokens = idNumber_response.usage.total_tokens
-            idNumber_cached_tokens = idNumber_response.usage.cached_tokens if hasattr(idNumber_response.usage, 'cached_tokens') else None
-            
-        except Exception as e:
-            print(f"Error obtaining the ID number from the mail context: {str(e)}")
-            ava_compiliation.update({"id_number": "error"})
-         
+        usage.record_usage(idNumber_response, "id_number", account, ava_compiliation.get("tracker_company"))
         
-        # STEP 4 - EXTRACT THE CERTIFICATE DETAILS
-        try:
-            if ava_compiliation['tracker_company'] in extraction_templates.available_tempates:
-                
-                cert_response = extract_details(llm_data, extraction_templates.templates[ava_compiliation['tracker_company']])
-                result = cert_response.choices[0].message.content
-                result = json.loads(result)
-                
-                
-                cert_input_tokens = cert_response.usage.prompt_tokens
-                cert_completion_tokens = cert_response.usage.completion_tokens
-                cert_output_tokens = cert_response.usage.total_tokens
-                cert_cached_tokens = cert_response.usage.cached_tokens if hasattr(cert_response.usage, 'cached_tokens') else None
-                
-                for key in result:
-                    ava_compiliation.update({key: result[key]})
-                
-                
-                # Compile the vehicle key string for similarity check
-                
-                # YEAR, MAKE AND MODEL AVAILABLE
-                if ava_compiliation["vehicle_year"] != "not_found" and ava_compiliation["vehicle_make"] != "not_found" and ava_compiliation["vehicle_model"] != "not_found":
-                    ava_compiliation.update({"vehicle_key": (ava_compiliation["vehicle_year"].lower() + ava_compiliation["vehicle_make"].lower() + ava_compiliation["vehicle_model"].lower()).replace(" ", "")})
+    except Exception as e:
+        print(f"Error obtaining the ID number from the mail context: {str(e)}")
+        ava_compiliation.update({"id_number": "error"})
+        errors.append("id_number")
+    
+    # STEP 3B - THE LOOKUP NEEDS ONE OF THE NUMBERS, WHEN NEITHER IS IN THE LATEST MESSAGE THEY MAY BE FURTHER DOWN THE EMAIL TRAIL
+    if FULL_TRAIL_SEARCH and ava_compiliation.get("policy_number") == "not_found" and ava_compiliation.get("id_number") == "not_found":
+        for call_type, extract in [("policy_number", func.get_policy_number), ("id_number", func.get_id_number)]:
+            try:
+                result = await search_full_trail(context, extract, call_type, account, ava_compiliation.get("tracker_company"))
+            except Exception as e:
+                print(f"Error searching the email trail for the {call_type}: {str(e)}")
+                ava_compiliation.update({call_type: "error"})
+                errors.append(call_type)
+                break
+            if result is None:
+                # The email has no quoted history
+                break
+            if result.get(call_type, "not_found") != "not_found":
+                ava_compiliation.update({call_type: result[call_type]})
+                break
+    
+    return {"ava_compiliation": ava_compiliation}
+
+
+async def extract_with_model(context, tracker_company, model, fields, account):
+    """Extract the given certificate fields with one model call, returns the details of those fields."""
+    all_fields = len(fields) == len(certificate_extractors.CERTIFICATE_FIELDS)
+    cert_response = await func.extract_details(context, extraction_templates.templates[tracker_company], model=model, fields=None if all_fields else fields)
+    result = cert_response.choices[0].message.content
+    result = json.loads(result)
+    
+    usage.record_usage(cert_response, "certificate_details", account, tracker_company)
+    
+    return {key: value for key, value in result.items() if key in fields}
+
+
+async def extract_with_models(context, tracker_company, fields, account):
+    """
+    Extract the given certificate fields with the extraction model.
+    
+    With EXTRACTION_CASCADE the cheap model extracts the fields first and only the fields that fail
+    validation (see certificate_extractors.invalid_fields) are extracted again with gpt-4o.
+    """
+    model = usage.select_model('gpt-4o')
+    if not EXTRACTION_CASCADE or model == CASCADE_CHEAP_MODEL:
+        return await extract_with_model(context, tracker_company, model, fields, account)
+    
+    details = await extract_with_model(context, tracker_company, CASCADE_CHEAP_MODEL, fields, account)
+    escalated = [field for field in certificate_extractors.invalid_fields(details, CASCADE_REQUIRED_FIELDS) if field in fields]
+    
+    metrics.increment("extraction_cascade_total", tracker_company=tracker_company, result="escalated" if escalated else "accepted")
+    for field in escalated:
+        metrics.increment("extraction_cascade_escalated_fields_total", tracker_company=tracker_company, field=field)
+    
+    if escalated:
+        print(f"Escalating {', '.join(escalated)} to {model} for {tracker_company}")
+        details.update(await extract_with_model(context, tracker_company, model, escalated, account))
+    return details
+
+
+def previous_certificate_details(state, tracker_company):
+    """
+    Return (details, confidence) extracted for the latest completed email with exactly the same attachments
+    and tracker company (the same certificate sent again in a new message), or None.
+    """
+    previous_key = ledger.find_completed_with_attachments(state["ledger_key"], state["email_data"].get("attachment_hashes"))
+    if previous_key is None:
+        return None
+    previous = checkpoints.load_checkpoints(previous_key).get("extraction")
+    if previous is None or previous["ava_compiliation"].get("tracker_company") != tracker_company:
+        return None
+    
+    print(f"Reusing the certificate details of {previous_key}, the attachments are the same")
+    details = {key: previous["ava_compiliation"].get(key, "not_found") for key in NOT_FOUND_CERTIFICATE_DETAILS}
+    return details, previous["ava_compiliation"].get("extraction_confidence", {})
+
+
+async def stage_extraction(state, errors):
+    """
+    Extract the certificate details using the template of the classified tracker company. The details of an
+    earlier email with the same attachments are reused without any model call.
+    """
+    context = state["context"]
+    ava_compiliation = dict(state["ava_compiliation"])
+    
+    # STEP 4 - EXTRACT THE CERTIFICATE DETAILS
+    try:
+        tracker_company = ava_compiliation['tracker_company']
+        if tracker_company in extraction_templates.available_tempates:
+            
+            previous = previous_certificate_details(state, tracker_company)
+            if previous is not None:
+                details, confidence = previous
+                low_confidence = []
+                method = "reused"
+            else:
+                # Read the labelled fields of the certificate, only the fields read with a low confidence go to the model
+                details, confidence = {}, {}
+                if DETERMINISTIC_EXTRACTION:
+                    details, confidence = certificate_extractors.extract_certificate_fields(tracker_company, certificate_extractors.context_texts(context))
+                low_confidence = [field for field in certificate_extractors.CERTIFICATE_FIELDS if confidence.get(field, 0) < EXTRACTOR_MIN_CONFIDENCE]
                 
-                # MAKE AND MODEL AVAILABLE ONLY
-                elif ava_compiliation["vehicle_make"] != "not_found" and ava_compiliation["vehicle_model"] != "not_found":
-                    ava_compiliation.update({"vehicle_key": (ava_compiliation["vehicle_make"].lower() + ava_compiliation["vehicle_model"].lower()).replace(" ", "")})
-                           
-                else:
-                    ava_compiliation.update({"vehicle_key": "not_found"})
+                if low_confidence:
+                    details.update(await extract_with_models(context, tracker_company, low_confidence, state["account"]))
                 
-            else: 
-                print(f"Template not available for {ava_compiliation['tracker_company']}")
-                ava_compiliation.update({"vin_number": "not_found"})
-                ava_compiliation.update({"engine_number": "not_found"})
-                ava_compiliation.update({"registration_number": "not_found"})
-                ava_compiliation.update({"vehicle_year": "not_found"})
-                ava_compiliation.update({"vehicle_make": "not_found"})
-                ava_compiliation.update({"vehicle_model": "not_found"})
-                ava_compiliation.update({"contract_number": "not_found"})
-                ava_compiliation.update({"fitment_date": "not_found"})
-                ava_compiliation.update({"product_name": "not_found"})
+                method = "model" if len(low_confidence) == len(certificate_extractors.CERTIFICATE_FIELDS) else "layout_and_model" if low_confidence else "layout"
+            metrics.increment("certificate_extraction_total", tracker_company=tracker_company, method=method)
+            for field in low_confidence:
+                metrics.increment("certificate_fields_to_model_total", tracker_company=tracker_company, field=field)
+            
+            for key in details:
+                ava_compiliation.update({key: details[key]})
+            if confidence:
+                ava_compiliation.update({"extraction_confidence": confidence})
+            
+            # Compile the vehicle key string for similarity check
+            
+            # YEAR, MAKE AND MODEL AVAILABLE
+            if ava_compiliation["vehicle_year"] != "not_found" and ava_compiliation["vehicle_make"] != "not_found" and ava_compiliation["vehicle_model"] != "not_found":
+                ava_compiliation.update({"vehicle_key": (ava_compiliation["vehicle_year"].lower() + ava_compiliation["vehicle_make"].lower() + ava_compiliation["vehicle_model"].lower()).replace(" ", "")})
+            
+            # MAKE AND MODEL AVAILABLE ONLY
+            elif ava_compiliation["vehicle_make"] != "not_found" and ava_compiliation["vehicle_model"] != "not_found":
+                ava_compiliation.update({"vehicle_key": (ava_compiliation["vehicle_make"].lower() + ava_compiliation["vehicle_model"].lower()).replace(" ", "")})
+                       
+            else:
                 ava_compiliation.update({"vehicle_key": "not_found"})
-                
-        except Exception as e:
-            print(f"Error obtaining the certificate details from the mail context: {str(e)}")
-            ava_compiliation.update({"vin_number": "error"})
-            ava_compiliation.update({"engine_number": "error"})
-            ava_compiliation.update({"registration_number": "error"})
-            ava_compiliation.update({"vehicle_year": "error"})
-            ava_compiliation.update({"vehicle_make": "error"})
-            ava_compiliation.update({"vehicle_model": "error"})
-            ava_compiliation.update({"contract_number": "error"})
-            ava_compiliation.update({"fitment_date": "error"})
-            ava_compiliation.update({"product_name": "error"})
+            
+        else: 
+            print(f"Template not available for {ava_compiliation['tracker_company']}")
+            for key in NOT_FOUND_CERTIFICATE_DETAILS:
+                ava_compiliation.update({key: "not_found"})
             ava_compiliation.update({"vehicle_key": "not_found"})
+            
+    except Exception as e:
+        print(f"Error obtaining the certificate details from the mail context: {str(e)}")
+        for key in NOT_FOUND_CERTIFICATE_DETAILS:
+            ava_compiliation.update({key: "error"})
+        ava_compiliation.update({"vehicle_key": "not_found"})
+        errors.append("certificate_details")
 
-        print(ava_compiliation)
-        
-        try:
-            ## GET A TOKEN FROM THE TOKEN SERVICE
-            token =func.get_token()
+    print(ava_compiliation)
+    
+    return {"ava_compiliation": ava_compiliation}
 
-        except Exception as e:
-            print(f"Error obtaining the token from the token service: {str(e)}")
+
+async def stage_lookup(state, errors):
+    """
+    Look up the vehicles on the customer's policies on the AS400 using the policy number or the ID number.
+    
+    The ESB calls block, so they are run in a thread to keep the event loop free for the other workers.
+    """
+    ava_compiliation = state["ava_compiliation"]
+    
+    ## GET A TOKEN FROM THE TOKEN SERVICE
+    token = await asyncio.to_thread(func.get_token)
+    
+    # STEP 5 - CALL AS400 TO GET VEHICLE DETAILS
+    ## ATTEMPT 1 : TRY WITH POLICY NUMBER
+    if ava_compiliation["policy_number"] not in ['not_found', '']: 
+        
+        print(f"Attempting to use policy number to get vehicle details")
+        
+        # USE THE POLICY NUMBER TO GET THE VEHICLES DETAILS ON THE POLICY 
+        vehicles_list = await asyncio.to_thread(func.get_vehicles, token, ava_compiliation["policy_number"])
         
+        return {"ava_lookup_method": "policy_number", "vehicle_lists": [vehicles_list]}
+    
+    elif ava_compiliation["id_number"] not in ['not_found', '']: 
         
-        try: 
-            # STEP 5 - CALL AS400 TO GET VEHICLE DETAILS
-            ## ATTEMPT 1 : TRY WITH POLICY NUMBER
+        # USE THE ID NUMBER TO GET THE LIST OF ACTIVE POLICIES
+        response = await asyncio.to_thread(func.get_active_policies, ava_compiliation["id_number"], token)
+
+        # SUCCESSFUL RESPONSE
+        if response["response_code"] == 200:
+            activePolices = response["activePolicies"]
             
-            if ava_compiliation["policy_number"] not in ['not_found', '']: 
-                
-                print(f"Attempting to use policy number to get vehicle details")
-                
-                ava_result.update({"ava_lookup_method":"policy_number"})
-                
-                # USE THE POLICY NUMBER TO GET THE VEHICLES DETAILS ON THE POLICY 
-                vehicles_list = func.get_vehicles(token, ava_compiliation["policy_number"])
-                                
-                # UNPACK THE VEHICLE LIST
-                for vehicle_sequence in vehicles_list:
-                    
-                    # CREATE THE VEHICLE KEY STRING FOR SIMILARITY CHECK
-                    # CHECK IF THE VEHICLE MAKE IS INCLUDED IN THE MODEL LISTING - SOMETIME THE MODEL STRING HAS THE MAKE STRING INCLUDED WHICH CREATES A DUPLICATE THAT THROWS OFF THE SIMILARITY MATCH
-                    if vehicles_list[vehicle_sequence]["make"].lower() in vehicles_list[vehicle_sequence]["model"].lower():
-                        # IF MODEL STRING INCLUDES MAKE STRING THEN STRIP OUT THE MAKE STRING FROM THE MODEL STRING
-                        as400_vehicle_string = vehicles_list[vehicle_sequence]["year"].lower() + vehicles_list[vehicle_sequence]["make"].lower() + vehicles_list[vehicle_sequence]["model"].lower().replace(vehicles_list[vehicle_sequence]["make"].lower(), "")
-                    else:
-                        # OTHERWISE CONCATENATE THE YEAR, MAKE AND MODEL STRINGS
-                        as400_vehicle_string = vehicles_list[vehicle_sequence]["year"].lower() + vehicles_list[vehicle_sequence]["make"].lower() + vehicles_list[vehicle_sequence]["model"].lower()
-                        
-                    as400_vehicle_string = as400_vehicle_string.replace(" ", "")
-                    
-                    text_similarity_score = func.text_similarity_score(ava_compiliation["vehicle_key"], as400_vehicle_string, SentenceTransformer('all-MiniLM-L6-v2'))
-                    print(f"Extracted vehicle key",ava_compiliation["vehicle_key"])
-                    print(f"AS400 vehicle key",as400_vehicle_string)
-                    print(f"Text similarity score", text_similarity_score)
-                                        
-                    # MATCH ATTEMPT 1 - USE VIN
-                    if ava_compiliation["vin_number"].replace(" ", "").lower() == vehicles_list[vehicle_sequence]["vinNumber"].replace(" ", "").lower():
-                        for key in vehicles_list[vehicle_sequence]:
-                            ava_result.update({key:vehicles_list[vehicle_sequence][key]})
-                            ava_result.update({"ava_validation_method":"VIN NUMBER"})
-                    
-                    # MATCH ATTEMPT 2 - USE ENGINE NUMBER        
-                    elif ava_compiliation["engine_number"].replace(" ", "").lower() == vehicles_list[vehicle_sequence]["engineNumber"].replace(" ", "").lower():
-                        for key in vehicles_list[vehicle_sequence]:
-                            ava_result.update({key:vehicles_list[vehicle_sequence][key]})   
-                            ava_result.update({"ava_validation_method":"ENGINE NUMBER"})
-                            
-                    # MATCH ATTEMPT 3 - USE REGISTRATION NUMBER
-                    elif ava_compiliation["registration_number"].strip().lower() == vehicles_list[vehicle_sequence]["registrationNumber"].strip().lower():
-                        for key in vehicles_list[vehicle_sequence]:
-                            ava_result.update({key:vehicles_list[vehicle_sequence][key]})
-                            ava_result.update({"ava_validation_method":"REGISTRATION NUMBER"})
-                    
-                    # MATCH ATTEMPT 4 - USE VEHICLE YEAR, MAKE AND MODEL
-                    elif text_similarity_score > 0.8:
-                        for key in vehicles_list[vehicle_sequence]:
-                            ava_result.update({key:vehicles_list[vehicle_sequence][key]})
-                            ava_result.update({"ava_validation_method":"TEXT SIMILARITY"})
-                    
-                    # NO MATCHES FOUND
-                    else:
-                        ava_result.update({'year': 'validation_unsuccessfull'})
-                        ava_result.update({'make': 'validation_unsuccessfull'})
-                        ava_result.update({'model': 'validation_unsuccessfull'})
-                        ava_result.update({'colour': 'validation_unsuccessfull'})
-                        ava_result.update({'registrationNumber': 'validation_unsuccessfull'})
-                        ava_result.update({'vinNumber': 'validation_unsuccessfull'})
-                        ava_result.update({'engineNumber': 'validation_unsuccessfull'})
-                        ava_result.update({'riskItemSequenceNumber': 'validation_unsuccessfull'})
-                        ava_result.update({'coverTypeDescription': 'validation_unsuccessfull'})
-                        ava_result.update({'statusDescription': 'validation_unsuccessfull'})
-                        ava_result.update({'vehicleActiveIndicator': 'validation_unsuccessfull'})
-                        ava_result.update({"ava_validation_method":"validation_unsuccessfull"})
+            # GET THE VEHICLES ON ALL THE ACTIVE POLICIES TO FIND A MATCH ON THE TRACKER DOCUMENT
+            vehicle_lists = [await asyncio.to_thread(func.get_vehicles, token, policyNumber) for policyNumber in activePolices]
             
-            elif ava_compiliation["id_number"] not in ['not_found', '']: 
-                ava_result.update({"ava_lookup_method":"id_number"})
-                
-                
-                # USE THE ID NUMBER TO GET THE LIST OF ACTIVE POLICIES
-                response = func.get_active_policies(ava_compiliation["id_number"],token)
+            return {"ava_lookup_method": "id_number", "vehicle_lists": vehicle_lists}
+        
+        else:
+            # Handle errors for failed requests for activePolicy numbers
+            print(f"There was an error getting the active policies with the provided ID Number")
+            errors.append("active_policies")
+            
+            return {"ava_lookup_method": "id_number", "vehicle_lists": []}
+    
+    return {"ava_lookup_method": None, "vehicle_lists": []}
 
-                # SUCCESSFUL RESPONSE
-                if response["response_code"] == 200:
-                    activePolices = response["activePolicies"]
-                    
-                    # RUN A LOOP TO GO THROUGH ALL THE ACTIVE POLICIES TO FIND A MATCH ON THE TRACKER DOCUMENT
-                    for policyNumber in activePolices:
-                        vehicles_list = func.get_vehicles(token, policyNumber)
-                        
-                        # UNPACK THE VEHICLE LIST
-                        for vehicle_sequence in vehicles_list:
-                            
-                            # CREATE THE VEHICLE KEY STRING FOR SIMILARITY CHECK
-                            # CHECK IF THE VEHICLE MAKE IS INCLUDED IN THE MODEL LISTING - SOMETIME THE MODEL STRING HAS THE MAKE STRING INCLUDED WHICH CREATES A DUPLICATE THAT THROWS OFF THE SIMILARITY MATCH
-                            if vehicles_list[vehicle_sequence]["make"].lower() in vehicles_list[vehicle_sequence]["model"].lower():
-                                # IF MODEL STRING INCLUDES MAKE STRING THEN STRIP OUT THE MAKE STRING FROM THE MODEL STRING
-                                as400_vehicle_string = vehicles_list[vehicle_sequence]["year"].lower() + vehicles_list[vehicle_sequence]["make"].lower() + vehicles_list[vehicle_sequence]["model"].lower().replace(vehicles_list[vehicle_sequence]["make"].lower(), "")
-                            else:
-                                # OTHERWISE CONCATENATE THE YEAR, MAKE AND MODEL STRINGS
-                                as400_vehicle_string = vehicles_list[vehicle_sequence]["year"].lower() + vehicles_list[vehicle_sequence]["make"].lower() + vehicles_list[vehicle_sequence]["model"].lower()
-                                
-                            as400_vehicle_string = as400_vehicle_string.replace(" ", "")
-                            
-                            text_similarity_score = func.text_similarity_score(ava_compiliation["vehicle_key"], as400_vehicle_string, SentenceTransformer('all-MiniLM-L6-v2'))
-                            print(f"Extracted vehicle key",ava_compiliation["vehicle_key"])
-                            print(f"AS400 vehicle key",as400_vehicle_string)
-                            print(f"Text similarity score", text_similarity_score)
-                                                
-                            # MATCH ATTEMPT 1 - USE VIN
-                            if ava_compiliation["vin_number"].replace(" ", "").lower() == vehicles_list[vehicle_sequence]["vinNumber"].replace(" ", "").lower():
-                                for key in vehicles_list[vehicle_sequence]:
-                                    ava_result.update({key:vehicles_list[vehicle_sequence][key]})
-                                    ava_result.update({"ava_validation_method":"VIN NUMBER"})
-                            
-                            # MATCH ATTEMPT 2 - USE ENGINE NUMBER        
-                            elif ava_compiliation["engine_number"].replace(" ", "").lower() == vehicles_list[vehicle_sequence]["engineNumber"].replace(" ", "").lower():
-                                for key in vehicles_list[vehicle_sequence]:
-                                    ava_result.update({key:vehicles_list[vehicle_sequence][key]})   
-                                    ava_result.update({"ava_validation_method":"ENGINE NUMBER"})
-                                    
-                            # MATCH ATTEMPT 3 - USE REGISTRATION NUMBER
-                            elif ava_compiliation["registration_number"].strip().lower() == vehicles_list[vehicle_sequence]["registrationNumber"].strip().lower():
-                                for key in vehicles_list[vehicle_sequence]:
-                                    ava_result.update({key:vehicles_list[vehicle_sequence][key]})
-                                    ava_result.update({"ava_validation_method":"REGISTRATION NUMBER"})
+
+def as400_vehicle_key(vehicle):
+    """Build the year + make + model key of an AS400 vehicle that is compared with the extracted vehicle key."""
+    # CHECK IF THE VEHICLE MAKE IS INCLUDED IN THE MODEL LISTING - SOMETIME THE MODEL STRING HAS THE MAKE STRING INCLUDED WHICH CREATES A DUPLICATE THAT THROWS OFF THE SIMILARITY MATCH
+    if vehicle["make"].lower() in vehicle["model"].lower():
+        # IF MODEL STRING INCLUDES MAKE STRING THEN STRIP OUT THE MAKE STRING FROM THE MODEL STRING
+        as400_vehicle_string = vehicle["year"].lower() + vehicle["make"].lower() + vehicle["model"].lower().replace(vehicle["make"].lower(), "")
+    else:
+        # OTHERWISE CONCATENATE THE YEAR, MAKE AND MODEL STRINGS
+        as400_vehicle_string = vehicle["year"].lower() + vehicle["make"].lower() + vehicle["model"].lower()
+        
+    return as400_vehicle_string.replace(" ", "")
+
+
+def match_vehicles(ava_compiliation, vehicles_list, ava_result, similarity_scores):
+    """
+    Match the extracted certificate details against the vehicles of a policy, updating ava_result in place.
+    similarity_scores holds the text similarity score of every vehicle sequence (see func.vehicle_similarity_scores).
+    """
+    
+    # UNPACK THE VEHICLE LIST
+    for vehicle_sequence in vehicles_list:
+        
+        # CREATE THE VEHICLE KEY STRING FOR SIMILARITY CHECK
+        as400_vehicle_string = as400_vehicle_key(vehicles_list[vehicle_sequence])
+        
+        text_similarity_score = similarity_scores[vehicle_sequence]
+        print(f"Extracted vehicle key",ava_compiliation["vehicle_key"])
+        print(f"AS400 vehicle key",as400_vehicle_string)
+        print(f"Text similarity score", text_similarity_score)
                             
-                            # MATCH ATTEMPT 4 - USE VEHICLE YEAR, MAKE AND MODEL
-                            elif text_similarity_score > 0.8:
-                                for key in vehicles_list[vehicle_sequence]:
-                                    ava_result.update({key:vehicles_list[vehicle_sequence][key]})
-                                    ava_result.update({"ava_validation_method":"TEXT SIMILARITY"})
-                                
-                            # NO MATCHES FOUND
-                            else:
-                                ava_result.update({'year': 'validation_unsuccessfull'})
-                                ava_result.update({'make': 'validation_unsuccessfull'})
-                                ava_result.update({'model': 'validation_unsuccessfull'})
-                                ava_result.update({'colour': 'validation_unsuccessfull'})
-                                ava_result.update({'registrationNumber': 'validation_unsuccessfull'})
-                                ava_result.update({'vinNumber': 'validation_unsuccessfull'})
-                                ava_result.update({'engineNumber': 'validation_unsuccessfull'})
-                                ava_result.update({'riskItemSequenceNumber': 'validation_unsuccessfull'})
-                                ava_result.update({'coverTypeDescription': 'validation_unsuccessfull'})
-                                ava_result.update({'statusDescription': 'validation_unsuccessfull'})
-                                ava_result.update({'vehicleActiveIndicator': 'validation_unsuccessfull'})
-                                ava_result.update({"ava_validation_method":"validation_unsuccessfull"})
-
-                        
-                else:
-                    # Handle errors for failed requests for activePolicy numbers
-                    print(f"There was an error getting the active policies with the provided ID Number")
-                                
-                
-                                             
-            print("AVA RESULTS")
-            print(ava_result)
+        # MATCH ATTEMPT 1 - USE VIN
+        if ava_compiliation["vin_number"].replace(" ", "").lower() == vehicles_list[vehicle_sequence]["vinNumber"].replace(" ", "").lower():
+            for key in vehicles_list[vehicle_sequence]:
+                ava_result.update({key:vehicles_list[vehicle_sequence][key]})
+                ava_result.update({"ava_validation_method":"VIN NUMBER"})
+        
+        # MATCH ATTEMPT 2 - USE ENGINE NUMBER        
+        elif ava_compiliation["engine_number"].replace(" ", "").lower() == vehicles_list[vehicle_sequence]["engineNumber"].replace(" ", "").lower():
+            for key in vehicles_list[vehicle_sequence]:
+                ava_result.update({key:vehicles_list[vehicle_sequence][key]})   
+                ava_result.update({"ava_validation_method":"ENGINE NUMBER"})
                 
+        # MATCH ATTEMPT 3 - USE REGISTRATION NUMBER
+        elif ava_compiliation["registration_number"].strip().lower() == vehicles_list[vehicle_sequence]["registrationNumber"].strip().lower():
+            for key in vehicles_list[vehicle_sequence]:
+                ava_result.update({key:vehicles_list[vehicle_sequence][key]})
+                ava_result.update({"ava_validation_method":"REGISTRATION NUMBER"})
+        
+        # MATCH ATTEMPT 4 - USE VEHICLE YEAR, MAKE AND MODEL
+        elif text_similarity_score > 0.8:
+            for key in vehicles_list[vehicle_sequence]:
+                ava_result.update({key:vehicles_list[vehicle_sequence][key]})
+                ava_result.update({"ava_validation_method":"TEXT SIMILARITY"})
+        
+        # NO MATCHES FOUND
+        else:
+            for key in VALIDATION_UNSUCCESSFUL_FIELDS:
+                ava_result.update({key: 'validation_unsuccessfull'})
+            ava_result.update({"ava_validation_method":"validation_unsuccessfull"})
+
+
+async def stage_match(state, errors):
+    """Validate the extracted certificate details against the AS400 vehicles."""
+    ava_result = {}
+    
+    if state["ava_lookup_method"] is not None:
+        ava_result.update({"ava_lookup_method": state["ava_lookup_method"]})
+        
+        for vehicles_list in state["vehicle_lists"]:
+            # The embeddings are computed in the CPU executor, off the event loop
+            as400_vehicle_keys = {vehicle_sequence: as400_vehicle_key(vehicle) for vehicle_sequence, vehicle in vehicles_list.items()}
+            similarity_scores = await executor.run_cpu(func.vehicle_similarity_scores, state["ava_compiliation"]["vehicle_key"], as400_vehicle_keys)
+            match_vehicles(state["ava_compiliation"], vehicles_list, ava_result, similarity_scores)
+    
+    print("AVA RESULTS")
+    print(ava_result)
+    
+    return {"ava_result": ava_result}
+
+
+async def stage_forward(state, errors):
+    """Forward the email and mark it as read. Only runs when FORWARD_EMAILS is enabled."""
+    if not FORWARD_EMAILS:
+        return {"forward_status": "disabled"}
+    
+    email_data = state["email_data"]
+    
+    # Forward email
+    with metrics.span("forward"):
+        forward_success = await forward_email(
+                state["access_token"], 
+                state["account"], 
+                state["message_id"], 
+                email_data['from'], 
+                DEFAULT_FORWARD_TO, 
+                email_data, 
+                "AI Forwarded message"
+            ) 
+    
+    # An email whose attachments are still being scanned was already parked by the context stage
+    if not forward_success:
+        raise RuntimeError(f"Failed to forward message {state['message_id']}")
+    
+    # Mark as read only if forwarding was successful
+    marked_as_read = await mark_email_as_read(state["access_token"], state["account"], state["message_id"])
+    if not marked_as_read:
+        processed_but_unread.add((state["account"], state["message_id"]))
+    
+    return {"forward_status": "success", "forwarded_to": DEFAULT_FORWARD_TO}
+
+
+STAGES = [
+    ("context", stage_context),
+    ("triage", stage_triage),
+    ("extraction", stage_extraction),
+    ("lookup", stage_lookup),
+    ("match", stage_match),
+    ("forward", stage_forward),
+]
+
+STAGE_NAMES = [name for name, _ in STAGES]
+
+# Stages whose effect can not be undone. Their checkpoint is saved whenever they succeed and loaded on every
+# retry, also after an unclean stage, so an email is never forwarded twice
+SIDE_EFFECT_STAGES = {"forward"}
+
+# Dependencies called by each stage. A stage is not started while the breaker of one of them is open
+STAGE_DEPENDENCIES = {
+    "context": [breakers.GRAPH, breakers.DOCUMENT_INTELLIGENCE],
+    "triage": [breakers.OPENAI],
+    "extraction": [breakers.OPENAI],
+    "lookup": [breakers.ESB],
+    "match": [],
+    "forward": [breakers.GRAPH],
+}
+
+
+def serialize_stage_output(output):
+    """Convert a stage output to JSON serialisable data for its checkpoint."""
+    return {key: value.to_dict(include_trail=True) if isinstance(value, EmailContext) else value for key, value in output.items()}
+
+
+def restore_stage_output(stage_name, output):
+    """Inverse of serialize_stage_output for a loaded checkpoint."""
+    if stage_name == "context":
+        output = dict(output, context=EmailContext.from_dict(output["context"]))
+    return output
+
+
+async def run_stages(state):
+    """
+    Run the pipeline stages for an email, resuming after the last stage that was checkpointed.
+    
+    Returns:
+        list: Names of the stages that failed or reported errors, empty if the email completed
+    """
+    saved = checkpoints.load_checkpoints(state["ledger_key"])
+    failed_steps = []
+    
+    # Stages after a failed or unclean stage are run on unclean input and are therefore not checkpointed,
+    # except the SIDE_EFFECT_STAGES
+    clean = True
+    
+    for stage_name, stage in STAGES:
+        if (clean or stage_name in SIDE_EFFECT_STAGES) and stage_name in saved:
+            state.update(restore_stage_output(stage_name, saved[stage_name]))
+            print(f"Resuming {state['ledger_key']} - loaded checkpoint for stage: {stage_name}")
+            continue
+        
+        # Park the email at this stage instead of running it against a dependency that is down
+        for dependency in STAGE_DEPENDENCIES.get(stage_name, []):
+            if breakers.is_open(dependency):
+                raise deferred.DeferEmail(f"{DEPENDENCY_UNAVAILABLE}{dependency}")
+        
+        errors = []
+        rejected = breakers.track_rejections()
+        try:
+            with metrics.span("stage", stage=stage_name):
+                output = await stage(state, errors)
+        except deferred.DeferEmail:
+            # The stages completed so far stay checkpointed, the caller parks the email
+            raise
+        except breakers.CircuitOpenError as e:
+            raise deferred.DeferEmail(f"{DEPENDENCY_UNAVAILABLE}{e.dependency}")
         except Exception as e:
-            print(f"Error obtaining the vehicle details from the AS400: {str(e)}")
-         
-                
-        # if customer_email is not None:
-        #     FORWARD_TO = customer_email
-        # else:
-        #     FORWARD_TO = 'connexaibiztest@tihsa.co.za'
-                
-        # reply_to_address = email_data['from']
+            print(f"Error in stage {stage_name}: {str(e)}")
+            failed_steps.append(f"{stage_name}: {str(e)}")
+            break
         
-        # apex_post_cost_usd = apex_interactionID['message']['apex_cost_usd']
+        if rejected:
+            # The stage caught the rejected call and carried on with partial output, which is not checkpointed
+            raise deferred.DeferEmail(f"{DEPENDENCY_UNAVAILABLE}{sorted(rejected)[0]}")
         
-        # # Update the APEX_POST_AGENT log 
-        # add_to_log("eml_to", FORWARD_TO, log)
-        # add_to_log("eml_frm", email_data['from'], log)
-        # add_to_log("interaction_id", interactionID, log)
-        # add_to_log("apex_cost_usd", apex_post_cost_usd, log)
-    
-        # # Forward email
-        # forward_success = await forward_email(
-        #         access_token, 
-        #         account, 
-        #         message_id, 
-        #         reply_to_address, 
-        #         FORWARD_TO, 
-        #         email_data, 
-        #         "AI Forwarded message"
-        #     ) 
+        state.update(output)
         
-        # if forward_success:
-        #     add_to_log("sts_eml_forward", "success", log)
-        #     # Mark as read only if forwarding was successful
-        #     marked_as_read = await mark_email_as_read(access_token, account, message_id)
-                            
-        #     if marked_as_read:
-        #         interaction_id = interactionID
-        #         # First update the acknowledged field and the acknowledged timestamp in the APEX log
-        #         update_apex_log = await update_acknowledged_status(interaction_id)
-        # else:
-        #     add_to_log("sts_eml_forward", "failed", log)
-        # """
+        if errors:
+            failed_steps.append(f"{stage_name}: {', '.join(errors)}")
+            clean = False
         
-        # For testing purposes
-        # Uncomment the following line when testing
-        # await mark_email_as_read(access_token, account, message_id)
+        if clean or (stage_name in SIDE_EFFECT_STAGES and not errors):
+            checkpoints.save_checkpoint(state["ledger_key"], stage_name, serialize_stage_output(output))
+    
+    return failed_steps
+
+
+async def process_email(access_token, account, msg):
+    """
+    Process a single email: extract all information including attachment text using Document Intelligence,
+    categorize it, forward it, mark as read, and log it.
+    
+    The email is claimed in the processing ledger before any attachment is downloaded or analysed, so
+    emails that were already completed (e.g. a failed mark-as-read, or the same message delivered to
+    another mailbox) are skipped without repeating the OCR, LLM and ESB calls. The output of every stage
+    is checkpointed, so a retry resumes at the first stage that did not complete. Attachments are looked
+    up in the ledger by their hash, so a certificate sent again in a new message is not analysed again
+    and its certificate details are reused (see previous_certificate_details).
+    
+    Before that, the email is leased (see leases.py) so that several instances polling the same mailboxes
+    never process it twice. The lease is renewed while the email is in flight and released at the end.
+    
+    Emails parked while their attachments are scanned or a dependency is unavailable (see deferred.py and
+    breakers.py) are skipped until their retry time.
+    """
+    
+    message_id = msg['id']
+    ledger_key = ledger.ledger_key(msg)
+    
+    deferral = deferred.get_deferral(ledger_key)
+    if deferral is not None and not deferred.is_due(deferral):
+        metrics.mark_event("emails_processed_total", account=account, status="deferred")
+        return
+    
+    if not leases.acquire(ledger_key):
+        print(f"Skipping email with subject: {msg.get('subject', '')} - leased by another worker or instance ({ledger_key})")
+        metrics.mark_event("emails_processed_total", account=account, status="leased")
+        return
+    
+    try:
+        if deferral is not None and not await recheck_deferred_email(access_token, account, msg, ledger_key, deferral['reason']):
+            return
+        await process_leased_email(access_token, account, msg, ledger_key)
+    finally:
+        leases.release(ledger_key)
+
+
+async def recheck_deferred_email(access_token, account, msg, ledger_key, reason):
+    """
+    Check only what a parked email that is due is waiting for: the Safe Attachments scan status, or the
+    circuit breaker of the unavailable dependency.
+    
+    Returns:
+        bool: True if the email should be processed now (it is no longer waiting, or it has waited longer than DEFER_MAX_AGE)
+    """
+    if reason.startswith(DEPENDENCY_UNAVAILABLE):
+        # Kept parked until it finishes, so an email that keeps hitting the outage still expires after DEFER_MAX_AGE
+        if not breakers.is_open(reason[len(DEPENDENCY_UNAVAILABLE):]):
+            return True
+    else:
+        try:
+            attachments = await fetch_attachments(access_token, account, msg['id'])
+        except breakers.CircuitOpenError as e:
+            reason = f"{DEPENDENCY_UNAVAILABLE}{e.dependency}"
+        else:
+            if not scan_in_progress(attachments):
+                print(f"Safe Attachments scan finished for email with subject: {msg.get('subject', '')} ({ledger_key})")
+                deferred.clear(ledger_key)
+                return True
+    
+    if deferred.defer(ledger_key, account, msg['id'], reason):
+        metrics.mark_event("emails_processed_total", account=account, status="deferred")
+        return False
+    
+    # Waited too long, the pipeline fails the email as usual (counting the attempt)
+    return True
+
+
+async def process_leased_email(access_token, account, msg, ledger_key):
+    """Claim the email in the ledger and run the pipeline, while holding its lease."""
+    message_id = msg['id']
+    
+    # Holding a shared lease, a "processing" ledger entry can only be left by an instance whose lease expired.
+    # Leases that only this instance sees (LEASE_BACKEND=memory) do not exclude the other instances
+    if not ledger.claim_email(ledger_key, account, message_id, leased=leases.is_shared()):
+        ledger_status = ledger.get_status(ledger_key)
+        print(f"Skipping email with subject: {msg.get('subject', '')} - ledger status is {ledger_status['status']} ({ledger_key})")
         
+        if MARK_PROCESSED_AS_READ and ledger_status['status'] == ledger.STATUS_COMPLETED:
+            processed_but_unread.add((account, message_id))
+        metrics.mark_event("emails_processed_total", account=account, status="skipped")
+        return
+    
+    print(f"Processing email with subject: {msg.get('subject', '')}")
+    
+    start_time = datetime.datetime.now()
+    
+    state = {
+        "access_token": access_token,
+        "account": account,
+        "msg": msg,
+        "message_id": message_id,
+        "ledger_key": ledger_key,
+    }
+    
+    lease_lost = asyncio.Event()
+    renewal = asyncio.create_task(leases.keep_alive(ledger_key, lease_lost))
+    lease_lost_waiter = asyncio.create_task(lease_lost.wait())
+    stages = asyncio.create_task(run_stages(state))
+    try:
+        await asyncio.wait([stages, lease_lost_waiter], return_when=asyncio.FIRST_COMPLETED)
+        finished = stages.done()
+    finally:
+        renewal.cancel()
+        lease_lost_waiter.cancel()
+        if not stages.done():
+            stages.cancel()
+    
+    if not finished:
+        # Another instance took the email over, leave the ledger entry to it
+        print(f"Stopped processing email with subject: {msg.get('subject', '')} - the lease was lost")
+        metrics.mark_event("emails_processed_total", account=account, status="lease_lost")
+        return
+    
+    try:
+        failed_steps = stages.result()
+    except deferred.DeferEmail as e:
+        if deferred.defer(ledger_key, account, message_id, str(e)):
+            ledger.mark_deferred(ledger_key, str(e))
+            metrics.mark_event("emails_processed_total", account=account, status="deferred")
+            return
+        failed_steps = [f"{e}, still waiting after {DEFER_MAX_AGE} s"]
     except Exception as e:
         # add_to_log error handling code here
         print(f"Error processing email: {str(e)}")
+        failed_steps = [f"process_email: {str(e)}"]
+    
+    deferred.clear(ledger_key)
+    
+    # Emails with failed steps are retried on the next poll
+    if failed_steps:
+        ledger.mark_failed(ledger_key, "; ".join(failed_steps))
+    else:
+        ledger.mark_completed(ledger_key)
          
     end_time = datetime.datetime.now()
     # add_to_log("end_time", end_time, log)
 
     tat = (end_time - start_time).total_seconds()
+    metrics.observe("email_duration_seconds", tat, account=account)
+    metrics.mark_event("emails_processed_total", account=account, status="failed" if failed_steps else "completed")
     # add_to_log("tat", tat, log)
     print(f"Email processing completed in {tat:.2f} seconds")
 
@@ -377,31 +696,227 @@ async def process_email(access_token, account, email_data, message_id):
     # except Exception as e:
     #     print("Failed to log record to DB due to error: ", e)
     
+def email_priority(msg, now=None):
+    """
+    Return the scheduler priority of an unread email, a tuple that sorts lower for emails that go first.
+    
+    Emails received within PRIORITY_SLA_SECONDS come first, newest first, so fresh emails do not wait behind a
+    backlog. The backlog follows, oldest first. Within each, large emails (PRIORITY_LARGE_EMAIL_BYTES, or with
+    attachments when the size is unknown) go after the small ones, and emails that mention a tracker company
+    in PRIORITY_TRACKER_WEIGHTS go ahead by its weight.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    try:
+        received = datetime.datetime.fromisoformat(msg.get('receivedDateTime', '').replace('Z', '+00:00'))
+    except ValueError:
+        received = now
+    age = (now - received).total_seconds()
+    
+    size = message_size(msg)
+    large = size >= PRIORITY_LARGE_EMAIL_BYTES if size is not None else msg.get('hasAttachments', False)
+    
+    text = f"{msg.get('subject', '')} {msg.get('from', {}).get('emailAddress', {}).get('address', '')} {msg.get('bodyPreview', '')}".lower()
+    tracker_weight = max([weight for tracker, weight in PRIORITY_TRACKER_WEIGHTS.items() if tracker in text], default=0)
+    
+    if age <= PRIORITY_SLA_SECONDS:
+        return (PRIORITY_FRESH_LARGE if large else PRIORITY_FRESH, -tracker_weight, age)
+    return (PRIORITY_BACKLOG_LARGE if large else PRIORITY_BACKLOG, -tracker_weight, -age)
+
+
+async def update_concurrency(scheduler, throttled):
+    """
+    Set the concurrency limits of the scheduler: one email at a time while throttled by the LLM budget,
+    otherwise BATCH_SIZE, or DRAIN_MAX_CONCURRENCY in drain mode.
+    
+    Drain mode is entered when at least DRAIN_BACKLOG_THRESHOLD emails are queued and left once all the
+    mailboxes were fetched and no more than DRAIN_EXIT_BACKLOG emails are still queued.
+    
+    The stages await their Graph, Document Intelligence, OpenAI and ESB calls, so the extra workers of drain
+    mode overlap their waits. The CPU work runs in the CPU executor (see executor.py).
+    """
+    global draining
+    backlog = scheduler.queued()
+    if not draining and DRAIN_BACKLOG_THRESHOLD and backlog >= DRAIN_BACKLOG_THRESHOLD:
+        draining = True
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: update_concurrency - {backlog} emails queued, draining the backlog with {DRAIN_MAX_CONCURRENCY} workers")
+    elif draining and len(polled_mailboxes) >= len(EMAIL_ACCOUNTS) and backlog <= DRAIN_EXIT_BACKLOG:
+        draining = False
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: update_concurrency - Backlog drained, back to {BATCH_SIZE} workers")
+    metrics.set_gauge("drain_mode", 1 if draining else 0)
+    
+    if draining:
+        # Graph allows GRAPH_MAILBOX_CONCURRENCY concurrent requests per mailbox
+        account_limit = min(ACCOUNT_MAX_CONCURRENCY or GRAPH_MAILBOX_CONCURRENCY, GRAPH_MAILBOX_CONCURRENCY)
+        concurrency = DRAIN_MAX_CONCURRENCY
+    else:
+        account_limit = ACCOUNT_MAX_CONCURRENCY or None
+        concurrency = BATCH_SIZE
+    
+    await scheduler.set_limits(1 if throttled else concurrency, account_limit)
+
+
+async def intake_worker(scheduler, access_token, account):
+    """
+    Fetch the unread emails of one mailbox and queue them in the scheduler.
+    
+    While the cycle is still processing emails the mailbox is fetched again every EMAIL_FETCH_INTERVAL seconds,
+    so emails that arrive during a long cycle (e.g. while a backlog is drained) are queued straight away and go
+    ahead of the backlog. Emails that were already queued in this cycle are not queued again.
+    """
+    queued_ids = set()
+    while True:
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Fetching unread emails for: {account}")
+        try:
+            all_unread_emails = await fetch_unread_messages(access_token, account)
+        except Exception as e:
+            # The other mailboxes are not affected, the mailbox is fetched again on the next poll
+            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: intake_worker - Error fetching unread emails for {account}: {str(e)}")
+            all_unread_emails = []
+        polled_mailboxes.add(account)
+        
+        new_emails = [msg for msg in all_unread_emails if msg['id'] not in queued_ids]
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: intake_worker - Queueing {len(new_emails)} unread emails for {account}")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for msg in new_emails:
+            queued_ids.add(msg['id'])
+            await scheduler.submit(account, msg, priority=email_priority(msg, now))
+        
+        await update_concurrency(scheduler, usage.budget_pressure() >= BUDGET_SOFT_LIMIT)
+        
+        # The cycle ends once every mailbox was fetched and every queued email was processed
+        deadline = time.monotonic() + EMAIL_FETCH_INTERVAL
+        while time.monotonic() < deadline:
+            if scheduler.stopped:
+                return
+            if len(polled_mailboxes) >= len(EMAIL_ACCOUNTS) and scheduler.queued() == 0 and scheduler.in_flight() == 0:
+                return
+            await asyncio.sleep(min(1, deadline - time.monotonic()))
+
+
+async def processing_worker(scheduler, access_token):
+    """Process the emails handed out by the scheduler until it is closed and empty, or stopped."""
+    while True:
+        # Slow down while the LLM spend is close to a budget and stop the cycle once a budget is exhausted
+        pressure = usage.budget_pressure()
+        if pressure >= 1:
+            if not scheduler.stopped:
+                print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: processing_worker - LLM budget exhausted ({pressure:.0%}), pausing until the next cycle")
+                await scheduler.stop()
+            return
+        throttled = pressure >= BUDGET_SOFT_LIMIT
+        await update_concurrency(scheduler, throttled)
+        
+        item = await scheduler.next()
+        if item is None:
+            return
+        
+        account, msg = item
+        try:
+            await process_email(access_token, account, msg)
+            if throttled:
+                # The slot is held while waiting, so that only one email is processed per delay
+                await asyncio.sleep(BUDGET_THROTTLE_DELAY)
+        except Exception as e:
+            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: processing_worker - Error processing email for {account}: {str(e)}")
+        finally:
+            await scheduler.done(account)
+
+
 async def process_batch():
+    """
+    Run one processing cycle over all mailboxes.
     
+    Every mailbox has its own intake worker, so the mailboxes are fetched concurrently, and again every
+    EMAIL_FETCH_INTERVAL seconds until the cycle's emails are processed. The fetched emails are shared
+    between BATCH_SIZE processing workers by the FairScheduler, round-robin over the mailboxes (weighted by
+    ACCOUNT_WEIGHTS, at most ACCOUNT_MAX_CONCURRENCY emails of one mailbox at a time), so a busy mailbox does
+    not hold back the others. Fresh emails go ahead of the backlog (see email_priority).
+    
+    In drain mode (see update_concurrency) up to DRAIN_MAX_CONCURRENCY emails are processed at the same time.
+    """
     access_token = await get_access_token()
     
-    for account in EMAIL_ACCOUNTS:
-        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Fetching unread emails for: {account}")
+    # Retry marking emails as read that were completed earlier but are still unread
+    for account, message_id in list(processed_but_unread):
+        if await mark_email_as_read(access_token, account, message_id):
+            processed_but_unread.discard((account, message_id))
+    
+    polled_mailboxes.clear()
+    scheduler = FairScheduler(BATCH_SIZE, account_limit=ACCOUNT_MAX_CONCURRENCY or None, weights=ACCOUNT_WEIGHTS)
+    # The scheduler limits how many of the workers process an email at the same time
+    workers = [asyncio.create_task(processing_worker(scheduler, access_token)) for _ in range(max(BATCH_SIZE, DRAIN_MAX_CONCURRENCY))]
+    
+    await asyncio.gather(*(intake_worker(scheduler, access_token, account) for account in EMAIL_ACCOUNTS))
+    await scheduler.close()
+    await asyncio.gather(*workers)
+
+
+# COMPONENTS LOADED BY THE WARM-UP BEFORE THE FIRST EMAIL, INSTEAD OF BY THE FIRST EMAIL THAT NEEDS THEM
+WARM_UP_COMPONENTS = {
+    "openai_client": func.get_openai_client,
+    "document_intelligence_client": get_document_client,
+    "graph_auth": lambda: importlib.import_module("msal"),
+    # Starts the CPU executor, for a process pool the workers load the embedding model themselves
+    "cpu_executor": executor.warm_up,
+}
+if CPU_EXECUTOR != 'process':
+    WARM_UP_COMPONENTS["embedding_model"] = func.get_embedding_model
+
+
+async def warm_up():
+    """
+    Import the heavy dependencies, create the clients and load the embedding model in parallel threads and
+    report readiness (also as the gauge ready). A component that fails to load is loaded again at first use.
+    
+    Returns:
+        bool: True if every component loaded
+    """
+    metrics.set_gauge("ready", 0)
+    start = time.monotonic()
+    
+    async def load(name, component):
+        component_start = time.monotonic()
         try:
-            all_unread_emails = await fetch_unread_emails(access_token, account)
-            
+            with metrics.span("warm_up", component=name):
+                await asyncio.to_thread(component)
         except Exception as e:
-            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: process_batch - Error fetching unread emails for {account}: {str(e)}")
-            continue  # Skip to the next account if there's an error fetching emails
-
-        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: process_batch - Processing {len(all_unread_emails)} unread emails in batch")
-        for i in range(0, len(all_unread_emails), BATCH_SIZE):
-            batch = all_unread_emails[i:i+BATCH_SIZE]
-            tasks = [asyncio.create_task(process_email(access_token, account, email_data, message_id)) 
-                     for email_data, message_id in batch]
-            await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Add a small delay between batches to avoid overwhelming the API
-            await asyncio.sleep(1)
+            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: warm_up - Failed to load {name}: {str(e)}")
+            return False
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: warm_up - Loaded {name} in {time.monotonic() - component_start:.2f} s")
+        return True
+    
+    results = await asyncio.gather(*(load(name, component) for name, component in WARM_UP_COMPONENTS.items()))
+    ready = all(results)
+    metrics.set_gauge("ready", 1 if ready else 0)
+    print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: warm_up - {'Ready' if ready else 'Started with components loading at first use'} after {time.monotonic() - start:.2f} s")
+    return ready
 
 
-async def main():
+async def main(watchdog=LOOP_WATCHDOG, drain=False):
+    global draining
+    if drain:
+        # Drain mode until the backlog is cleared, then the steady state settings
+        draining = True
+    
+    if watchdog:
+        loop_watchdog = LoopWatchdog()
+        loop_watchdog.start()
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: main - Event loop watchdog running, stalls over {loop_watchdog.threshold} s are logged")
+    
+    if METRICS_PORT:
+        metrics.start_metrics_server(METRICS_PORT)
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: main - Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    
+    if not leases.is_shared():
+        # The leases do not exclude other instances, their claims are only taken over once LEDGER_STALE_SECONDS old
+        print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: main - WARNING: LEASE_BACKEND={LEASE_BACKEND} only coordinates the workers of this instance, run a single instance or use a shared lease backend")
+        recent_claims = ledger.count_recent_claims()
+        if recent_claims:
+            print(f">> {datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=2))).strftime('%Y-%m-%d %H:%M:%S')} Script: main.py - Function: main - WARNING: {recent_claims} emails in the ledger are being processed, another instance may be running")
+    
+    # Load the dependencies, clients and the embedding model before the first email
+    await warm_up()
+    
     while True:
         start_time = time.time()
         
@@ -414,12 +929,128 @@ async def main():
         if elapsed_time < EMAIL_FETCH_INTERVAL:
             await asyncio.sleep(EMAIL_FETCH_INTERVAL - elapsed_time)
 
+def show_stuck_emails():
+    """Print every email in the ledger that is not completed, with the stages that were checkpointed."""
+    unfinished = ledger.list_unfinished()
+    if not unfinished:
+        print("No stuck emails")
+        return
+    
+    for entry in unfinished:
+        completed_stages = [name for name in STAGE_NAMES if name in checkpoints.load_checkpoints(entry['ledger_key'])]
+        print(f"{entry['ledger_key']} | {entry['account']} | {entry['status']} | attempts: {entry['attempts']} | updated: {entry['updated_at']}")
+        print(f"    completed stages: {', '.join(completed_stages) if completed_stages else 'none'}")
+        print(f"    error: {entry['error']}")
+        deferral = deferred.get_deferral(entry['ledger_key'])
+        if deferral is not None:
+            retry_at = datetime.datetime.fromtimestamp(deferral['retry_at']).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"    parked: {deferral['reason']} | checks: {deferral['checks']} | next check: {retry_at}")
+
+
+def inspect_email(ledger_key):
+    """Print the ledger entry and the saved stage outputs of an email."""
+    entry = ledger.get_status(ledger_key)
+    if entry is None:
+        print(f"No ledger entry for {ledger_key}")
+        return
+    
+    print(json.dumps(entry, indent=2))
+    saved = checkpoints.load_checkpoints(ledger_key)
+    for name in STAGE_NAMES:
+        if name in saved:
+            print(f"--- stage: {name} ---")
+            print(json.dumps(saved[name], indent=2, default=str))
+        else:
+            print(f"--- stage: {name} (not completed) ---")
+
+
+async def replay_email(ledger_key, from_stage=None):
+    """
+    Reset a stuck email in the ledger and process it again immediately.
+    Checkpoints are reused, unless from_stage is given in which case that stage and all later stages are rerun.
+    A stage in SIDE_EFFECT_STAGES that already succeeded (e.g. the forward) is only rerun when it is from_stage.
+    """
+    entry = ledger.get_status(ledger_key)
+    if entry is None:
+        print(f"No ledger entry for {ledger_key}")
+        return
+    
+    if from_stage is not None:
+        rerun = [name for name in STAGE_NAMES[STAGE_NAMES.index(from_stage):] if name not in SIDE_EFFECT_STAGES or name == from_stage]
+        checkpoints.clear_checkpoints(ledger_key, rerun)
+    
+    ledger.reset_email(ledger_key)
+    deferred.clear(ledger_key)
+    
+    access_token = await get_access_token()
+    msg = await fetch_message(access_token, entry['account'], entry['message_id'])
+    if msg is None:
+        print(f"Could not fetch message {entry['message_id']} from {entry['account']}")
+        return
+    
+    await process_email(access_token, entry['account'], msg)
+
+
+def show_usage():
+    """Print the LLM token usage and estimated cost for the last hour and day."""
+    for window_name, window_seconds in [("last hour", usage.HOUR), ("last 24 hours", usage.DAY)]:
+        print(f"=== LLM usage - {window_name} (spent ${usage.spend_in_window(window_seconds):.4f}) ===")
+        for group_by in usage.GROUP_BY_COLUMNS:
+            print(f"--- by {group_by} ---")
+            for row in usage.usage_summary(window_seconds, group_by):
+                print(f"  {row[group_by]}: calls={row['calls']} input={row['input_tokens']} completion={row['completion_tokens']} cached={row['cached_tokens']} cost=${row['cost_usd']:.4f}")
+    print(f"Budget pressure: {usage.budget_pressure():.0%}")
+
+
+async def record_fixture(path):
+    """Run a single processing cycle against the live services and save the responses as a replay fixture."""
+    import replay
+    
+    recording = replay.install_recorder()
+    try:
+        await process_batch()
+    finally:
+        replay.uninstall()
+        recorded = replay.save_fixture(recording, path)
+        print(f"Recorded {recorded} emails to {path}")
+
+
 def trigger_email_triage():
     if len(sys.argv) > 1 and sys.argv[1] == 'start':
         asyncio.run(main())
+    elif len(sys.argv) > 1 and sys.argv[1] == 'watchdog':
+        asyncio.run(main(watchdog=True))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'drain':
+        asyncio.run(main(drain=True))
+    elif len(sys.argv) > 2 and sys.argv[1] == 'record':
+        asyncio.run(record_fixture(sys.argv[2]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        import bench
+        bench.main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'usage':
+        show_usage()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'stuck':
+        show_stuck_emails()
+    elif len(sys.argv) > 2 and sys.argv[1] == 'inspect':
+        inspect_email(sys.argv[2])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        from_stage = sys.argv[3] if len(sys.argv) > 3 else None
+        if from_stage is not None and from_stage not in STAGE_NAMES:
+            print(f"Unknown stage {from_stage}, expected one of: {', '.join(STAGE_NAMES)}")
+            return
+        asyncio.run(replay_email(sys.argv[2], from_stage))
     else:
         print("To start the email processing, run with 'start' argument")
         print("Run Command: python main.py start")
+        print("Admin Commands:")
+        print("  python main.py watchdog                             - start the email processing and log the calls that block the event loop")
+        print("  python main.py drain                                - start the email processing in drain mode, until the backlog is cleared")
+        print("  python main.py record <fixture_path>                - process one cycle and save the responses as a replay fixture")
+        print("  python main.py bench <fixture_path> [options]       - benchmark the pipeline offline against a fixture (see python bench.py -h)")
+        print("  python main.py usage                                - show LLM token usage and cost per model, call type, tracker and mailbox")
+        print("  python main.py stuck                                - list emails that did not complete")
+        print("  python main.py inspect <ledger_key>                 - show the saved stage outputs of an email")
+        print("  python main.py replay <ledger_key> [from_stage]     - reprocess an email now, optionally rerunning from a stage")
 
 if __name__ == '__main__':
-    trigger_email_triage()
+    trigger_email_triage()
\ No newline at end of file
@@ -0,0 +1,251 @@
+import time
+import bisect
+import threading
+import contextlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# HISTOGRAM BUCKET UPPER BOUNDS IN SECONDS
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+# NUMBER OF RECENT SAMPLES KEPT PER SERIES FOR THE P50/P95/P99 ESTIMATES
+SAMPLE_WINDOW = 1024
+
+# WINDOW IN SECONDS USED FOR THE THROUGHPUT GAUGE
+THROUGHPUT_WINDOW = 60
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_events = {}
+_started_at = time.time()
+
+# Metrics recorded in a process pool worker are collected here and sent back with the task result, see executor.py
+_recording = None
+
+
+def _series_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def observe(name, seconds, **labels):
+    """Record a latency sample (in seconds) for a metric."""
+    if _recording is not None:
+        _recording.append(("observe", name, seconds, labels))
+        return
+    key = _series_key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = {
+                "buckets": [0] * len(LATENCY_BUCKETS),
+                "count": 0,
+                "sum": 0.0,
+                "samples": deque(maxlen=SAMPLE_WINDOW),
+            }
+            _histograms[key] = histogram
+
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        if index < len(LATENCY_BUCKETS):
+            histogram["buckets"][index] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["samples"].append(seconds)
+
+
+def increment(name, value=1, **labels):
+    """Increment a counter."""
+    if _recording is not None:
+        _recording.append(("increment", name, value, labels))
+        return
+    key = _series_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to its current value."""
+    if _recording is not None:
+        _recording.append(("set_gauge", name, value, labels))
+        return
+    key = _series_key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def mark_event(name, **labels):
+    """Increment a counter and remember when it happened so that a rolling throughput can be reported."""
+    increment(name, **labels)
+    key = _series_key(name, labels)
+    now = time.time()
+    with _lock:
+        events = _events.setdefault(key, deque())
+        events.append(now)
+        while events and events[0] < now - THROUGHPUT_WINDOW:
+            events.popleft()
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """
+    Time a block of code and record it under `name`. Works inside both sync and async functions.
+
+    Records the latency histogram `<name>_duration_seconds`, the counter `<name>_total` and, when the
+    block raises, the counter `<name>_errors_total`. The exception is re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        increment(f"{name}_errors_total", **labels)
+        raise
+    finally:
+        observe(f"{name}_duration_seconds", time.perf_counter() - start, **labels)
+        increment(f"{name}_total", **labels)
+
+
+def start_recording():
+    """Collect the metrics recorded from now on instead of keeping them, until take_recording is called."""
+    global _recording
+    _recording = []
+
+
+def take_recording():
+    """Stop collecting and return the collected metrics, to be passed to replay in another process."""
+    global _recording
+    recorded, _recording = _recording or [], None
+    return recorded
+
+
+def replay(recorded):
+    """Record the metrics collected by take_recording (in a process pool worker) in this process."""
+    functions = {"observe": observe, "increment": increment, "set_gauge": set_gauge}
+    for kind, name, value, labels in recorded:
+        functions[kind](name, value, **labels)
+
+
+def counter_value(name, **labels):
+    """Return the current value of a counter, 0 if it was never incremented."""
+    with _lock:
+        return _counters.get(_series_key(name, labels), 0)
+
+
+def percentile(name, q, **labels):
+    """
+    Return the q-th quantile (0-1) of the recent samples of a span, or None if there are no samples.
+
+    Args:
+        name (str): Span name as passed to span()
+        q (float): Quantile between 0 and 1
+    """
+    key = _series_key(f"{name}_duration_seconds", labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        samples = sorted(histogram["samples"]) if histogram else []
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def _escape_label_value(value):
+    """Escape a label value for the Prometheus text format: backslash, double quote and line feed."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in pairs) + "}"
+
+
+def render_prometheus():
+    """Render all metrics in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {key: {"buckets": list(h["buckets"]), "count": h["count"], "sum": h["sum"], "samples": sorted(h["samples"])}
+                      for key, h in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        now = time.time()
+        throughput = {key: len([t for t in events if t >= now - THROUGHPUT_WINDOW]) / THROUGHPUT_WINDOW
+                      for key, events in _events.items()}
+
+    lines = [
+        "# TYPE process_uptime_seconds gauge",
+        f"process_uptime_seconds {now - _started_at:.3f}",
+    ]
+
+    for name in sorted({key[0] for key in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (series_name, labels), value in sorted(counters.items()):
+            if series_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for name in sorted({key[0] for key in gauges}):
+        lines.append(f"# TYPE {name} gauge")
+        for (series_name, labels), value in sorted(gauges.items()):
+            if series_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for name in sorted({key[0] for key in throughput}):
+        gauge = f"{name.removesuffix('_total')}_per_second"
+        lines.append(f"# TYPE {gauge} gauge")
+        for (series_name, labels), value in sorted(throughput.items()):
+            if series_name == name:
+                lines.append(f"{gauge}{_format_labels(labels)} {value:.4f}")
+
+    for name in sorted({key[0] for key in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (series_name, labels), histogram in sorted(histograms.items()):
+            if series_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+        quantile_name = f"{name.removesuffix('_seconds')}_quantile_seconds"
+        lines.append(f"# TYPE {quantile_name} gauge")
+        for (series_name, labels), histogram in sorted(histograms.items()):
+            if series_name != name or not histogram["samples"]:
+                continue
+            samples = histogram["samples"]
+            for q in QUANTILES:
+                value = samples[min(len(samples) - 1, int(q * len(samples)))]
+                lines.append(f"{quantile_name}{_format_labels(labels, [('quantile', q)])} {value:.6f}")
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the processing logs
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """Serve /metrics on a background thread. Returns the server so that it can be shut down."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    return server
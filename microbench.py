@@ -0,0 +1,280 @@
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import tracemalloc
+
+# MICRO-BENCHMARKS FOR THE TEXT PROCESSING THAT RUNS ON EVERY EMAIL
+# Measures the time per call and the peak memory allocated by one call on realistic synthetic inputs
+# and compares them with a saved baseline.
+#
+#   python microbench.py --save-baseline           # record a baseline (microbench_baseline.json)
+#   python microbench.py                           # compare against it, exit code 1 on a regression
+#   python microbench.py --only get_email_body     # run a subset
+#
+# The benchmarks are registered with @benchmark below. Each one is a setup function that builds its
+# inputs (not timed) and returns the zero-argument callable that is timed.
+
+DEFAULT_BASELINE_PATH = 'microbench_baseline.json'
+
+# A benchmark is flagged when its time or allocation exceeds the baseline by more than this fraction
+DEFAULT_THRESHOLD = 0.20
+
+BENCHMARKS = {}
+
+WORDS = ("vehicle tracking unit fitted certificate installation chassis engine registration policy "
+         "insurance client contract product netstar tracker cartrack recovery warranty monitoring "
+         "the of and to for with on at by from this that is are was be as").split()
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def _sentence(rng, words=12):
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:]
+
+
+def synthetic_ocr_lines(rng, pages=50, lines_per_page=60):
+    """OCR lines as returned per page by Document Intelligence: headers, key-value lines, lists and wrapped prose."""
+    result = []
+    for page in range(1, pages + 1):
+        lines = [f"FITMENT CERTIFICATE - PAGE {page}", f"VIN: AHTFR22G{rng.randint(100000000, 999999999)}",
+                 f"Engine No: 1ZR{rng.randint(1000000, 9999999)}", f"Registration: CA {rng.randint(100000, 999999)}"]
+        while len(lines) < lines_per_page:
+            kind = rng.random()
+            if kind < 0.15:
+                lines.append(f"- {_sentence(rng, 6)}")
+            elif kind < 0.3:
+                lines.append("")
+            elif kind < 0.6:
+                lines.append(_sentence(rng, 10) + ".")
+            else:
+                lines.append(_sentence(rng, 10).lower())
+        result.append(lines)
+    return result
+
+
+def synthetic_html_body(rng, size=200_000):
+    """An Outlook style HTML body with a long chain of quoted replies and signatures, about `size` bytes."""
+    parts = ["<html><head><style>p{margin:0}</style></head><body>",
+             f"<div><p>{_sentence(rng, 30)}</p><p>Policy number {rng.randint(100000000, 999999999)}</p></div>"]
+    reply = 0
+    while sum(len(part) for part in parts) < size:
+        reply += 1
+        parts.append('<div id="divRplyFwdMsg" dir="ltr"><hr style="display:inline-block;width:98%">'
+                     f'<font face="Calibri"><b>From:</b> Sender {reply} &lt;sender{reply}@example.com&gt;<br>'
+                     f'<b>Sent:</b> Monday, 3 March 2025 10:{reply % 60:02d}<br><b>To:</b> claims@example.com<br>'
+                     f'<b>Subject:</b> RE: Tracker certificate</font></div>')
+        parts.append("<div>" + "".join(f"<p>{_sentence(rng, 25)}</p>" for _ in range(8)) + "</div>")
+        parts.append('<table><tr><td><img src="cid:logo.png" width="120"></td><td>Kind regards<br>Client Services<br>'
+                     'Tel: 021 000 0000</td></tr></table>')
+        parts.append("<p style='font-size:8pt'>DISCLAIMER: This e-mail and any attachments are confidential and "
+                     "intended solely for the addressee. " + _sentence(rng, 40) + "</p>")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def synthetic_email_data(rng, attachments=3, pages=50):
+    import email_processor.email_utils as email_utils
+
+    processed_attachments = []
+    for index in range(attachments):
+        page_texts = []
+        for page_number, lines in enumerate(synthetic_ocr_lines(rng, pages=pages), 1):
+            page_texts.append({"page_number": page_number, "text": "\n\n".join(email_utils.group_lines_into_paragraphs(lines))})
+        processed_attachments.append({
+            "name": f"certificate_{index}.pdf",
+            "content_type": "application/pdf",
+            "analysis_result": {
+                "full_text": "\n\n".join(page["text"] for page in page_texts),
+                "pages": page_texts,
+                "page_count": pages,
+                "has_handwritten_content": False,
+            },
+        })
+
+    return {
+        'email_id': 'bench',
+        'internet_message_id': '<bench@example.com>',
+        'to': 'claims@example.com',
+        'from': 'broker@example.com',
+        'date_received': '2025-03-03T10:00:00Z',
+        'cc': '',
+        'subject': 'RE: Tracker certificate for policy 123456789',
+        'body_html': '',
+        'body_text': "\n\n".join(_sentence(rng, 25) for _ in range(200)),
+        'processed_attachments': processed_attachments,
+    }
+
+
+def synthetic_policy_vehicles(rng, count=20):
+    makes = [("VOLKSWAGEN", "POLO VIVO 1.6 GLE"), ("TOYOTA", "TOYOTA HILUX 2.8 GD-6"), ("FORD", "RANGER 2.2 XL"),
+             ("BMW", "320I M SPORT"), ("HYUNDAI", "I20 1.4 FLUID"), ("NISSAN", "NP200 1.6 8V")]
+    vehicles = {}
+    for sequence in range(1, count + 1):
+        make, model = rng.choice(makes)
+        vehicles[sequence] = {"year": str(rng.randint(2005, 2024)), "make": make, "model": model,
+                              "vinNumber": f"AHT{rng.randint(10**13, 10**14 - 1)}", "engineNumber": f"E{rng.randint(10**6, 10**7)}",
+                              "registrationNumber": f"CA {rng.randint(100000, 999999)}"}
+    return vehicles
+
+
+@benchmark('group_lines_into_paragraphs')
+def setup_group_lines(rng):
+    from email_processor.email_utils import group_lines_into_paragraphs
+    pages = synthetic_ocr_lines(rng, pages=50)
+
+    def run():
+        for lines in pages:
+            group_lines_into_paragraphs(lines)
+    return run
+
+
+@benchmark('get_email_body')
+def setup_get_email_body(rng):
+    from email_processor.email_utils import get_email_body
+    msg = {'body': {'contentType': 'html', 'content': synthetic_html_body(rng)}}
+    return lambda: get_email_body(msg)
+
+
+@benchmark('get_email_body_full_trail')
+def setup_get_email_body_full_trail(rng):
+    from email_processor.email_utils import get_email_body
+    msg = {'body': {'contentType': 'html', 'content': synthetic_html_body(rng)}}
+    return lambda: get_email_body(msg, full_trail=True)
+
+
+@benchmark('html2text_body')
+def setup_html2text_body(rng):
+    # Reference: the whole body converted with html2text, as get_email_body did before the body processor
+    import html2text
+    html = synthetic_html_body(rng)
+    return lambda: html2text.html2text(html)
+
+
+@benchmark('generate_llm_text')
+def setup_generate_llm_text(rng):
+    from email_processor.email_utils import generate_llm_text
+    email_data = synthetic_email_data(rng)
+    return lambda: generate_llm_text(email_data)
+
+
+@benchmark('email_context_prompt')
+def setup_email_context_prompt(rng):
+    from email_processor.email_utils import build_email_context
+    email_data = synthetic_email_data(rng)
+
+    def run():
+        # Build the context and render the prompt once, as is done for every email
+        return build_email_context(email_data).prompt_text
+    return run
+
+
+@benchmark('text_similarity_score')
+def setup_text_similarity(rng):
+    from sentence_transformers import SentenceTransformer
+    import functions as func
+    model = SentenceTransformer('all-MiniLM-L6-v2')
+    vehicles = synthetic_policy_vehicles(rng)
+    keys = [(vehicle["year"] + vehicle["make"] + vehicle["model"]).lower().replace(" ", "") for vehicle in vehicles.values()]
+
+    def run():
+        for key in keys:
+            func.text_similarity_score("2008volkswagenpolovivo1.6", key, model)
+    return run
+
+
+def measure(run, rounds, min_round_time=0.2):
+    """Return the median seconds per call over `rounds` rounds and the peak bytes allocated by a single call."""
+    run()  # warm up caches and lazy imports
+
+    # Calibrate the number of calls per round so that a round lasts at least min_round_time
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        if time.perf_counter() - start >= min_round_time or number >= 1000:
+            break
+        number *= 2
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        timings.append((time.perf_counter() - start) / number)
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"seconds": statistics.median(timings), "min_seconds": min(timings), "peak_bytes": peak, "calls_per_round": number}
+
+
+def compare(results, baseline, threshold):
+    """Return the list of regression messages of results against baseline."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            previous = baseline[name][metric]
+            if previous and result[metric] > previous * (1 + threshold):
+                regressions.append(f"{name}: {metric} {previous:.6g} -> {result[metric]:.6g} (+{result[metric] / previous - 1:.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the per-email text processing functions")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help="Path of the baseline JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown/growth before flagging (0.2 = 20%%)")
+    parser.add_argument('--rounds', type=int, default=5, help="Number of timed rounds per benchmark")
+    parser.add_argument('--only', nargs='*', default=None, help="Names of the benchmarks to run")
+    parser.add_argument('--seed', type=int, default=1234, help="Seed for the synthetic inputs")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.only and name not in args.only:
+            continue
+        try:
+            run = setup(random.Random(args.seed))
+        except ImportError as e:
+            print(f"{name:<30} skipped ({e})")
+            continue
+        results[name] = measure(run, args.rounds)
+        print(f"{name:<30} {results[name]['seconds'] * 1000:>10.2f} ms/call {results[name]['peak_bytes'] / 1024:>10.0f} KiB peak")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions beyond {args.threshold:.0%} of the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,351 @@
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import functools
+import itertools
+import contextvars
+from types import SimpleNamespace
+
+# RECORD-AND-REPLAY OF THE EXTERNAL SERVICE CALLS (GRAPH, DOCUMENT INTELLIGENCE, AZURE OPENAI AND THE ESB)
+# Recording wraps the real functions and saves their responses, grouped per email, into an anonymised JSON
+# fixture. Replaying swaps the same functions for local stand-ins that serve the recorded responses with
+# injected latency and errors, so that the pipeline can be benchmarked without any live service.
+
+# (module name, function name, is async, kind) - kind selects the latency and error settings on replay
+TARGETS = [
+    ('email_processor.email_client', 'get_access_token', True, 'graph'),
+    ('email_processor.email_client', 'fetch_unread_messages', True, 'graph'),
+    ('email_processor.email_client', 'fetch_message', True, 'graph'),
+    ('email_processor.email_client', 'mark_email_as_read', True, 'graph'),
+    ('email_processor.email_client', 'forward_email', True, 'graph'),
+    ('email_processor.email_utils', 'fetch_attachments', True, 'graph'),
+    ('email_processor.email_utils', 'download_attachment', True, 'graph'),
+    ('email_processor.email_utils', 'extract_text_with_document_intelligence', True, 'document_intelligence'),
+    ('functions', 'get_tracking_company', True, 'llm'),
+    ('functions', 'get_policy_number', True, 'llm'),
+    ('functions', 'get_id_number', True, 'llm'),
+    ('functions', 'extract_details', True, 'llm'),
+    ('functions', 'get_token', False, 'esb'),
+    ('functions', 'get_active_policies', False, 'esb'),
+    ('functions', 'get_vehicles', False, 'esb'),
+]
+
+# Targets whose response is an OpenAI SDK object rather than plain JSON
+LLM_RESPONSE_TARGETS = {'get_tracking_company', 'get_policy_number', 'get_id_number', 'extract_details'}
+
+# Responses served when a fixture has no recording for a call that only reports success
+DEFAULT_RESPONSES = {
+    'mark_email_as_read': {"response": True, "duration": 0},
+    'forward_email': {"response": True, "duration": 0},
+}
+
+# Id of the email currently being processed, used to group recorded calls per email
+_current_email = contextvars.ContextVar('replay_current_email', default=None)
+
+_installed = []
+
+
+class ReplayInjectedError(Exception):
+    """Raised by a replay stand-in to simulate a failing dependency."""
+
+
+class FixtureMissError(Exception):
+    """Raised when the fixture has no recorded response for a call."""
+
+
+# ANONYMISATION
+
+_EMAIL_PATTERN = re.compile(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}')
+_ID_NUMBER_PATTERN = re.compile(r'(?<!\d)\d{13}(?!\d)')
+_POLICY_NUMBER_PATTERN = re.compile(r'(?<!\d)\d{9}(?!\d)')
+_VIN_PATTERN = re.compile(r'\b[A-HJ-NPR-Z0-9]{17}\b')
+
+
+class Anonymiser:
+    """
+    Replace e-mail addresses, SA ID numbers, policy numbers and VINs with stable fake values.
+    The same real value always maps to the same fake value, so the lookups in a fixture stay consistent.
+    Names, addresses and free text are not anonymised, review fixtures before sharing them.
+    """
+
+    def __init__(self):
+        self.mapping = {}
+
+    def _fake(self, kind, value, make):
+        key = (kind, value)
+        if key not in self.mapping:
+            self.mapping[key] = make(len([k for k in self.mapping if k[0] == kind]) + 1)
+        return self.mapping[key]
+
+    def text(self, value):
+        value = _EMAIL_PATTERN.sub(lambda m: self._fake('email', m.group(0).lower(), lambda n: f'user{n}@example.com'), value)
+        value = _ID_NUMBER_PATTERN.sub(lambda m: self._fake('id', m.group(0), lambda n: f'{9000000000000 + n}'), value)
+        value = _POLICY_NUMBER_PATTERN.sub(lambda m: self._fake('policy', m.group(0), lambda n: f'{900000000 + n}'), value)
+        value = _VIN_PATTERN.sub(lambda m: self._fake('vin', m.group(0), lambda n: f'TESTVIN{n:010d}'), value)
+        return value
+
+    def value(self, value):
+        if isinstance(value, str):
+            return self.text(value)
+        if isinstance(value, list):
+            return [self.value(item) for item in value]
+        if isinstance(value, dict):
+            return {self.value(key) if isinstance(key, str) else key: self.value(item) for key, item in value.items()}
+        return value
+
+
+def _to_jsonable(target, result):
+    if target in LLM_RESPONSE_TARGETS:
+        return result.model_dump()
+    if target == 'get_access_token':
+        return 'replay-access-token' if result else None
+    if target == 'get_token':
+        return 'replay-esb-token'
+    if target == 'fetch_unread_messages':
+        # The messages themselves are recorded per email
+        return {"message_count": len(result)}
+    if target == 'download_attachment':
+        # Attachment content is never stored, only its size
+        return None if result is None else {"size": len(result)}
+    return json.loads(json.dumps(result, default=str))
+
+
+def _to_namespace(value):
+    """Rebuild an attribute-accessible object (like an OpenAI response) from a recorded dict."""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _to_namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(item) for item in value]
+    return value
+
+
+def _patch(module_name, name, replacement):
+    """Replace a function on its module and on every loaded module that imported it by name."""
+    module = sys.modules[module_name]
+    original = getattr(module, name)
+    for loaded in list(sys.modules.values()):
+        if loaded is not None and getattr(loaded, name, None) is original:
+            setattr(loaded, name, replacement)
+            _installed.append((loaded, name, original))
+    return original
+
+
+def uninstall():
+    """Restore every function that was replaced by install_recorder() or install_replay()."""
+    while _installed:
+        module, name, original = _installed.pop()
+        setattr(module, name, original)
+
+
+def _import_targets():
+    import importlib
+    for module_name, _, _, _ in TARGETS:
+        importlib.import_module(module_name)
+    import main
+    return main
+
+
+# RECORDING
+
+def install_recorder():
+    """
+    Wrap the external calls so that their responses are recorded. Returns the recording,
+    which is written to disk with save_fixture().
+    """
+    main = _import_targets()
+    recording = {"emails": {}, "global": {}}
+
+    def store(target, result, duration):
+        email_id = _current_email.get()
+        if email_id is None:
+            calls = recording["global"].setdefault(target, [])
+        else:
+            calls = recording["emails"].setdefault(email_id, {"message": None, "calls": {}})["calls"].setdefault(target, [])
+        calls.append({"response": _to_jsonable(target, result), "duration": duration})
+
+    for module_name, name, is_async, _ in TARGETS:
+        original = getattr(sys.modules[module_name], name)
+
+        if is_async:
+            def make_wrapper(original=original, name=name):
+                @functools.wraps(original)
+                async def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    result = await original(*args, **kwargs)
+                    store(name, result, time.perf_counter() - start)
+                    return result
+                return wrapper
+        else:
+            def make_wrapper(original=original, name=name):
+                @functools.wraps(original)
+                def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    result = original(*args, **kwargs)
+                    store(name, result, time.perf_counter() - start)
+                    return result
+                return wrapper
+
+        _patch(module_name, name, make_wrapper())
+
+    original_process_email = main.process_email
+
+    @functools.wraps(original_process_email)
+    async def recording_process_email(access_token, account, msg):
+        recording["emails"].setdefault(msg['id'], {"message": None, "calls": {}})["message"] = msg
+        token = _current_email.set(msg['id'])
+        try:
+            return await original_process_email(access_token, account, msg)
+        finally:
+            _current_email.reset(token)
+
+    _patch('main', 'process_email', recording_process_email)
+    return recording
+
+
+def save_fixture(recording, path):
+    """Anonymise a recording and write it to a JSON fixture file."""
+    anonymiser = Anonymiser()
+    emails = {}
+    for index, (email_id, email) in enumerate(recording["emails"].items(), 1):
+        if email["message"] is None:
+            continue
+        fixture_id = f'email-{index}'
+        message = anonymiser.value(email["message"])
+        message["id"] = fixture_id
+        emails[fixture_id] = {"message": message, "calls": anonymiser.value(email["calls"])}
+
+    fixture = {
+        "recorded_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "emails": emails,
+        "global": anonymiser.value(recording["global"]),
+    }
+    with open(path, 'w') as f:
+        json.dump(fixture, f, indent=2)
+    return len(emails)
+
+
+# REPLAY
+
+def load_fixture(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def install_replay(fixture, email_count=None, latency_scale=1.0, extra_latency=None, error_rates=None, seed=None):
+    """
+    Replace the external calls with stand-ins that serve the responses of a fixture.
+
+    Args:
+        fixture (dict): Fixture loaded with load_fixture()
+        email_count (int): Number of unread emails to serve, the recorded emails are cycled with new ids.
+            Defaults to the number of recorded emails.
+        latency_scale (float): Multiplier applied to the recorded duration of every call, 0 disables sleeping
+        extra_latency (dict): Extra seconds added per call kind (graph, document_intelligence, llm, esb)
+        error_rates (dict): Probability (0-1) per call kind that a call raises ReplayInjectedError
+        seed (int): Seed for the random error injection
+    """
+    main = _import_targets()
+    extra_latency = extra_latency or {}
+    error_rates = error_rates or {}
+    rng = random.Random(seed)
+
+    recorded_ids = list(fixture["emails"])
+    if not recorded_ids:
+        raise ValueError("The fixture contains no recorded emails")
+    email_count = email_count or len(recorded_ids)
+
+    # Every served email gets a unique id (and internetMessageId, so the ledger does not skip it)
+    # mapped back to the recorded email it replays
+    served = {}
+    messages = []
+    for n in range(email_count):
+        recorded_id = recorded_ids[n % len(recorded_ids)]
+        message = dict(fixture["emails"][recorded_id]["message"])
+        message["id"] = f'{recorded_id}#{n}'
+        message["internetMessageId"] = f'<replay-{n}-{recorded_id}@bench>'
+        served[message["id"]] = recorded_id
+        messages.append(message)
+
+    # Next recorded response per (served email, target)
+    cursors = {}
+    download_counter = itertools.count()
+    global_cursors = {}
+
+    def next_response(target):
+        email_id = _current_email.get()
+        if email_id is not None:
+            calls = fixture["emails"][served[email_id]]["calls"].get(target, [])
+            position = cursors.get((email_id, target), 0)
+            if position < len(calls):
+                cursors[(email_id, target)] = position + 1
+                return calls[position]
+            if calls:
+                return calls[-1]
+
+        calls = fixture["global"].get(target, [])
+        if not calls and target in DEFAULT_RESPONSES:
+            return DEFAULT_RESPONSES[target]
+        if not calls:
+            raise FixtureMissError(f"No recorded response for {target}")
+        position = global_cursors.get(target, 0)
+        global_cursors[target] = position + 1
+        return calls[position % len(calls)]
+
+    def prepare(target, kind):
+        if target == 'fetch_unread_messages':
+            call = {"response": messages, "duration": next_response(target)["duration"] if fixture["global"].get(target) else 0}
+        else:
+            call = next_response(target)
+        delay = call["duration"] * latency_scale + extra_latency.get(kind, 0)
+        fail = rng.random() < error_rates.get(kind, 0)
+        response = call["response"]
+        if target in LLM_RESPONSE_TARGETS:
+            response = _to_namespace(response)
+        elif target == 'download_attachment' and response is not None:
+            # Zero-filled content of the recorded size, so that memory use stays realistic, with a unique
+            # prefix so that the replayed attachments are not all taken for the same signature image, or
+            # for an attachment that was analysed before (see ledger.get_attachment_analysis)
+            prefix = f'replay-{next(download_counter)}'.encode()
+            response = prefix + bytes(max(0, response["size"] - len(prefix)))
+        elif target == 'get_vehicles':
+            response = {int(key): value for key, value in response.items()}
+        return delay, fail, response
+
+    for module_name, name, is_async, kind in TARGETS:
+        if is_async:
+            def make_stand_in(name=name, kind=kind):
+                async def stand_in(*args, **kwargs):
+                    delay, fail, response = prepare(name, kind)
+                    await asyncio.sleep(delay)
+                    if fail:
+                        raise ReplayInjectedError(f"Injected {kind} error in {name}")
+                    return response
+                return stand_in
+        else:
+            def make_stand_in(name=name, kind=kind):
+                def stand_in(*args, **kwargs):
+                    delay, fail, response = prepare(name, kind)
+                    # The real calls are blocking, so the stand-ins block as well
+                    time.sleep(delay)
+                    if fail:
+                        raise ReplayInjectedError(f"Injected {kind} error in {name}")
+                    return response
+                return stand_in
+
+        _patch(module_name, name, make_stand_in())
+
+    original_process_email = main.process_email
+
+    @functools.wraps(original_process_email)
+    async def replaying_process_email(access_token, account, msg):
+        token = _current_email.set(msg['id'])
+        try:
+            return await original_process_email(access_token, account, msg)
+        finally:
+            _current_email.reset(token)
+
+    _patch('main', 'process_email', replaying_process_email)
+    return messages
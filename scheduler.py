@@ -0,0 +1,151 @@
+import time
+import heapq
+import asyncio
+import itertools
+import metrics
+
+
+class FairScheduler:
+    """
+    Shares the email pipeline between the mailboxes.
+
+    Every mailbox has its own queue. Workers take the next email with a smooth weighted round-robin over
+    the mailboxes that have queued emails and are below their concurrency limit, so a busy mailbox cannot
+    starve the others. A mailbox with weight 2 is served twice as often as one with weight 1.
+
+    Every email is submitted with a priority, a tuple that sorts lower for emails that should go first. The
+    first element is the priority class: only the mailboxes whose next email has the best class waiting are
+    served, so a fresh email in one mailbox is not held back by the backlog of another. Within a mailbox the
+    emails are handed out in priority order (in submission order for equal priorities).
+
+    Usage:
+        scheduler = FairScheduler(max_concurrency=3, account_limit=2)
+        await scheduler.submit(account, msg, priority=(0, ...))   # intake workers
+        await scheduler.close()                    # no more emails this cycle
+        while (item := await scheduler.next()):     # processing workers
+            account, msg = item
+            ...
+            await scheduler.done(account)
+    """
+
+    def __init__(self, max_concurrency, account_limit=None, weights=None):
+        """
+        Args:
+            max_concurrency (int): Maximum number of emails processed at the same time over all mailboxes
+            account_limit (int): Maximum number of emails of one mailbox processed at the same time, None for no limit
+            weights (dict): Account -> weight, accounts that are not listed have weight 1
+        """
+        self.max_concurrency = max_concurrency
+        self.account_limit = account_limit
+        self.weights = weights or {}
+        self._queues = {}
+        self._in_flight = {}
+        self._current_weights = {}
+        self._sequence = itertools.count()
+        self._closed = False
+        self._stopped = False
+        self._condition = asyncio.Condition()
+
+    def _update_gauges(self, account):
+        metrics.set_gauge("scheduler_queue_depth", len(self._queues.get(account, ())), account=account)
+        metrics.set_gauge("scheduler_in_flight", self._in_flight.get(account, 0), account=account)
+
+    async def submit(self, account, item, priority=(0,)):
+        """Queue an email of a mailbox, with its priority (a tuple, lower goes first, the first element is the class)."""
+        async with self._condition:
+            heapq.heappush(self._queues.setdefault(account, []), (priority, next(self._sequence), time.monotonic(), item))
+            self._in_flight.setdefault(account, 0)
+            self._update_gauges(account)
+            self._condition.notify_all()
+
+    async def close(self):
+        """Signal that no more emails will be submitted, workers stop once the queues are empty."""
+        async with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    async def stop(self):
+        """Stop handing out emails, the queued emails are dropped (they are still unread and fetched again)."""
+        async with self._condition:
+            self._stopped = True
+            for account in self._queues:
+                self._queues[account].clear()
+                self._update_gauges(account)
+            self._condition.notify_all()
+
+    async def set_limits(self, max_concurrency, account_limit):
+        """Change the concurrency limits, workers waiting for an email pick up a raised limit straight away."""
+        async with self._condition:
+            self.max_concurrency = max_concurrency
+            self.account_limit = account_limit
+            self._condition.notify_all()
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def queued(self):
+        """Return the number of queued emails over all mailboxes."""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def in_flight(self):
+        """Return the number of emails handed out and not done yet over all mailboxes."""
+        return sum(self._in_flight.values())
+
+    def _pick_account(self):
+        """Smooth weighted round-robin over the mailboxes that can take another email."""
+        eligible = [account for account, queue in self._queues.items()
+                    if queue and (self.account_limit is None or self._in_flight[account] < self.account_limit)]
+        if not eligible:
+            return None
+        
+        # Only the mailboxes whose next email is of the best priority class waiting take part in the round-robin
+        best_class = min(self._queues[account][0][0][0] for account in eligible)
+        eligible = [account for account in eligible if self._queues[account][0][0][0] == best_class]
+
+        total = 0
+        for account in eligible:
+            weight = self.weights.get(account, 1)
+            self._current_weights[account] = self._current_weights.get(account, 0) + weight
+            total += weight
+        chosen = max(eligible, key=lambda account: self._current_weights[account])
+        self._current_weights[chosen] -= total
+        return chosen
+
+    async def next(self):
+        """
+        Wait for the next email to process.
+
+        Returns:
+            tuple: (account, item), or None once the scheduler is closed and empty, or stopped
+        """
+        async with self._condition:
+            while True:
+                if self._stopped:
+                    return None
+
+                if sum(self._in_flight.values()) < self.max_concurrency:
+                    account = self._pick_account()
+                    if account is not None:
+                        priority, _, queued_at, item = heapq.heappop(self._queues[account])
+                        self._in_flight[account] += 1
+                        self._update_gauges(account)
+                        metrics.observe("scheduler_queue_wait_seconds", time.monotonic() - queued_at, account=account)
+                        metrics.increment("scheduler_dispatched_total", account=account, priority_class=priority[0])
+                        return account, item
+
+                if self._closed and self.queued() == 0:
+                    return None
+
+                await self._condition.wait()
+
+    async def done(self, account):
+        """Mark an email handed out by next() as finished."""
+        async with self._condition:
+            self._in_flight[account] -= 1
+            self._update_gauges(account)
+            self._condition.notify_all()
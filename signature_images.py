@@ -0,0 +1,91 @@
+import datetime
+import ledger
+from config import SIGNATURE_IMAGE_MIN_EMAILS
+
+# HASHES OF IMAGE ATTACHMENTS, STORED IN THE SAME SQLITE DATABASE AS THE PROCESSING LEDGER
+# An image that arrives with SIGNATURE_IMAGE_MIN_EMAILS different emails is a logo or signature image,
+# certificates and vehicle photos are different in every email.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_hashes (
+    hash TEXT PRIMARY KEY,
+    name TEXT,
+    email_count INTEGER NOT NULL DEFAULT 0,
+    last_ledger_key TEXT,
+    is_signature INTEGER NOT NULL DEFAULT 0,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL
+);
+
+-- Every email an image arrived with, email_count is the number of distinct emails in here
+CREATE TABLE IF NOT EXISTS image_emails (
+    hash TEXT NOT NULL,
+    ledger_key TEXT NOT NULL,
+    PRIMARY KEY (hash, ledger_key)
+);
+"""
+
+_schema_created = False
+
+
+def _get_connection():
+    global _schema_created
+    connection = ledger.get_connection()
+    if not _schema_created:
+        connection.executescript(SCHEMA)
+        _schema_created = True
+    return connection
+
+
+def is_signature_image(image_hash):
+    """Return True if the image was seen in enough emails (or was marked by hand) to be a signature image."""
+    connection = _get_connection()
+    with ledger._lock:
+        row = connection.execute(
+            "SELECT email_count, is_signature FROM image_hashes WHERE hash = ?", (image_hash,)
+        ).fetchone()
+    return row is not None and (row[1] == 1 or row[0] >= SIGNATURE_IMAGE_MIN_EMAILS)
+
+
+def record_image(image_hash, key, name):
+    """
+    Count an image attachment for an email. Every email is counted once, however often it is retried.
+
+    Args:
+        image_hash (str): SHA-256 of the image content
+        key (str): Ledger key of the email
+        name (str): Attachment name, kept for inspection
+    """
+    connection = _get_connection()
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with ledger._lock:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute("INSERT OR IGNORE INTO image_emails (hash, ledger_key) VALUES (?, ?)", (image_hash, key))
+            connection.execute(
+                """
+                INSERT INTO image_hashes (hash, name, email_count, last_ledger_key, first_seen, last_seen) VALUES (?, ?, 1, ?, ?, ?)
+                ON CONFLICT(hash) DO UPDATE SET
+                    email_count = (SELECT COUNT(DISTINCT ledger_key) FROM image_emails WHERE hash = excluded.hash),
+                    last_ledger_key = excluded.last_ledger_key,
+                    last_seen = excluded.last_seen
+                """,
+                (image_hash, name, key, now, now)
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+
+def mark_signature_image(image_hash, name=None):
+    """Flag an image as a signature image by hand, so that it is never analysed again."""
+    connection = _get_connection()
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with ledger._lock:
+        connection.execute(
+            """
+            INSERT INTO image_hashes (hash, name, is_signature, first_seen, last_seen) VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT(hash) DO UPDATE SET is_signature = 1
+            """,
+            (image_hash, name, now, now)
+        )
@@ -0,0 +1,151 @@
+import time
+import ledger
+import metrics
+from config import (MODEL_PRICES_USD_PER_1M_TOKENS, HOURLY_BUDGET_USD, DAILY_BUDGET_USD,
+                    BUDGET_SOFT_LIMIT, BUDGET_FALLBACK_MODEL)
+
+# TOKEN USAGE IS STORED IN THE SAME SQLITE DATABASE AS THE PROCESSING LEDGER SO THAT BUDGETS SURVIVE RESTARTS
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_usage (
+    ts REAL NOT NULL,
+    model TEXT NOT NULL,
+    call_type TEXT NOT NULL,
+    tracker_company TEXT,
+    mailbox TEXT,
+    input_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    cost_usd REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_token_usage_ts ON token_usage (ts);
+"""
+
+HOUR = 3600
+DAY = 86400
+
+GROUP_BY_COLUMNS = ('model', 'call_type', 'tracker_company', 'mailbox')
+
+_schema_created = False
+
+
+def _get_connection():
+    global _schema_created
+    connection = ledger.get_connection()
+    if not _schema_created:
+        connection.executescript(SCHEMA)
+        _schema_created = True
+    return connection
+
+
+def get_model_prices(model):
+    """Return the price entry for a model name such as 'gpt-4o-2024-08-06', matching the longest configured prefix."""
+    matches = [name for name in MODEL_PRICES_USD_PER_1M_TOKENS if (model or '').startswith(name)]
+    if not matches:
+        return None
+    return MODEL_PRICES_USD_PER_1M_TOKENS[max(matches, key=len)]
+
+
+def estimate_cost(model, input_tokens, completion_tokens, cached_tokens=0):
+    """Estimate the cost in USD of a model call. Unknown models are costed at 0."""
+    prices = get_model_prices(model)
+    if prices is None:
+        return 0.0
+    uncached_tokens = max(input_tokens - cached_tokens, 0)
+    return (uncached_tokens * prices['input'] + cached_tokens * prices['cached_input'] + completion_tokens * prices['output']) / 1_000_000
+
+
+def get_cached_tokens(response_usage):
+    """Return the number of cached prompt tokens reported for a call, 0 if the API version does not report it."""
+    details = getattr(response_usage, 'prompt_tokens_details', None)
+    if details is not None and getattr(details, 'cached_tokens', None) is not None:
+        return details.cached_tokens
+    return getattr(response_usage, 'cached_tokens', None) or 0
+
+
+def record_usage(response, call_type, mailbox=None, tracker_company=None):
+    """
+    Record the token usage and estimated cost of a chat completion response.
+
+    Args:
+        response: Chat completion response returned by the OpenAI client
+        call_type (str): Name of the call, e.g. tracker_company or certificate_details
+        mailbox (str): Mailbox the email was received in
+        tracker_company (str): Tracker company the email was classified as, if known
+
+    Returns:
+        float: Estimated cost of the call in USD
+    """
+    model = getattr(response, 'model', None) or 'unknown'
+    input_tokens = response.usage.prompt_tokens
+    completion_tokens = response.usage.completion_tokens
+    cached_tokens = get_cached_tokens(response.usage)
+    cost_usd = estimate_cost(model, input_tokens, completion_tokens, cached_tokens)
+
+    connection = _get_connection()
+    with ledger._lock:
+        connection.execute(
+            "INSERT INTO token_usage (ts, model, call_type, tracker_company, mailbox, input_tokens, completion_tokens, cached_tokens, cost_usd) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (time.time(), model, call_type, tracker_company, mailbox, input_tokens, completion_tokens, cached_tokens, cost_usd)
+        )
+
+    metrics.increment("llm_input_tokens_total", input_tokens, model=model, call_type=call_type)
+    metrics.increment("llm_completion_tokens_total", completion_tokens, model=model, call_type=call_type)
+    metrics.increment("llm_cached_tokens_total", cached_tokens, model=model, call_type=call_type)
+    metrics.increment("llm_cost_usd_total", cost_usd, model=model, call_type=call_type)
+
+    return cost_usd
+
+
+def usage_summary(window_seconds, group_by='model'):
+    """
+    Aggregate the token usage and cost over a rolling window.
+
+    Args:
+        window_seconds (int): Size of the window, e.g. usage.HOUR or usage.DAY
+        group_by (str): One of model, call_type, tracker_company or mailbox
+
+    Returns:
+        list: One dict per group with calls, token counts and cost_usd, most expensive first
+    """
+    if group_by not in GROUP_BY_COLUMNS:
+        raise ValueError(f"group_by must be one of {', '.join(GROUP_BY_COLUMNS)}")
+
+    connection = _get_connection()
+    with ledger._lock:
+        rows = connection.execute(
+            f"SELECT {group_by}, COUNT(*), SUM(input_tokens), SUM(completion_tokens), SUM(cached_tokens), SUM(cost_usd) "
+            f"FROM token_usage WHERE ts >= ? GROUP BY {group_by} ORDER BY SUM(cost_usd) DESC",
+            (time.time() - window_seconds,)
+        ).fetchall()
+    columns = [group_by, 'calls', 'input_tokens', 'completion_tokens', 'cached_tokens', 'cost_usd']
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def spend_in_window(window_seconds):
+    connection = _get_connection()
+    with ledger._lock:
+        row = connection.execute(
+            "SELECT COALESCE(SUM(cost_usd), 0) FROM token_usage WHERE ts >= ?", (time.time() - window_seconds,)
+        ).fetchone()
+    return row[0]
+
+
+def budget_pressure():
+    """
+    Return the highest fraction of a configured budget that has been spent in its window.
+    0 means no budget is configured, 1 or more means a budget is exhausted.
+    """
+    pressure = 0.0
+    if HOURLY_BUDGET_USD > 0:
+        pressure = max(pressure, spend_in_window(HOUR) / HOURLY_BUDGET_USD)
+    if DAILY_BUDGET_USD > 0:
+        pressure = max(pressure, spend_in_window(DAY) / DAILY_BUDGET_USD)
+    return pressure
+
+
+def select_model(preferred_model):
+    """Return the preferred model, or the cheaper fallback model while spend is over the soft budget limit."""
+    if budget_pressure() >= BUDGET_SOFT_LIMIT:
+        return BUDGET_FALLBACK_MODEL
+    return preferred_model